@@ -0,0 +1,205 @@
+""" Performance benchmarks of split generation, search, screening and export, run
+offline against `FakeScopus` and synthetic data.
+
+    python benchmark_suite.py                         # Quick run
+    python benchmark_suite.py --full                  # Grids up to a million splits
+    python benchmark_suite.py --save baseline.json    # Save the results as a baseline
+    python benchmark_suite.py --compare baseline.json # Fail on regressions
+
+Every benchmark is timed `--repeat` times and the best time is kept. Compare against
+baselines saved on the same machine: times aren't comparable across machines.
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from prisma_automator.collector import Collector
+from prisma_automator.dedup import Deduplicator
+from prisma_automator.exporters import export
+from prisma_automator.fake import FakeScopus, keyword_grid, synthetic_records
+from prisma_automator.ratelimit import TokenBucket
+from prisma_automator.screening import KeywordExclusion, Pipeline, YearRange, default_stages
+from prisma_automator.splitter import Splitter
+
+# Keyword group sizes of the split generation benchmarks, from tens to millions of splits.
+QUICK_GRIDS = [[5, 2], [10, 10, 10], [100, 10, 10, 10]]
+FULL_GRIDS = QUICK_GRIDS + [[100, 100, 100]]
+
+
+def measure(func, repeat: int) -> float:
+    """ Best time of `repeat` calls of `func`, in seconds. """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def splitter_size(groups: list) -> int:
+    splitter = Splitter()
+    splitter.add_kwgroups(groups)
+    return splitter.num_splits()
+
+
+def bench_split(group_sizes: list):
+    groups = keyword_grid(group_sizes)
+
+    def run():
+        splitter = Splitter()
+        splitter.add_kwgroups(groups)
+        splitter.split(log=False, save_to="")
+    return run, splitter_size(groups)
+
+
+def bench_search(num_splits: int, workers: int):
+    splitter = Splitter()
+    splitter.add_kwgroups(keyword_grid([num_splits], skips=False))
+    splits = splitter.split(log=False, save_to="")
+
+    def run():
+        # 5 ms per request, 1% of failed requests and up to 400 results per split
+        backend = FakeScopus(max_count=400, latency=0.005, error_rate=0.01)
+        collector = Collector(backend=backend, workers=workers,
+                              bucket=TokenBucket(rate=10**6), backoff=0.001)
+        collector.search(splits, subscriber=True, log=False)
+    return run, num_splits
+
+
+def chunks_of(df, chunk_size: int = 10000) -> list:
+    """ `df` in chunks, as `Collector.run()` screens and exports the search results. """
+    return [df[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
+
+
+def bench_screen(df, near_duplicates: bool):
+    chunks = chunks_of(df)
+
+    def run():
+        collector = Collector(backend=FakeScopus())
+        for _ in collector.screen_chunks(chunks, log=False, dedup=Deduplicator(
+                near_duplicates=near_duplicates)):
+            pass
+    return run, len(df)
+
+
+def bench_criteria(df):
+    chunks = chunks_of(df)
+
+    def run():
+        criteria = [YearRange(2010, 2020), KeywordExclusion(["brain computer", "digital twin"])]
+        collector = Collector(backend=FakeScopus())
+        for _ in collector.screen_chunks(chunks, log=False, pipeline=Pipeline(
+                default_stages(criteria=criteria))):
+            pass
+    return run, len(df)
+
+
+def bench_export(df, format: str, directory: str):
+    chunks = chunks_of(df)
+
+    def run():
+        export(chunks, f"{directory}/export.{format}", format)
+    return run, len(df)
+
+
+def benchmarks(full: bool, directory: str):
+    """ Yield `(name, setup)` tuples, where `setup()` returns the benchmarked function
+    and the number of items (splits or records) it processes.
+    """
+    for group_sizes in FULL_GRIDS if full else QUICK_GRIDS:
+        yield f"split/{splitter_size(keyword_grid(group_sizes))}", lambda g=group_sizes: bench_split(g)
+    num_splits = 1000 if full else 200
+    for workers in [1, 8]:
+        yield f"search/{num_splits}x{workers}", lambda w=workers: bench_search(num_splits, w)
+    num_records = 200000 if full else 20000
+    cached = []
+
+    def records():  # Generated once, only if a benchmark needs them
+        if not cached:
+            cached.append(synthetic_records(num_records))
+        return cached[0]
+    yield f"screen/{num_records}", lambda: bench_screen(records(), False)
+    yield f"screen_near/{num_records}", lambda: bench_screen(records(), True)
+    yield f"screen_criteria/{num_records}", lambda: bench_criteria(records())
+    for format in ["csv", "parquet", "xlsx"]:
+        yield f"export_{format}/{num_records}", lambda f=format: bench_export(records(), f, directory)
+
+
+def run_benchmarks(full: bool = False, repeat: int = 3, only: str = None) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, setup in benchmarks(full, directory):
+            if only and only not in name:
+                continue
+            try:
+                func, items = setup()
+                seconds = measure(func, repeat)
+            except ImportError as e:  # Optional dependency of an exporter
+                print(f"[#] {name}: skipped ({e})")
+                continue
+            results[name] = {"seconds": round(seconds, 6),
+                             "per_second": round(items / seconds, 1)}
+            print(f"[#] {name}: {seconds:.3f}s ({items / seconds:,.0f}/s)")
+    return results
+
+
+def save_baseline(results: dict, path: str):
+    baseline = {"date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.platform(),
+                "results": results}
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(baseline, f, indent=2)
+    print(f"[/] Baseline saved to: {path}")
+
+
+def compare(results: dict, path: str, tolerance: float) -> list:
+    """ Compare `results` with the baseline saved in `path`. Returns the names of the
+    benchmarks over `tolerance` (e.g. 0.25 for 25%) slower than the baseline.
+    """
+    with open(path, encoding="utf8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        status = "ok"
+        if ratio > 1 + tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(f"[#] {name}: {baseline[name]['seconds']:.3f}s -> {result['seconds']:.3f}s "
+              f"({ratio:.2f}x) {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--full", action="store_true",
+                        help="benchmark larger grids and record sets")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timings per benchmark, the best one is kept")
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", metavar="PATH", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(full=args.full, repeat=args.repeat, only=args.only)
+    if args.save:
+        save_baseline(results, args.save)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"[#] {len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+        print("[$] No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from pybliometrics.scopus.utils import config
 
 from prisma_automator.collector import Collector
 from prisma_automator.splitter import Splitter
+from prisma_automator.telemetry import Telemetry
 
 
 def main():
@@ -21,8 +22,12 @@ def main():
     other = ["Digital Twin", ""]
     kw_groups = [reality, goal, other]
 
+    # Metrics of the whole program, summarized at the end of the run
+    telemetry = Telemetry()
+    telemetry.start()
+
     # Create a Splitter and add the key word groups
-    splitter = Splitter()
+    splitter = Splitter(telemetry=telemetry)
     splitter.add_kwgroups(kw_groups)
 
     # Generate the splits. Results are saved to "./out".
@@ -30,7 +35,7 @@ def main():
 
     """ Search results collection """
     # Create a Collector
-    collector = Collector()
+    collector = Collector(telemetry=telemetry)
 
     # Search Scopus using the generated splits. Results are saved to "./out".
     collector.run(splits, subscriber=True, threshold=1000, log=True)
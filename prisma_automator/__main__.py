@@ -0,0 +1,5 @@
+import sys
+
+from prisma_automator.cli import main
+
+sys.exit(main())
@@ -0,0 +1,83 @@
+import os
+
+import pandas as pd
+
+from prisma_automator.utility import record_to_dict
+
+try:
+    import pyarrow  # noqa: F401  (optional: enables Parquet chunks)
+    CHUNK_FORMAT = "parquet"
+except ImportError:
+    CHUNK_FORMAT = "pkl"
+
+
+class ResultAccumulator:
+    def __init__(self, directory: str = None, chunk_size: int = 10000):
+        """ Collects the records of every split, in chunks of at most `chunk_size` rows.
+
+        `directory`: if given, full chunks are written to this directory (as Parquet
+        if pyarrow is installed, else as pickles) and only the current chunk is kept in
+        memory. If None, chunks are kept in memory.
+        `chunk_size`: number of rows per chunk.
+
+        Appending is linear in the number of records: chunks are only built once, and
+        never concatenated with each other until `to_frame()` is called.
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.num_rows = 0
+        self._buffer = []
+        self._chunks = []  # DataFrames, or paths to chunk files
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):  # Leftovers of a previous run
+                if name.startswith("chunk_"):
+                    os.remove(os.path.join(directory, name))
+
+    def append(self, split: str, records: list):
+        """ Add the `records` (namedtuples or dicts) found by `split`. """
+        for record in records:
+            row = {'splits': split}
+            row.update(record_to_dict(record))
+            self._buffer.append(row)
+            self.num_rows += 1
+            if len(self._buffer) >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """ Turn the buffered rows into a chunk. """
+        if not self._buffer:
+            return
+        # Chunks share one index, as if they were a single DataFrame
+        start = self.num_rows - len(self._buffer)
+        chunk = pd.DataFrame(self._buffer, index=range(
+            start, start + len(self._buffer)))
+        self._buffer = []
+        if self.directory:
+            path = os.path.join(
+                self.directory, f"chunk_{len(self._chunks):05d}.{CHUNK_FORMAT}")
+            if CHUNK_FORMAT == "parquet":
+                chunk.to_parquet(path)
+            else:
+                chunk.to_pickle(path)
+            chunk = path
+        self._chunks.append(chunk)
+
+    def iter_chunks(self):
+        """ Yield the collected records as DataFrames of at most `chunk_size` rows. """
+        self.flush()
+        for chunk in self._chunks:
+            if isinstance(chunk, str):
+                chunk = pd.read_parquet(
+                    chunk) if chunk.endswith(".parquet") else pd.read_pickle(chunk)
+            yield chunk
+
+    def to_frame(self) -> pd.DataFrame:
+        """ Return all records in a single DataFrame. """
+        chunks = list(self.iter_chunks())
+        if not chunks:
+            return pd.DataFrame(columns=['splits'])
+        return pd.concat(chunks, ignore_index=True)
+
+    def __len__(self):
+        return self.num_rows
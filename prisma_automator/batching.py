@@ -0,0 +1,86 @@
+from prisma_automator.query import match_terms, normalize_text, parse_split
+from prisma_automator.utility import record_to_dict
+
+# Maximum length of a batched split. Longer queries are rejected by the API (413/414).
+MAX_QUERY_LENGTH = 3000
+
+# Fields of a search result that TITLE-ABS-KEY() searches in.
+TEXT_FIELDS = ["title", "description", "authkeywords"]
+
+
+def batch_query(splits: list) -> str:
+    """ Combine `splits` into a single split: `(split1) OR (split2) OR ...`. """
+    if len(splits) == 1:
+        return splits[0]
+    return " OR ".join(f"({s})" for s in splits)
+
+
+def unbatch(split: str):
+    """ Return the list of splits combined by `batch_query()`, or None if `split` isn't a batch. """
+    # Collect the top-level parenthesized groups; a plain split can't be rebuilt from them
+    members = []
+    depth = 0
+    start = 0
+    quoted = False
+    for i, char in enumerate(split):
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            if depth == 0:
+                start = i + 1
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                members.append(split[start:i])
+    if len(members) < 2 or batch_query(members) != split:
+        return None
+    return members
+
+
+def batch_splits(splits, max_length: int = MAX_QUERY_LENGTH):
+    """ Greedily group consecutive splits so each group's `batch_query()` fits in `max_length`.
+
+    `splits`: list (or any iterable) of splits. Groups are yielded lazily, in order.
+    """
+    batch = []
+    length = 0
+    for s in splits:
+        extra = len(s) + 2 + (4 if batch else 0)  # Parentheses and " OR "
+        if batch and length + extra > max_length:
+            yield batch
+            batch = []
+            length = 0
+            extra = len(s) + 2
+        batch.append(s)
+        length += extra
+    if batch:
+        yield batch
+
+
+def demultiplex(records: list, splits: list) -> tuple[dict, int]:
+    """ Attribute the results of a batched query to the splits it combines.
+
+    Each record's title, abstract and author keywords are matched locally against the
+    terms of every split. A record that matches none of them (e.g. because Scopus matched
+    a plural or spelling variant, or because the abstract isn't available without
+    subscriber access) is attributed to all splits, so no paper is lost.
+
+    Returns a dict of split -> list of records, and the number of unmatched records.
+    """
+    terms = [parse_split(s) for s in splits]
+    groups = {s: [] for s in splits}
+    unmatched = 0
+    for record in records:
+        fields = record_to_dict(record)
+        text = normalize_text(" ".join(str(fields.get(f) or "")
+                                       for f in TEXT_FIELDS))
+        matched = [s for s, t in zip(splits, terms) if match_terms(t, text)]
+        if not matched:
+            unmatched += 1
+            matched = splits
+        for s in matched:
+            groups[s].append(record)
+    return groups, unmatched
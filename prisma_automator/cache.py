@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from prisma_automator.utility import record_to_dict
+
+
+def normalize_split(split: str) -> str:
+    """ Normalize a split for use as a cache key. Scopus is case-insensitive and
+    ignores repeated whitespace, so `"BCI"  AND "gaming"` and `"bci" AND "Gaming"`
+    are the same query.
+    """
+    return " ".join(split.split()).lower()
+
+
+class QueryCache:
+    def __init__(self, path: str = "./out/cache.sqlite", ttl: float = 7 * 24 * 60 * 60, max_size: int = 512 * 1024**2):
+        """ Persistent cache of search results, keyed by the normalized split, `subscriber` and view.
+
+        `path`: path to the SQLite file.
+        `ttl`: seconds after which an entry expires. If None, entries never expire.
+        `max_size`: maximum total size in bytes of the cached records. When it's
+        exceeded, the least recently used entries are evicted.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, split TEXT, num_results INTEGER,
+            records TEXT, size INTEGER, created REAL, accessed REAL)""")
+        self._con.commit()
+
+    def key(self, split: str, subscriber: bool, view: str, fields: list = None) -> str:
+        text = f"{normalize_split(split)}|{int(subscriber)}|{view}"
+        if fields is not None:  # Projected records (see `fields.project()`)
+            text += "|" + ",".join(sorted(fields))
+        return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+    def _lookup(self, split: str, subscriber: bool, view: str, need_records: bool, fields: list = None):
+        key = self.key(split, subscriber, view, fields)
+        now = time.time()
+        with self._lock:
+            row = self._con.execute(
+                "SELECT num_results, records, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[2] > self.ttl:
+                self._con.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._con.commit()
+                row = None
+            if row is None or (need_records and row[1] is None and row[0]):
+                self.misses += 1
+                return None
+            self._con.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._con.commit()
+            self.hits += 1
+        return row
+
+    def get_count(self, split: str, subscriber: bool, view: str):
+        """ Return `(num_results,)` for a cached split, or None on a miss.
+        `num_results` is None if Scopus refused to count the split (>5000).
+        """
+        row = self._lookup(split, subscriber, view, need_records=False)
+        if row is None:
+            return None
+        return (row[0],)
+
+    def get_records(self, split: str, subscriber: bool, view: str, fields: list = None):
+        """ Return the list of cached records (dicts) of a split, or None on a miss.
+        `fields`: the fields the records were projected to, if any.
+        """
+        row = self._lookup(split, subscriber, view,
+                           need_records=True, fields=fields)
+        if row is None:
+            return None
+        return json.loads(row[1]) if row[1] is not None else []
+
+    def put(self, split: str, subscriber: bool, view: str, num_results: int, records: list = None, fields: list = None):
+        """ Store the number of results of a split and, optionally, its records.
+
+        `records`: list of namedtuples or dicts. If None, only the count is stored and
+        an already cached list of records is kept.
+        `fields`: the fields `records` were projected to, if any. Records of different
+        projections are cached separately.
+        """
+        key = self.key(split, subscriber, view, fields)
+        now = time.time()
+        text = None
+        if records is not None:
+            text = json.dumps([record_to_dict(r) for r in records],
+                              separators=(',', ':'))
+        size = len(text) if text else 0
+        with self._lock:
+            if text is None:
+                row = self._con.execute(
+                    "SELECT records, num_results FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] is not None and row[1] == num_results:
+                    text, size = row[0], len(row[0])
+            self._con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (key, split, num_results, text, size, now, now))
+            self._evict()
+            self._con.commit()
+
+    def _evict(self):
+        total = self._con.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._con.execute(
+            "SELECT key, size FROM entries ORDER BY accessed").fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            self._con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> dict:
+        """ Return hit/miss counters of this session and the current size of the cache. """
+        with self._lock:
+            entries, size = self._con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries, "size": size}
+
+    def close(self):
+        self._con.close()
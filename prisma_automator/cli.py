@@ -0,0 +1,304 @@
+""" Command line interface of prisma-automator: `python -m prisma_automator <command>`.
+
+Commands only import the modules they need (pandas and pybliometrics are only
+imported to screen and export results, and on the first request to Scopus), so
+`split` and `plan` start in a few tens of milliseconds.
+"""
+import argparse
+import json
+import os
+import sys
+
+from prisma_automator.ratelimit import QuotaExhaustedError
+
+# Extensions of keyword group files. Any other input file holds one split per line.
+KEYWORD_FORMATS = (".json", ".yaml", ".yml")
+
+
+def load_kwgroups(path: str) -> list:
+    """ Read key-word groups from a JSON or YAML file: either a list of groups, or a
+    mapping of group name to group, in order. Every group is a list of key-words, where
+    `""` (or null) skips the group, e.g. in YAML:
+
+        reality: [Augmented Reality, Virtual Reality, Extended Reality || Mixed Reality]
+        goal: [BCI, Gaming]
+        other: [Digital Twin, ""]
+    """
+    with open(path, encoding="utf8") as f:
+        if path.endswith(".json"):
+            groups = json.load(f)
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError(
+                    "YAML key-word files require PyYAML: pip install pyyaml") from None
+            groups = yaml.safe_load(f)
+    if isinstance(groups, dict):
+        groups = list(groups.values())
+    if not isinstance(groups, list) or not all(isinstance(g, list) for g in groups):
+        raise ValueError(f"{path} must hold a list of key-word groups (lists of key-words).")
+    return [["" if kw is None else str(kw) for kw in group] for group in groups]
+
+
+def load_splits(path: str, log: bool = True, dedup: bool = True) -> list:
+    """ Splits of a key-word group file (see `load_kwgroups()`), or of a file with one
+    split per line, such as the one written by the `split` command.
+    """
+    if path.endswith(KEYWORD_FORMATS):
+        from prisma_automator.splitter import Splitter
+
+        splitter = Splitter()
+        splitter.add_kwgroups(load_kwgroups(path))
+        return splitter.split(log=log, save_to="", dedup=dedup)
+    with open(path, encoding="utf8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def directory(path: str) -> str:
+    """ `path` with a trailing separator, as expected by `Collector.run()`'s `save_to`. """
+    return os.path.join(path, "")
+
+
+def make_collector(args, backend=None):
+    from prisma_automator.collector import Collector
+    from prisma_automator.ratelimit import TokenBucket
+
+    kwds = {}
+    if backend is not None:
+        kwds["backend"] = backend
+    if args.cache:
+        from prisma_automator.cache import QueryCache
+        kwds["cache"] = QueryCache(args.cache)
+    if args.profile:
+        from prisma_automator.telemetry import Telemetry
+        kwds["telemetry"] = Telemetry(profile=True, trace_memory=True)
+    return Collector(workers=args.workers, bucket=TokenBucket(rate=args.rate, quota=args.quota), **kwds)
+
+
+def fields_of(args):
+    return args.fields.split(",") if args.fields else None
+
+
+def criteria_of(args) -> list:
+    """ Screening stages of the `--years`, `--include-type`, `--exclude-type`,
+    `--language` and `--exclude-keyword` options.
+    """
+    from prisma_automator.screening import DocumentType, KeywordExclusion, Language, YearRange
+
+    criteria = []
+    if args.years:
+        first, _, last = args.years.partition("-")
+        try:
+            criteria.append(YearRange(int(first) if first else None, int(last) if last else None))
+        except ValueError:
+            raise ValueError(f"Invalid year range: {args.years}. Use e.g. 2015-2024, 2015- or -2024.") from None
+    if args.include_type or args.exclude_type:
+        criteria.append(DocumentType(args.exclude_type, args.include_type or None))
+    if args.language:
+        criteria.append(Language(args.language))
+    if args.exclude_keyword:
+        criteria.append(KeywordExclusion(args.exclude_keyword))
+    return criteria
+
+
+def split_command(args, backend=None):
+    from prisma_automator.splitter import Splitter
+    from prisma_automator.utility import save_to_file
+
+    splitter = Splitter()
+    splitter.add_kwgroups(load_kwgroups(args.keywords))
+    splits = splitter.split(log=not args.quiet, save_to="", dedup=not args.no_dedup)
+    save_to_file(file_path=args.output, lines_to_write=splits)
+    if not args.quiet:
+        print(f"[/] Generated splits saved to: {args.output}")
+
+
+def plan_command(args, backend=None):
+    collector = make_collector(args, backend)
+    splits = load_splits(args.input, log=not args.quiet)
+    plan = collector.plan(splits, subscriber=args.subscriber, threshold=args.threshold,
+                          log=not args.quiet, refine=args.refine, batch=args.batch,
+                          fields=fields_of(args))
+    collector.save_plan(plan, directory(args.out) + "plan.txt", log=not args.quiet)
+
+
+def collect_command(args, backend=None):
+    scheduler = None
+    if args.budget is not None or args.priority != "plan" or args.weight:
+        from prisma_automator.scheduler import Scheduler
+
+        weights = {}
+        for weight in args.weight:
+            keyword, _, value = weight.rpartition("=")
+            weights[keyword] = float(value)
+        index = None
+        if args.index:
+            from prisma_automator.exporters import read_chunks
+            from prisma_automator.index import InvertedIndex
+
+            index = InvertedIndex()
+            for chunk in read_chunks(args.index):
+                index.add(chunk)
+        scheduler = Scheduler(args.budget, args.priority, weights, index)
+    collector = make_collector(args, backend)
+    splits = load_splits(args.input, log=not args.quiet)
+    collector.run(splits, save_to=directory(args.out), subscriber=args.subscriber,
+                  threshold=args.threshold, log=not args.quiet, dry_run=args.dry_run,
+                  resume=args.resume, refine=args.refine, batch=args.batch,
+                  near_duplicates=args.near_duplicates, incremental=args.incremental,
+                  format=args.format, fields=fields_of(args), scheduler=scheduler,
+                  criteria=criteria_of(args), processes=args.processes)
+
+
+def screen_command(args, backend=None):
+    from prisma_automator.collector import Collector
+    from prisma_automator.dedup import Deduplicator
+    from prisma_automator.exporters import get_exporter, read_chunks
+    from prisma_automator.screening import Pipeline, default_stages
+    from prisma_automator.seen import SeenIndex
+
+    dedup = Deduplicator(near_duplicates=args.near_duplicates)
+    pipeline = Pipeline(default_stages(dedup, fields_of(args), criteria_of(args)), args.processes)
+    seen = SeenIndex(args.seen) if args.seen else None
+    format = os.path.splitext(args.output)[1][1:]
+    with get_exporter(format, args.output) as exporter:
+        for chunk in Collector().screen_chunks(read_chunks(args.input), log=not args.quiet,
+                                               seen=seen, pipeline=pipeline):
+            exporter.write(chunk)
+    if args.duplicates:
+        dedup.report().to_csv(args.duplicates, index=False)
+    if args.report:
+        pipeline.report().to_csv(args.report, index=False)
+    if seen is not None:
+        seen.commit()
+        seen.close()
+    if not args.quiet:
+        print(f"[/] Screened results saved to: {args.output}")
+
+
+def export_command(args, backend=None):
+    from prisma_automator.exporters import export, read_chunks
+
+    format = args.format or os.path.splitext(args.output)[1][1:]
+    num_rows = export(read_chunks(args.input), args.output, format, index=not args.no_index)
+    if not args.quiet:
+        print(f"[/] {num_rows} rows exported to: {args.output}")
+
+
+def add_search_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("input", help="key-word group file (.json, .yaml) or file with one split per line")
+    parser.add_argument("-o", "--out", default="./out/", help="output directory (default: ./out/)")
+    parser.add_argument("--subscriber", action="store_true",
+                        help="the API key has subscriber access")
+    parser.add_argument("--threshold", type=int, default=1000,
+                        help="maximum number of results of a downloaded split (default: 1000)")
+    parser.add_argument("--refine", action="store_true",
+                        help="partition splits over the threshold instead of excluding them")
+    parser.add_argument("--batch", action="store_true",
+                        help="search small splits together in batched queries")
+    parser.add_argument("--fields", help="comma-separated fields to download, e.g. title,doi,coverDate")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent searches (default: 1)")
+    parser.add_argument("--rate", type=float, default=9, help="requests per second (default: 9)")
+    parser.add_argument("--quota", type=int, help="maximum number of requests")
+    parser.add_argument("--cache", metavar="PATH", help="SQLite query cache file")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the run with cProfile and tracemalloc")
+
+
+def add_screening_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="also remove nearly identical papers")
+    parser.add_argument("--years", metavar="FIRST-LAST",
+                        help="only keep papers published in this year range, e.g. 2015-2024 or 2015-")
+    parser.add_argument("--include-type", action="append", default=[], metavar="TYPE",
+                        help="only keep this document type, e.g. Article (repeatable)")
+    parser.add_argument("--exclude-type", action="append", default=[], metavar="TYPE",
+                        help="remove this document type, e.g. Review (repeatable)")
+    parser.add_argument("--language", action="append", default=[],
+                        help="only keep papers in this language, from a language column (repeatable)")
+    parser.add_argument("--exclude-keyword", action="append", default=[], metavar="KEYWORD",
+                        help="remove papers mentioning this key-word in their title, abstract or "
+                             "author key-words (repeatable)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes running the screening filters (default: 1)")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="prisma_automator", description="Search Scopus with split search strings and screen the results.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-q", "--quiet", action="store_true", help="don't print progress")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split = commands.add_parser("split", parents=[common], help="generate splits from key-word groups")
+    split.add_argument("keywords", help="key-word group file (.json, .yaml)")
+    split.add_argument("-o", "--output", default="./out/splits.txt",
+                       help="splits file (default: ./out/splits.txt)")
+    split.add_argument("--no-dedup", action="store_true",
+                       help="keep splits that are the same Scopus query")
+    split.set_defaults(func=split_command)
+
+    plan = commands.add_parser("plan", parents=[common], help="count the results of every split (plan.txt)")
+    add_search_arguments(plan)
+    plan.set_defaults(func=plan_command)
+
+    collect = commands.add_parser("collect", parents=[common], help="search, screen and export (see Collector.run)")
+    add_search_arguments(collect)
+    collect.add_argument("--dry-run", action="store_true", help="stop after the plan")
+    collect.add_argument("--resume", action="store_true", help="resume the run in the output directory")
+    collect.add_argument("--incremental", action="store_true",
+                         help="only screen records not screened by earlier runs")
+    collect.add_argument("--format", default="xlsx", choices=["xlsx", "csv", "parquet"],
+                         help="format of the final results (default: xlsx)")
+    collect.add_argument("--budget", type=int, help="maximum number of download requests")
+    collect.add_argument("--priority", default="plan", choices=["plan", "smallest", "weights", "yield"],
+                         help="order of the downloads (default: plan)")
+    collect.add_argument("--weight", action="append", default=[], metavar="KEYWORD=WEIGHT",
+                         help="weight of a key-word for --priority weights (repeatable)")
+    collect.add_argument("--index", metavar="PATH",
+                         help="earlier results (chunks directory or .csv, .parquet, .xlsx file) whose "
+                              "papers --priority yield doesn't count as new")
+    add_screening_arguments(collect)
+    collect.set_defaults(func=collect_command)
+
+    screen = commands.add_parser("screen", parents=[common], help="screen collected results")
+    screen.add_argument("input", help="chunks directory (e.g. ./out/chunks/) or .csv, .parquet, .xlsx file")
+    screen.add_argument("output", help="screened results (.xlsx, .csv or .parquet)")
+    screen.add_argument("--fields", help="comma-separated fields to keep")
+    screen.add_argument("--seen", metavar="PATH",
+                        help="SQLite index of records screened earlier; only new records are kept")
+    screen.add_argument("--duplicates", metavar="PATH", help="CSV report of the removed duplicates")
+    screen.add_argument("--report", metavar="PATH",
+                        help="CSV report of the rows removed by every screening stage")
+    add_screening_arguments(screen)
+    screen.set_defaults(func=screen_command)
+
+    export = commands.add_parser("export", parents=[common], help="convert results to another format")
+    export.add_argument("input", help="chunks directory or .csv, .parquet, .xlsx file")
+    export.add_argument("output", help="exported file")
+    export.add_argument("--format", choices=["xlsx", "csv", "parquet"],
+                        help="format (default: from the output's extension)")
+    export.add_argument("--no-index", action="store_true", help="don't write the index column")
+    export.set_defaults(func=export_command)
+    return parser
+
+
+def main(argv: list = None, backend=None) -> int:
+    """ Run the command line `argv` (defaults to `sys.argv[1:]`).
+
+    `backend`: backend of the collector (see `Collector`), e.g. a `FakeScopus`.
+    """
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args, backend)
+    except QuotaExhaustedError as error:
+        print(f"[#] Error: {error}", file=sys.stderr)
+        if "resume" in args:
+            print("[#] Run the same command with --resume once the quota is renewed: "
+                  "completed splits won't be searched again.", file=sys.stderr)
+        return 1
+    except (OSError, ValueError, ImportError) as error:
+        print(f"[#] Error: {error}", file=sys.stderr)
+        return 1
+    return 0
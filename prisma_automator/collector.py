@@ -1,110 +1,637 @@
-import pandas as pd
-from pybliometrics.scopus import ScopusSearch
-from pybliometrics.scopus.exception import ScopusQueryError
+from __future__ import annotations
 
-from prisma_automator.utility import save_to_file_advanced
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from prisma_automator.batching import batch_query, batch_splits, demultiplex, unbatch
+from prisma_automator.cache import QueryCache
+from prisma_automator.fields import project, view_for
+from prisma_automator.journal import RunJournal
+from prisma_automator.ratelimit import QuotaExhaustedError, TokenBucket
+from prisma_automator.refiner import build_query, refine
+from prisma_automator.scheduler import Scheduler
+from prisma_automator.telemetry import Telemetry
+from prisma_automator.utility import record_to_dict, save_to_file_advanced
+
+# pandas, pybliometrics and the modules using them are imported where they're needed,
+# so that commands that don't screen results (e.g. `cli` split and plan) start fast.
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from prisma_automator.accumulator import ResultAccumulator
+    from prisma_automator.dedup import Deduplicator
+    from prisma_automator.screening import Pipeline
+    from prisma_automator.seen import SeenIndex
+
+
+
+def scopus_search(query: str, *args, **kwds):
+    """ pybliometrics' `ScopusSearch`, imported on first use: importing pybliometrics
+    reads its configuration, which isn't needed until the first request.
+    """
+    from pybliometrics.scopus import ScopusSearch
+    return ScopusSearch(query, *args, **kwds)
+
+
+def from_file_cache(ss) -> bool:
+    """ Whether pybliometrics loaded the search object `ss` from its file cache, in
+    which case no request was sent and it has no response headers.
+    """
+    return hasattr(ss, "get_key_remaining_quota") and not hasattr(ss, "_header")
+
+
+def page_size(subscriber: bool, view: str = None) -> int:
+    """ Number of results per API page, as used by pybliometrics' ScopusSearch. """
+    view = view or view_for(None, subscriber)
+    return 200 if view == "STANDARD" and subscriber else 25
 
 
 class Collector:
-    def search(self, splits: list, subscriber: bool = False, threshold: int = 1000, log: bool = True) -> tuple[pd.DataFrame, list, list]:
+    def __init__(self, backend=scopus_search, workers: int = 1, bucket: TokenBucket = None,
+                 max_retries: int = 5, backoff: float = 1.0, cache: QueryCache = None,
+                 telemetry: Telemetry = None):
+        """ Searches Scopus and screens the results.
+
+        `backend`: callable with the signature of pybliometrics' `ScopusSearch`. Use
+        `prisma_automator.fake.FakeScopus` to run offline.
+        `workers`: number of splits searched concurrently.
+        `bucket`: token bucket shared by all workers, limiting requests per second and
+        the total quota. Defaults to Scopus' 9 requests/s with no quota.
+        `max_retries`: number of retries of a failed (5xx) request.
+        `backoff`: initial wait in seconds before a retry, doubled on every attempt.
+        `cache`: persistent `QueryCache` consulted before any request is sent.
+        `telemetry`: `Telemetry` receiving the metrics and events of the collector.
+        Defaults to metrics aggregated in memory only; `run()` also writes them to
+        `telemetry.jsonl` in its `save_to` directory.
+        """
+        self.backend = backend
+        self.workers = workers
+        self.bucket = bucket if bucket is not None else TokenBucket()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+
+    def query(self, split: str, subscriber: bool = False, download: bool = True, clauses: tuple = (), view: str = None, results: int = None):
+        """ Run a single `ScopusSearch` for `split`, respecting the token bucket.
+
+        `clauses`: extra clauses restricting the query, e.g. `("PUBYEAR > 2009",)`.
+        `view`: Scopus view ("STANDARD" or "COMPLETE"). Defaults to pybliometrics' default.
+        `results`: expected number of results of a download, e.g. from the plan.
+        pybliometrics fetches every page of a download at once, so the tokens of all its
+        pages are taken from the bucket before it starts: a download the quota can't
+        cover raises `QuotaExhaustedError` without sending any request. Without it, only
+        the first page is taken beforehand, and the others are charged afterwards.
+
+        Server-side failures are retried with exponential backoff and jitter. A 429
+        raises `QuotaExhaustedError`: pybliometrics only raises it once every API key of
+        its configuration is out of quota, so retrying can't succeed. Returns the search
+        object.
+
+        Searches answered by pybliometrics' file cache sent no request, so their token
+        is given back to the bucket.
+
+        Every query emits a "request" telemetry event with its latency (waits and
+        retries included), pages, bytes received and the remaining quota of the key.
+        """
+        from pybliometrics.scopus.exception import Scopus429Error, ScopusServerError
+
+        search = build_query(split, clauses)
+        telemetry = self.telemetry
+        tokens = 1
+        if download and results:
+            tokens = -(-results // page_size(subscriber, view))
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            waiting = time.perf_counter()
+            self.bucket.acquire(tokens)
+            telemetry.time("rate_limit_wait", time.perf_counter() - waiting)
+            try:
+                ss = self.backend(search, subscriber=subscriber,
+                                  download=download, view=view)
+            except Scopus429Error as error:
+                telemetry.count("requests")
+                telemetry.count("throttled")
+                raise QuotaExhaustedError(
+                    "Scopus refused the request (429): the quota of every API key is exhausted.") from error
+            except ScopusServerError:
+                # Counted as the one request that failed, as in the telemetry
+                self.bucket.refund(tokens - 1)
+                telemetry.count("requests")
+                telemetry.count("server_errors")
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff * 2**attempt * (1 + random.random()))
+                attempt += 1
+                telemetry.count("retries")
+                continue
+            if from_file_cache(ss):
+                self.bucket.refund(tokens)
+                telemetry.count("file_cache_hits")
+                pages = 0
+            else:
+                pages = 1
+                if download:
+                    # Every page after the first one was a request of its own, and the
+                    # number of results may have changed since it was counted
+                    pages = max(-(-ss.get_results_size() // page_size(subscriber, view)), 1)
+                    if pages > tokens:
+                        self.bucket.charge(pages - tokens)
+                    else:
+                        self.bucket.refund(tokens - pages)
+                telemetry.count("requests", pages)
+            self._record_request(ss, search, download, pages, attempt,
+                                 time.perf_counter() - start)
+            return ss
+
+    def _record_request(self, ss, search: str, download: bool, pages: int, retries: int, seconds: float):
+        telemetry = self.telemetry
+        telemetry.time("download_request" if download else "count_request", seconds)
+        telemetry.count("pages", pages)
+        # pybliometrics saves the downloaded pages, which are the bytes received
+        path = getattr(ss, "_cache_file_path", None)
+        size = os.path.getsize(path) if download and pages and path and os.path.exists(path) else 0
+        telemetry.count("bytes", size)
+        quota = ss.get_key_remaining_quota() if hasattr(
+            ss, "get_key_remaining_quota") else None
+        if quota is not None:  # None when pybliometrics answered from its own cache
+            telemetry.gauge("quota_remaining", int(quota))
+        telemetry.event("request", query=search, download=download, results=ss.get_results_size(),
+                        pages=pages, bytes=size, retries=retries, seconds=round(seconds, 6),
+                        quota_remaining=quota)
+
+    def _count_one(self, split: str, subscriber: bool, journal: RunJournal = None, clauses: tuple = ()):
+        from pybliometrics.scopus.exception import ScopusQueryError
+
+        # Restricted sub-queries are cached and journaled under their full query
+        key = build_query(split, clauses) if clauses else split
+        if journal is not None and key in journal.counts:
+            self.telemetry.count("journal_hits")
+            return journal.counts[key]
+        view = view_for(None, subscriber)
+        if self.cache is not None:
+            cached = self.cache.get_count(key, subscriber, view)
+            self.telemetry.count("cache_hits" if cached is not None else "cache_misses")
+            if cached is not None:
+                return cached[0]
+        try:
+            num_results = self.query(
+                split, subscriber=subscriber, download=False, clauses=clauses).get_results_size()
+        except ScopusQueryError:
+            self.telemetry.count("query_errors")
+            num_results = None
+        if self.cache is not None:
+            self.cache.put(key, subscriber, view, num_results)
+        if journal is not None:
+            journal.record_count(key, num_results)
+        return num_results
+
+    def _fetch(self, split: str, subscriber: bool, clauses: tuple = (), fields: list = None, results: int = None) -> list:
+        key = build_query(split, clauses) if clauses else split
+        view = view_for(fields, subscriber)
+        if self.cache is not None:
+            records = self.cache.get_records(key, subscriber, view, fields)
+            self.telemetry.count("cache_hits" if records is not None else "cache_misses")
+            if records is not None:
+                return records
+        ss = self.query(split, subscriber=subscriber,
+                        download=True, clauses=clauses, view=view, results=results)
+        # Unused fields are dropped before they reach the cache, journal and results
+        records = project(ss.results or [], fields)
+        if self.cache is not None:
+            self.cache.put(key, subscriber, view,
+                           ss.get_results_size(), records, fields)
+        return records
+
+    def _download_one(self, split: str, subscriber: bool, journal: RunJournal = None, parts: list = None, fields: list = None, num_results: int = None):
+        if journal is not None and split in journal.completed:
+            self.telemetry.count("journal_hits")
+            return journal.get_results(split)
+        with self.telemetry.span("split", split=split) as event:
+            if not parts:
+                records = self._fetch(split, subscriber, fields=fields, results=num_results)
+            else:
+                # Merge the sub-queries of a refined split, which may overlap
+                records = []
+                seen = set()
+                for n, clauses in parts:
+                    for record in self._fetch(split, subscriber, clauses, fields, n):
+                        eid = record_to_dict(record)["eid"]
+                        if eid not in seen:
+                            seen.add(eid)
+                            records.append(record)
+            event.update(queries=len(parts or ()) or 1, records=len(records))
+        if journal is not None:
+            journal.record_results(split, records)
+        return records
+
+    def _refine_one(self, split: str, subscriber: bool, threshold: int, journal: RunJournal = None) -> list:
+        # The plan already counted the whole split, which is over the threshold
+        return refine(lambda clauses: self._count_one(split, subscriber, journal, clauses),
+                      threshold, over_threshold=True)
+
+    def _bisect_batch(self, splits: list, subscriber: bool, threshold: int, journal: RunJournal = None) -> list:
+        """ Probe the batched query of `splits`, halving it until every batch fits in `threshold`.
+
+        Returns a list of `(split, num_results)` tuples, where `split` is a batched query
+        or a single split, and `num_results` is False for single splits (not probed yet).
+        """
+        if len(splits) == 1:
+            return [(splits[0], False)]
+        query = batch_query(splits)
+        num_results = self._count_one(query, subscriber, journal)
+        if num_results is not None and num_results <= threshold:
+            return [(query, num_results)]
+        half = len(splits) // 2
+        return self._bisect_batch(splits[:half], subscriber, threshold, journal) + \
+            self._bisect_batch(splits[half:], subscriber, threshold, journal)
+
+    def _map(self, func, items):
+        """ Apply `func` to every item, concurrently if `self.workers` > 1, and yield
+        `(item, result)` tuples in the order of `items`.
+
+        `items` may be any iterable, e.g. a generator from `Splitter.iter_splits()`.
+        Only a few items per worker are in flight at a time, so memory doesn't grow
+        with the number of items.
+        """
+        if self.workers <= 1:
+            for item in items:
+                yield item, func(item)
+            return
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= 2 * self.workers:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+
+    def plan(self, splits: list, subscriber: bool = False, threshold: int = 1000, log: bool = True, journal: RunJournal = None, refine: bool = False, batch: bool = False, fields: list = None) -> list:
+        """ Count-only pre-pass of the search. Fetch the number of results of every split without downloading them.
+
+        `splits`: list (or any iterable) of split search strings.
+        `threshold`: splits with more results than this value are planned as excluded.
+        `journal`: `RunJournal` in which counts are recorded. Splits already counted in
+        it aren't sent to Scopus again.
+        `refine`: if True, splits over `threshold` (or over Scopus' 5000 cap) are
+        partitioned into sub-queries by `PUBYEAR` and subject area instead of being
+        excluded, using count-only requests.
+        `batch`: if True, consecutive splits are combined into `(split1) OR (split2) ...`
+        queries of up to `batching.MAX_QUERY_LENGTH` characters. Batches over `threshold`
+        are halved until they fit, and single splits that still don't fit are planned
+        as usual. The plan then contains batched queries instead of their splits.
+        `fields`: fields that will be downloaded (see `search()`), which determine the
+        view and so the number of results per page.
+
+        Returns a list of `(num_results, pages, split, parts)` tuples in the order of
+        `splits`, where `num_results` is `">5000"` if Scopus refused to count the split,
+        `pages` is the number of API requests needed to download it (0 if the split
+        won't be downloaded) and `parts` is the list of `(num_results, clauses)`
+        sub-queries of a refined split (empty otherwise).
+        """
+        plan = []
+        size = page_size(subscriber, view_for(fields, subscriber))
+        known = dict()  # Counts already probed while batching
+        if batch:
+            units = list()
+            bisected = self._map(lambda b: self._bisect_batch(b, subscriber, threshold, journal),
+                                 batch_splits(splits))
+            for _, result in bisected:
+                for unit, num_results in result:
+                    units.append(unit)
+                    if num_results is not False:
+                        known[unit] = num_results
+            splits = units
+        counts = self._map(lambda s: known[s] if s in known else self._count_one(s, subscriber, journal),
+                           splits)
+        to_refine = []
+        for i, (s, num_results) in enumerate(counts):
+            if log:
+                print(f"[#] Counting results: {i}", end="\r")
+            if num_results is None:
+                plan.append((">5000", 0, s, []))
+            elif num_results > threshold or not num_results:
+                plan.append((num_results, 0, s, []))
+            else:
+                pages = -(-num_results // size)
+                plan.append((num_results, pages, s, []))
+            if refine and (num_results is None or num_results > threshold):
+                to_refine.append(i)
+        if log:
+            print(f"[$] Counting results: {len(plan)}/{len(plan)} (done)")
+
+        refinements = self._map(
+            lambda i: self._refine_one(plan[i][2], subscriber, threshold, journal), to_refine)
+        for j, (i, parts) in enumerate(refinements):
+            if log:
+                print(f"[#] Refining splits: {j}/{len(to_refine)}", end="\r")
+            num_results, _, s, _ = plan[i]
+            pages = sum(-(-n // size)
+                        for n, _ in parts if n is not None and n <= threshold)
+            plan[i] = (num_results, pages, s, parts)
+        if log and to_refine:
+            print(
+                f"[$] Refining splits: {len(to_refine)}/{len(to_refine)} (done)")
+        return plan
+
+    def save_plan(self, plan: list, file_path: str, log: bool = True):
+        """ Write a plan report with the estimated quota cost of downloading `plan`.
+
+        `plan`: list returned by `plan()`.
+        `file_path`: path to the report file.
+        """
+        num_splits = len(plan)
+        downloads = sum(1 for _, pages, _, _ in plan if pages)
+        refined = sum(1 for _, _, _, parts in plan if parts)
+        pages = sum(pages for _, pages, _, _ in plan)
+        header = (f"# splits: {num_splits}, to download: {downloads}, refined: {refined}, excluded or empty: {num_splits - downloads}\n"
+                  f"# download requests (estimated quota cost): {pages}\n"
+                  "num_results,pages,split")
+        save_to_file_advanced(file_path=file_path, header=header,
+                              lines_to_write=[entry[:3] for entry in plan], separator=',')
+        if log:
+            print(
+                f"[#] Plan: {downloads}/{num_splits} splits to download, estimated cost of {pages} requests.")
+            print(f"[/] Plan saved to: {file_path}")
+
+    def search(self, splits: list, subscriber: bool = False, threshold: int = 1000, log: bool = True, plan: list = None, journal: RunJournal = None, refine: bool = False, batch: bool = False, accumulator: ResultAccumulator = None, fields: list = None) -> tuple[pd.DataFrame, list, list]:
         """ Identification phase of the PRISMA statement. Search through Scopus using `splits` and return results.
 
-        `splits`: list of split search strings.
+        `splits`: list (or any iterable) of split search strings.
         `subscriber`: if you have an Elsevier API Key with subscriber access, set
         this to True to get access to abstract, author keywords, etc.
-        `download`: if results data should be downloaded. If False, only number of
-        results will be available.
         `threshold`: if number of search results goes over this value, they're 
         added to the excluded results group and ignored for the dataframe.
+        `plan`: result of `plan()` for the same splits. If None, it's computed first,
+        so that splits over `threshold` are never downloaded.
+        `journal`: `RunJournal` in which downloaded records are recorded as soon as
+        each split completes. Splits already completed in it aren't downloaded again.
+        `refine`: if True, splits over `threshold` are partitioned into sub-queries
+        whose results are merged back under the original split (see `plan()`). Only
+        sub-queries that can't be brought under `threshold` are excluded.
+        `batch`: if True, small splits are searched together in batched queries (see
+        `plan()`), and the results are attributed back to their splits locally by
+        matching the split's key-words against the title, abstract and author
+        keywords. Works best with `subscriber=True`, since abstracts and author
+        keywords aren't available otherwise.
+        `accumulator`: `ResultAccumulator` or `RecordStore` into which the records of
+        every split are streamed. If given, it's returned instead of a dataframe, so
+        results don't need to fit in memory.
+        `fields`: the fields (see `fields.FIELDS`) to download. Only these and the
+        fields needed to identify and screen papers (`fields.REQUIRED_FIELDS`) are
+        kept, and the smallest view returning them is requested: the STANDARD view,
+        unless fields of the COMPLETE view (e.g. "description") are needed. With
+        `subscriber=True`, the STANDARD view returns 200 results per request instead
+        of 25. If None, all fields of the default view are downloaded.
+
+        Splits are searched by `self.workers` concurrent workers, but results are
+        always returned in the order of `splits`. The returned dataframe has every
+        paper found once, with the first split that found it in the "splits" column.
         """
+        from prisma_automator.store import RecordStore
+
+        results = accumulator if accumulator is not None else RecordStore()
+        if plan is None:
+            plan = self.plan(splits, subscriber=subscriber, threshold=threshold,
+                             log=log, journal=journal, refine=refine, batch=batch, fields=fields)
         search_results = []
         excluded_results = []
-        num_splits = len(splits)
+        to_download = []
+        for num_results, pages, s, parts in plan:
+            for n, clauses in parts:
+                if n is None or n > threshold:
+                    excluded_results.append(
+                        (">5000" if n is None else n, build_query(s, clauses)))
+            if pages:
+                downloadable = [(n, clauses) for n, clauses in parts
+                                if n is not None and n <= threshold]
+                to_download.append((num_results, s, downloadable))
+            elif num_results and not parts:  # Avoid zero-result search strings
+                excluded_results.append((num_results, s))
+        num_splits = len(to_download)
         i = 0
-        for s in splits:
+        downloads = self._map(
+            lambda item: self._download_one(item[1], subscriber, journal, item[2], fields, item[0]), to_download)
+        for (num_results, s, parts), records in downloads:
             if log:
                 print(f"[#] Current Progress: {i}/{num_splits}", end="\r")
-            search = "TITLE-ABS-KEY(" + s + ")"
-            try:
-                ss = ScopusSearch(
-                    search, subscriber=subscriber, download=True)
-                num_results = ss.get_results_size()  # Number of search results
-                if num_results > threshold:
-                    excluded_results.append((num_results, s))
-                elif num_results:  # Avoid zero-result search strings
-                    search_results.append((num_results, s))
-                    results_df = pd.DataFrame(ss.results)
-                    results_df.insert(0, 'splits', s)   # Add "splits" to df
-            except ScopusQueryError:
-                excluded_results.append((">5000", s))
+            if parts:
+                num_results = len(records)
+            members = unbatch(s)
+            if members:
+                groups, unmatched = demultiplex(records, members)
+                if log and unmatched:
+                    print(
+                        f"[#] {unmatched} results of a batch matched no split locally, attributed to all of them.")
+            else:
+                groups = {s: records}
+            for s, records in groups.items():
+                if not records:  # Avoid zero-result splits of a batch
+                    continue
+                search_results.append(
+                    (len(records) if members else num_results, s))
+                results.append(s, records)  # "splits" column is added first
             i += 1
         if log:
             print(f"[$] Current Progress: {i}/{num_splits} (done)")
-        return results_df, search_results, excluded_results
+            if self.cache is not None:
+                stats = self.cache.stats()
+                print(
+                    f"[#] Cache: {stats['hits']} hits, {stats['misses']} misses.")
+        if accumulator is None:
+            results = results.to_frame()
+        return results, search_results, excluded_results
 
-    def screen(self, df: pd.DataFrame, log: bool = True) -> pd.DataFrame:
-        """ Screening phase of the PRISMA statement. Drop unnecessary columns and remove duplicates.
+    def screen_chunks(self, chunks, log: bool = True, dedup: Deduplicator = None, seen: SeenIndex = None, fields: list = None, pipeline: Pipeline = None):
+        """ Screen an iterable of DataFrame chunks, yielding the screened chunks.
 
-        `df`: a pandas dataframe containing the search results from Scopus.
-        `log`: if True, prints information to the cmd prompt.
+        Only one chunk is processed at a time (a few with a process pool), so memory is
+        bounded by the chunk size (plus a few hashes per kept row for duplicate detection).
+
+        `dedup`: the `Deduplicator` removing duplicates. Defaults to exact DOI and
+        normalized title and description matching.
+        `seen`: a `SeenIndex` of the records screened in earlier runs. If given, those
+        records are skipped, and the decisions on the new ones are added to it.
+        `fields`: if given, only the "splits" column and these fields are kept (see
+        `search()`), instead of dropping `screening.COLUMNS_TO_DROP`.
+        `pipeline`: the screening `Pipeline`, e.g. with extra criteria. Defaults to
+        `screening.default_stages(dedup, fields)`; `dedup` and `fields` are ignored
+        when a pipeline is given. Read its `report()` for the counts of every stage.
         """
-        shape = df.shape
-        new_shape = (0, 0)
-        if log:
-            print(
-                f"[#] Initial dataframe with {shape[0]} rows and {shape[1]} columns. Screening...")
+        from prisma_automator.screening import Pipeline, default_stages
 
-        # Drop unnecessary columns
-        columns_to_drop = ["eid", "pii", "pubmed_id", "subtype", "afid", "affilname", "affiliation_city", "affiliation_country",
-                                  "author_count", "author_ids", "author_afids", "coverDisplayDate", "issn", "source_id",
-                                  "eIssn", "publicationName", "aggregationType", "article_number", "fund_acr", "fund_no", "fund_sponsor"]
-        new_df = df.drop(columns=columns_to_drop)
+        if pipeline is None:
+            pipeline = Pipeline(default_stages(dedup, fields))
+        counts = {"rows": 0, "columns": 0, "skipped": 0}
 
-        if log:
-            print(f"[#] Dropped {len(columns_to_drop)} columns.")
+        def unseen_chunks():
+            for chunk in chunks:
+                counts["rows"] += chunk.shape[0]
+                counts["columns"] = chunk.shape[1]
+                if seen is not None:
+                    with self.telemetry.span("seen_lookup"):
+                        unseen = seen.unseen(chunk)
+                    counts["skipped"] += int((~unseen).sum())
+                    chunk = chunk[unseen]
+                yield chunk
 
-        # Remove duplicates based on the title and description columns
-        new_df = new_df.drop_duplicates(subset=['title', 'description'])
+        report = pipeline.report()
+        new_columns = 0
+        new_rows = 0
+        screened_chunks = pipeline.run(unseen_chunks())
+        while True:
+            with self.telemetry.span("screen"):
+                try:
+                    chunk, new_chunk, decisions = next(screened_chunks)
+                except StopIteration:
+                    break
+                if seen is not None:
+                    seen.add(chunk, decisions)
+            new_rows += new_chunk.shape[0]
+            new_columns = new_chunk.shape[1]
+            yield new_chunk
 
+        # Counts of this call only, as the pipeline's add up over its runs
+        numbers = ["rows_in", "removed", "rows_out", "seconds"]
+        report[numbers] = pipeline.report()[numbers] - report[numbers]
+        self.telemetry.event("screening", stages=report.astype(object).where(report.notna(), None).to_dict("records"))
         if log:
-            new_shape = new_df.shape
-            num_duplicates = shape[0] - new_shape[0]
-            print(f"[#] Removed {num_duplicates} duplicates.")
-            shape = new_df.shape
-
-        # Remove conference reviews
-        new_df = new_df[new_df.subtypeDescription != "Conference Review"]
+            print(
+                f"[#] Initial dataframe with {counts['rows']} rows and {counts['columns']} columns. Screened.")
+            if seen is not None:
+                print(f"[#] Skipped {counts['skipped']} rows screened in earlier runs.")
+            print(f"[#] Dropped {counts['columns'] - new_columns} columns.")
+            for stage in report[report.decision.notna()].itertuples():
+                print(f"[#] Removed {stage.removed} rows: {stage.decision} ({stage.seconds:.2f}s).")
+            print(
+                f"[#] New dataframe with {new_rows} rows and {new_columns} columns.")
 
-        if log:
-            new_shape = new_df.shape
-            num_reviews = shape[0] - new_shape[0]
-            print(f"[#] Removed {num_reviews} conference reviews.")
-            shape = new_df.shape
+    def screen(self, df, log: bool = True, dedup: Deduplicator = None, seen: SeenIndex = None, fields: list = None, pipeline: Pipeline = None) -> pd.DataFrame:
+        """ Screening phase of the PRISMA statement. Drop unnecessary columns and remove duplicates.
 
-        # Remove rows without doi
-        new_df = new_df[new_df['doi'].astype(bool)]
+        `df`: a pandas dataframe containing the search results from Scopus, or a
+        `ResultAccumulator` or `RecordStore`, which is screened chunk by chunk.
+        `log`: if True, prints information to the cmd prompt.
+        `dedup`: the `Deduplicator` removing duplicates; pass one to enable near-duplicate
+        detection or to read its `report()` afterwards.
+        `seen`: a `SeenIndex`; if given, only records not screened in earlier runs are
+        screened and returned (see `screen_chunks()`).
+        `fields`: if given, only the "splits" column and these fields are kept.
+        `pipeline`: a screening `Pipeline` replacing the default stages (see
+        `screen_chunks()`).
+        """
+        import pandas as pd
 
-        if log:
-            new_shape = new_df.shape
-            num_empty_doi = shape[0] - new_shape[0]
-            print(f"[#] Removed {num_empty_doi} rows without a doi.")
+        chunks = df.iter_chunks() if hasattr(df, "iter_chunks") else [df]
+        screened = list(self.screen_chunks(
+            chunks, log=log, dedup=dedup, seen=seen, fields=fields, pipeline=pipeline))
+        if not screened:
+            return pd.DataFrame(columns=['splits'])
+        return pd.concat(screened) if len(screened) > 1 else screened[0]
 
+    def _schedule(self, plan: list, scheduler: Scheduler, journal: RunJournal = None, save_to: str = None, log: bool = True) -> list:
+        """ Apply `scheduler` to `plan`, within the remaining quota of the token bucket. """
+        budget = scheduler.budget
+        if self.bucket.remaining is not None:
+            budget = self.bucket.remaining if budget is None else min(
+                budget, self.bucket.remaining)
+        scheduled, deferred = scheduler.schedule(
+            plan, journal.completed if journal is not None else (), budget)
+        deferred_pages = sum(pages for _, pages, _, _ in deferred)
+        self.telemetry.event("schedule", budget=budget, priority=scheduler.priority,
+                             scheduled_pages=scheduler.spent, deferred=len(deferred),
+                             deferred_pages=deferred_pages)
         if log:
-            new_shape = new_df.shape
-            print(
-                f"[#] New dataframe with {new_shape[0]} rows and {new_shape[1]} columns.")
-        return new_df
+            print(f"[#] Schedule: {scheduler.spent} requests scheduled ({scheduler.priority} first), "
+                  f"{len(deferred)} splits deferred ({deferred_pages} requests).")
+        if save_to:
+            self.save_plan(deferred, save_to + "deferred_plan.txt", log=log)
+        return scheduled
 
-    def run(self, splits: list, save_to: str = "./out/", subscriber: bool = False, threshold: int = 1000, log: bool = True):
+    def run(self, splits: list, save_to: str = "./out/", subscriber: bool = False, threshold: int = 1000, log: bool = True, dry_run: bool = False, resume: bool = False, refine: bool = False, batch: bool = False, near_duplicates: bool = False, incremental: bool = False, format: str = "xlsx", fields: list = None, scheduler: Scheduler = None, criteria: list = None, processes: int = 1):
         """ Execute methods associated with Identification and Screening phases of the PRISMA statement
 
         `splits`: list of split search strings.
         `save_to`: path to directory in which result files will be saved.
+        `dry_run`: if True, stop after the count-only pre-pass and its plan report.
+        `resume`: if True, continue the run recorded in `save_to`'s `journal.jsonl`,
+        skipping the splits that were already counted or downloaded.
+        `refine`: if True, partition splits over `threshold` into smaller sub-queries
+        instead of excluding them (see `plan()`).
+        `batch`: if True, search small splits together in batched queries (see `search()`).
+        `near_duplicates`: if True, also remove papers whose title and abstract are nearly
+        identical (see `dedup.Deduplicator`).
+        `incremental`: if True, only screen and export the records not screened by earlier
+        incremental runs in `save_to` (see `seen.SeenIndex`). The new records are saved to
+        a numbered `delta_results_<run>` file and appended to `cumulative_results.csv`.
+        `format`: format of the final results: "xlsx", "csv" or "parquet" (see
+        `exporters`).
+        `fields`: the fields of the final results. Only the fields needed are
+        downloaded, with the smallest Scopus view returning them (see `search()`).
+        `scheduler`: `Scheduler` ordering the downloads by priority and stopping at its
+        budget, which is capped by the remaining quota of `self.bucket`. The splits that
+        don't fit are saved to `save_to`'s `deferred_plan.txt`; run again with
+        `resume=True` (and a new budget) to download them.
+        `criteria`: extra screening stages (see `screening`), applied after the default
+        ones, e.g. `[YearRange(2015, 2024), KeywordExclusion(["survey"])]`. The rows
+        removed by every stage are counted in `save_to`'s `screening.csv`.
+        `processes`: size of the process pool running the row-local screening stages
+        (see `screening.Pipeline`).
+
+        Telemetry events are written to `save_to`'s `telemetry.jsonl` (unless
+        `self.telemetry` already has a path), and a summary is printed at the end.
         """
+        from prisma_automator.accumulator import ResultAccumulator
+        from prisma_automator.dedup import Deduplicator
+        from prisma_automator.exporters import CsvExporter, get_exporter
+        from prisma_automator.screening import Pipeline, default_stages
+        from prisma_automator.seen import SeenIndex
+        from prisma_automator.store import RecordStore
+
+        if incremental and not save_to:
+            raise ValueError("Incremental runs need a save_to directory.")
+        telemetry = self.telemetry
+        if save_to and telemetry.path is None:
+            telemetry.open(save_to + "telemetry.jsonl")
+        telemetry.start()
+        journal = None
+        if save_to:
+            journal = RunJournal(save_to + "journal.jsonl", resume=resume)
+            if resume:
+                print(
+                    f"[#] Resuming: {len(journal.completed)} splits already downloaded.")
 
-        print("[#] Identification: searching Scopus...")
-        df, search_results, excluded_results = self.search(
-            splits, subscriber=subscriber, threshold=threshold, log=log)
+        try:
+            print("[#] Planning: counting search results...")
+            with telemetry.span("plan"):
+                plan = self.plan(splits, subscriber=subscriber, threshold=threshold,
+                                 log=log, journal=journal, refine=refine, batch=batch, fields=fields)
+            if save_to:
+                self.save_plan(plan, save_to + "plan.txt", log=log)
+            if dry_run:
+                telemetry.report(log)
+                return
+            if scheduler is not None:
+                plan = self._schedule(plan, scheduler, journal, save_to, log)
+
+            print("[#] Identification: searching Scopus...")
+            store = RecordStore(ResultAccumulator(
+                save_to + "chunks/" if save_to else None))
+            with telemetry.span("search"):
+                df, search_results, excluded_results = self.search(
+                    splits, subscriber=subscriber, threshold=threshold, log=log, plan=plan, journal=journal,
+                    accumulator=store, fields=fields)
+        finally:
+            if journal is not None:
+                journal.close()
 
         if save_to:
             path_search_results = save_to + "search_results.txt"
@@ -118,14 +645,53 @@ class Collector:
                                   lines_to_write=excluded_results,
                                   separator=',')
 
+            path_split_yield = save_to + "split_yield.txt"
+            save_to_file_advanced(file_path=path_split_yield,
+                                  header="num_papers,unique_papers,split",
+                                  lines_to_write=store.yield_stats(),
+                                  separator=',')
+
             print(f"[/] Search results saved to: {path_search_results}")
             print(f"[/] Excluded results saved to: {path_excluded_results}")
+            print(f"[/] Yield per split saved to: {path_split_yield}")
 
         print("[#] Screening: cleaning dataframe...")
 
-        new_df = self.screen(df, log=log)
+        dedup = Deduplicator(near_duplicates=near_duplicates)
+        pipeline = Pipeline(default_stages(dedup, fields, criteria or ()), processes)
+        seen = SeenIndex(save_to + "seen.sqlite") if incremental else None
+        exporters = []
+        if incremental:
+            path_final_results = save_to + f"delta_results_{seen.run:03d}.{format}"
+            path_cumulative = save_to + "cumulative_results.csv"
+            exporters = [get_exporter(format, path_final_results),
+                         CsvExporter(path_cumulative, index=False, append=True)]
+        elif save_to:
+            path_final_results = save_to + f"final_results.{format}"
+            exporters = [get_exporter(format, path_final_results)]
+
+        # Screened chunks are exported as they come, so the results are never held in
+        # memory all at once
+        try:
+            for chunk in self.screen_chunks(df.iter_chunks(), log=log, seen=seen, pipeline=pipeline):
+                with telemetry.span("export"):
+                    for exporter in exporters:
+                        exporter.write(chunk)
+        finally:
+            with telemetry.span("export"):
+                for exporter in exporters:
+                    exporter.close()
 
         if save_to:
-            path_final_results = save_to + "final_results.xlsx"
-            new_df.to_excel(path_final_results)
+            path_duplicates = save_to + "duplicates.csv"
+            dedup.report().to_csv(path_duplicates, index=False)
+            print(f"[/] Removed duplicates saved to: {path_duplicates}")
+            path_screening = save_to + "screening.csv"
+            pipeline.report().to_csv(path_screening, index=False)
+            print(f"[/] Screening counts saved to: {path_screening}")
             print(f"[/] Final results saved to: {path_final_results}")
+        if seen is not None:
+            seen.commit()  # Only once the new records are safely exported
+            seen.close()
+            print(f"[/] Cumulative results saved to: {path_cumulative}")
+        telemetry.report(log)
@@ -0,0 +1,276 @@
+import string
+from itertools import repeat
+import numpy as np
+import pandas as pd
+
+DOI_PREFIX = r"^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)"
+# Punctuation is replaced by spaces, as Scopus does when matching phrases.
+PUNCTUATION = str.maketrans(string.punctuation, " " * len(string.punctuation))
+MAX_HASH = np.iinfo(np.uint64).max
+FNV_PRIME = 0x100000001B3
+FNV_PRIME_INVERSE = pow(FNV_PRIME, -1, 2**64)  # Modulo 2**64, where numpy wraps
+
+
+def normalize_column(column: pd.Series) -> pd.Series:
+    """ Normalize a text column: lowercase, with punctuation and repeated whitespace
+    replaced by a single space.
+    """
+    return pd.Series([" ".join(text.lower().translate(PUNCTUATION).split())
+                      for text in column.fillna("").astype(str).tolist()], index=column.index, dtype=object)
+
+
+def normalize_doi(column: pd.Series) -> pd.Series:
+    return (column.fillna("").astype(str).str.strip().str.lower()
+            .str.replace(DOI_PREFIX, "", regex=True))
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """ Scramble 64-bit integers (the splitmix64 finalizer). """
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+class Deduplicator:
+    def __init__(self, near_duplicates: bool = False, similarity: float = 0.8, num_perm: int = 64,
+                 bands: int = 16, shingle_size: int = 2, batch_size: int = 2000):
+        """ Finds duplicate papers in chunks of search results, remembering the kept papers
+        across chunks.
+
+        Duplicates are detected in up to three passes:
+        1. exact DOI (case and `https://doi.org/` prefix ignored);
+        2. exact normalized title and abstract (case, punctuation and whitespace ignored);
+        3. if `near_duplicates` is True, titles and abstracts whose estimated Jaccard
+        similarity of word `shingle_size`-grams is at least `similarity`. Candidates are
+        found with MinHash signatures of `num_perm` hashes split into `bands` LSH bands,
+        so papers aren't compared pairwise. Signatures are computed `batch_size` rows at
+        a time, which bounds the memory used, whatever the size of the chunks.
+
+        The first occurrence of a paper is kept. `report()` returns every merged row.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands.")
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.batch_size = batch_size
+        self._seen_doi = {}  # DOI hash -> kept index label
+        self._seen_text = {}  # Title and abstract hash -> kept index label
+        self._buckets = {}  # Band hash -> position of a kept paper in the arrays below
+        self._kept_signatures = np.empty((0, num_perm), dtype=np.uint64)  # Grown by doubling
+        self._kept_index = []  # Index of every kept paper with a signature
+        self._merges = []  # (dropped index, kept index, reason, dropped title)
+        self._power_cache = (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64))
+
+    def _exact_pass(self, keys: pd.Series, valid: pd.Series, seen: dict, reason: str, labels: np.ndarray) -> np.ndarray:
+        """ Mark rows whose key was seen before (in this or an earlier chunk) as duplicates.
+
+        `keys` is indexed by position in the chunk, whose index `labels` are only used to
+        report the kept rows, so they needn't be unique.
+        """
+        keys = keys[valid]
+        positions = keys.index.values
+        first = pd.Series(positions, index=keys.index).groupby(keys).transform('first').values
+        earlier = keys.map(seen.get)
+        in_earlier_chunk = earlier.notna().values
+        duplicated = in_earlier_chunk | (first != positions)
+        kept = np.where(in_earlier_chunk, earlier.values, labels[first].astype(object))
+        self._merges.extend((dropped, keep, reason) for dropped, keep in zip(
+            positions[duplicated], kept[duplicated]))
+        seen.update(zip(keys.values[~duplicated], labels[positions[~duplicated]]))
+        mask = np.zeros(len(valid), dtype=bool)
+        mask[np.flatnonzero(valid.values)[duplicated]] = True
+        return mask
+
+    def _powers(self, size: int) -> tuple:
+        """ The first `size` powers of `FNV_PRIME` and of its inverse, cached across chunks. """
+        if len(self._power_cache[0]) < size:
+            capacity = max(size, 2 * len(self._power_cache[0]))
+            self._power_cache = (
+                np.cumprod(np.full(capacity, FNV_PRIME, dtype=np.uint64)),
+                np.cumprod(np.full(capacity, FNV_PRIME_INVERSE, dtype=np.uint64)))
+        return self._power_cache[0][:size], self._power_cache[1][:size]
+
+    def _signatures_of(self, texts: list) -> np.ndarray:
+        """ MinHash signatures (one row per text) of the word shingles of `texts`, which
+        must be normalized with `normalize_column()` and non-empty.
+
+        Uses one-permutation hashing: every shingle is hashed once, and its hash lands in
+        one of `num_perm` bins, each bin keeping its minimum. Empty bins hold `MAX_HASH`.
+        """
+        # Words are hashed straight from the UTF-8 bytes with polynomial prefix hashes,
+        # so no string is created per word.
+        data = np.frombuffer((" ".join(texts) + " ").encode("utf8"), dtype=np.uint8)
+        ends = np.flatnonzero(data == ord(" "))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        powers, inverses = self._powers(len(data))
+        prefix = np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(data * powers)))
+        words = _mix((prefix[ends] - prefix[starts]) * inverses[starts]
+                     + (ends - starts).astype(np.uint64))
+
+        lengths = np.fromiter((t.count(" ") + 1 for t in texts), dtype=np.int64, count=len(texts))
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        position = np.arange(len(words)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        left = lengths[rows] - position  # Words left in the text, this one included
+        shingles = words
+        for j in range(1, self.shingle_size):
+            following = np.concatenate((words[j:], np.zeros(j, dtype=np.uint64)))
+            shingles = np.where(left > j, _mix(shingles * np.uint64(31) + following), shingles)
+        # Texts shorter than a shingle become a single shorter shingle
+        real = (left >= self.shingle_size) | ((position == 0) & (lengths[rows] < self.shingle_size))
+        shingles, rows = shingles[real], rows[real]
+
+        signatures = np.full(len(texts) * self.num_perm, MAX_HASH, dtype=np.uint64)
+        bins = rows * self.num_perm + (shingles % np.uint64(self.num_perm)).astype(np.int64)
+        np.minimum.at(signatures, bins, shingles // np.uint64(self.num_perm))
+        return signatures.reshape(len(texts), self.num_perm)
+
+    def _band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """ One hash per (row, LSH band) of `signatures`. """
+        rows = self.num_perm // self.bands
+        bands = signatures.reshape(len(signatures), self.bands, rows)
+        keys = np.broadcast_to(np.arange(self.bands, dtype=np.uint64), bands.shape[:2])
+        for column in range(rows):
+            keys = _mix(keys * np.uint64(31) + bands[:, :, column])
+        return keys
+
+    def _agreement(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """ Estimated Jaccard similarity of every pair of signatures (rows) of `a` and
+        `b`: the share of agreeing bins, ignoring bins empty in both.
+        """
+        used = (a != MAX_HASH) | (b != MAX_HASH)
+        return ((a == b) & used).sum(axis=1) / np.maximum(1, used.sum(axis=1))
+
+    def _near_pass(self, texts: pd.Series, labels: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(texts), dtype=bool)
+        valid = np.flatnonzero((texts != "").values)
+        for start in range(0, len(valid), self.batch_size):
+            rows = valid[start:start + self.batch_size]
+            mask[rows] = self._near_batch(texts.index.values[rows], texts.values[rows], labels)
+        return mask
+
+    def _keep_signatures(self, index: np.ndarray, signatures: np.ndarray) -> np.ndarray:
+        """ Store the signatures of kept papers. Returns their positions. """
+        start = len(self._kept_index)
+        end = start + len(signatures)
+        if end > len(self._kept_signatures):
+            grown = np.empty((max(end, 2 * len(self._kept_signatures)), self.num_perm), dtype=np.uint64)
+            grown[:start] = self._kept_signatures[:start]
+            self._kept_signatures = grown
+        self._kept_signatures[start:end] = signatures
+        self._kept_index.extend(index.tolist())
+        return np.arange(start, end)
+
+    def _near_batch(self, positions: np.ndarray, texts: np.ndarray, labels: np.ndarray) -> np.ndarray:
+        """ Mark the near duplicates among a batch of rows (at `positions` of the chunk)
+        with non-empty `texts`.
+        """
+        num_rows = len(positions)
+        signatures = self._signatures_of(list(texts))
+        keys = self._band_keys(signatures).ravel()
+        rows = np.repeat(np.arange(num_rows), self.bands)
+
+        # The candidate of a (row, band) is the paper kept earlier in the band's bucket,
+        # or else the first earlier row of the batch sharing the band.
+        kept_earlier = np.fromiter(map(self._buckets.get, keys.tolist(), repeat(-1)),
+                                   dtype=np.int64, count=len(keys))
+        external = kept_earlier >= 0
+        codes, uniques = pd.factorize(keys)
+        first = np.full(len(uniques), len(keys))
+        np.minimum.at(first, codes, np.arange(len(keys)))
+        first_row = first[codes] // self.bands
+        internal = ~external & (first_row < rows)
+
+        similarity = np.zeros(len(keys))
+        if external.any():
+            similarity[external] = self._agreement(signatures[rows[external]],
+                                                   self._kept_signatures[kept_earlier[external]])
+        if internal.any():
+            similarity[internal] = self._agreement(signatures[rows[internal]],
+                                                   signatures[first_row[internal]])
+        # Best candidate of every row
+        similarity = similarity.reshape(num_rows, self.bands)
+        best_band = similarity.argmax(axis=1)
+        best = similarity[np.arange(num_rows), best_band]
+        matched = best >= self.similarity
+        best_pair = np.arange(num_rows) * self.bands + best_band
+        matched_external = matched & external[best_pair]
+
+        # Rows matching a duplicate of the batch are merged into the paper it was merged into
+        parent = np.where(matched & ~external[best_pair], first_row[best_pair], np.arange(num_rows))
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+        mask = matched_external | (parent != np.arange(num_rows))
+        for row in np.flatnonzero(mask):
+            root = parent[row]
+            kept = self._kept_index[kept_earlier[best_pair[root]]] if matched_external[root] else labels[positions[root]]
+            self._merges.append((positions[row], kept, f"near-duplicate ({best[row]:.2f})"))
+
+        # Kept rows fill the buckets that were still empty, in order
+        kept_rows = np.flatnonzero(~mask)
+        slots = self._keep_signatures(labels[positions[kept_rows]], signatures[kept_rows])
+        pairs = (np.repeat(~mask, self.bands) & ~external).nonzero()[0]
+        new_keys = pd.Series(keys[pairs])
+        first_pairs = ~new_keys.duplicated().values
+        owners = np.empty(num_rows, dtype=np.int64)
+        owners[kept_rows] = slots
+        self._buckets.update(zip(new_keys.values[first_pairs].tolist(),
+                                 owners[rows[pairs[first_pairs]]].tolist()))
+        return mask
+
+    def process(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Return `df` without the duplicates of papers kept from this or earlier chunks. """
+        return df[~self.duplicated(df)]
+
+    def duplicated(self, df: pd.DataFrame) -> np.ndarray:
+        """ Boolean mask of the rows of `df` duplicating a paper kept from this or an
+        earlier chunk. The papers kept are remembered for the next chunks.
+
+        Rows are told apart by position, so the index of `df` needn't be unique (e.g.
+        chunks concatenated with their own `RangeIndex`); it's only used in `report()`.
+        """
+        labels = df.index.values
+        titles = df['title'].tolist() if 'title' in df else [None] * len(df)
+        # Only the compared columns, indexed by position
+        df = df[[c for c in ('doi', 'title', 'description') if c in df]].reset_index(drop=True)
+        start = len(self._merges)
+        dois = normalize_doi(df['doi']) if 'doi' in df else pd.Series(
+            "", index=df.index)
+        keys = pd.Series(pd.util.hash_array(
+            dois.values.astype(object)), index=df.index)
+        mask = self._exact_pass(keys, dois != "", self._seen_doi, "doi", labels)
+        df = df[~mask]
+
+        texts = normalize_column(df['title']) if 'title' in df else pd.Series(
+            "", index=df.index)
+        if 'description' in df:
+            texts = (texts + " " + normalize_column(df['description'])).str.strip()
+        keys = pd.Series(pd.util.hash_array(
+            texts.values.astype(object)), index=df.index)
+        mask = self._exact_pass(keys, texts != "", self._seen_text, "title", labels)
+        df = df[~mask]
+        texts = texts[~mask]
+
+        if self.near_duplicates and len(df):
+            mask = self._near_pass(texts, labels)
+            df = df[~mask]
+
+        # Merges were recorded with the position of the dropped row
+        self._merges[start:] = [(labels[position], kept, reason, titles[position])
+                                for position, kept, reason in self._merges[start:]]
+        duplicated = np.ones(len(labels), dtype=bool)
+        duplicated[df.index.values] = False
+        return duplicated
+
+    def report(self) -> pd.DataFrame:
+        """ Every merged row: its index, the index of the row it was merged into, why, and
+        its title.
+        """
+        return pd.DataFrame(self._merges, columns=['dropped', 'kept', 'reason', 'title'])
@@ -0,0 +1,233 @@
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: enables Parquet exports
+    pa = pq = None
+
+try:
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+except ImportError:  # Optional: enables Excel exports
+    Workbook = None
+
+# Maximum number of rows of an Excel sheet, header included.
+EXCEL_MAX_ROWS = 1048576
+
+# Columns with few distinct values, stored as categoricals in Parquet exports.
+CATEGORICAL_COLUMNS = ["splits", "subtype", "subtypeDescription", "aggregationType", "publicationName",
+                       "affiliation_country", "freetoread", "freetoreadLabel"]
+
+
+class Exporter:
+    def __init__(self, path: str, index: bool = True):
+        """ Writes DataFrame chunks to a file, one chunk at a time, so memory is bounded
+        by the chunk size. Use `write()` for every chunk, then `close()`, or use the
+        exporter as a context manager.
+
+        `path`: path to the exported file.
+        `index`: if True, the index of the chunks is written as a first "index" column.
+
+        The columns of the first chunk are used for the whole file: later chunks are
+        aligned with them.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.index = index
+        self.columns = None
+        self.num_rows = 0
+
+    def _align(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        if self.index:
+            chunk = chunk.rename_axis("index").reset_index()
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        return chunk.reindex(columns=self.columns)
+
+    def write(self, chunk: pd.DataFrame):
+        chunk = self._align(chunk)
+        self._write(chunk)
+        self.num_rows += len(chunk)
+
+    def _write(self, chunk: pd.DataFrame):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvExporter(Exporter):
+    def __init__(self, path: str, index: bool = True, append: bool = False):
+        """ Writes a CSV file. Fields containing commas, quotes or line breaks are quoted.
+
+        `append`: if True, rows are appended to an existing file and aligned with its
+        header, which is only written if the file is new.
+        """
+        super().__init__(path, index=index)
+        self._header = True
+        if append and os.path.exists(path) and os.path.getsize(path):
+            self.columns = list(pd.read_csv(path, nrows=0).columns)
+            self._header = False
+        self._file = open(path, "a" if append else "w",
+                          newline="", encoding="utf8")
+
+    def _write(self, chunk: pd.DataFrame):
+        chunk.to_csv(self._file, header=self._header, index=False)
+        self._header = False
+
+    def close(self):
+        if self._header and self.columns is not None:  # No rows: still write the header
+            pd.DataFrame(columns=self.columns).to_csv(self._file, index=False)
+        self._file.close()
+
+
+class ParquetExporter(Exporter):
+    def __init__(self, path: str, index: bool = True, categorical: list = CATEGORICAL_COLUMNS):
+        """ Writes a Parquet file (requires pyarrow), one row group per chunk.
+
+        `categorical`: columns stored as categoricals (dictionary-encoded), which makes
+        repetitive columns such as the splits much smaller and faster to load.
+        """
+        if pq is None:
+            raise ImportError("Parquet exports require pyarrow: pip install pyarrow")
+        super().__init__(path, index=index)
+        self.categorical = categorical
+        self._writer = None
+        self._schema = None
+
+    def _schema_of(self, table) -> "pa.Schema":
+        """ Schema of the whole file, from the first chunk. Columns without values in the
+        first chunk are assumed to hold strings.
+        """
+        fields = [field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                  for field in table.schema]
+        return pa.schema(fields)
+
+    def _write(self, chunk: pd.DataFrame):
+        chunk = chunk.copy()
+        for column in chunk.columns:
+            if chunk[column].dtype == object:  # Mixed types can't be converted
+                chunk[column] = chunk[column].astype("string")
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        for i, name in enumerate(table.column_names):
+            if name in self.categorical:
+                table = table.set_column(i, name, table.column(
+                    i).cast(pa.string()).dictionary_encode())
+        if self._writer is None:
+            self._schema = self._schema_of(table)
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        self._writer.write_table(table.cast(self._schema))
+
+    def close(self):
+        if self._writer is None and self.columns is not None:  # No rows
+            pd.DataFrame(columns=self.columns).to_parquet(self.path)
+        elif self._writer is not None:
+            self._writer.close()
+
+
+class XlsxExporter(Exporter):
+    def __init__(self, path: str, index: bool = True):
+        """ Writes an Excel workbook with openpyxl's write-only mode, which streams rows
+        to disk instead of keeping the workbook in memory. When a sheet is full
+        (`EXCEL_MAX_ROWS`), the rows continue in a new sheet.
+        """
+        if Workbook is None:
+            raise ImportError("Excel exports require openpyxl: pip install openpyxl")
+        super().__init__(path, index=index)
+        self._workbook = Workbook(write_only=True)
+        self._sheet = None
+        self._sheet_rows = 0
+
+    def _new_sheet(self):
+        self._sheet = self._workbook.create_sheet(
+            f"results_{len(self._workbook.worksheets) + 1}")
+        self._sheet.append(self.columns)
+        self._sheet_rows = 1
+
+    @staticmethod
+    def _clean(chunk: pd.DataFrame) -> pd.DataFrame:
+        """ Replace missing values by empty cells and remove the control characters Excel
+        rejects, only scanning each column once.
+        """
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for column in chunk.columns:
+            text = "".join(v for v in chunk[column] if isinstance(v, str))
+            if ILLEGAL_CHARACTERS_RE.search(text):
+                chunk[column] = chunk[column].map(
+                    lambda v: ILLEGAL_CHARACTERS_RE.sub("", v) if isinstance(v, str) else v)
+        return chunk
+
+    def _write(self, chunk: pd.DataFrame):
+        for row in self._clean(chunk).itertuples(index=False, name=None):
+            if self._sheet is None or self._sheet_rows >= EXCEL_MAX_ROWS:
+                self._new_sheet()
+            self._sheet.append(row)
+            self._sheet_rows += 1
+
+    def close(self):
+        if self._sheet is None:  # Excel files need at least one sheet
+            self._sheet = self._workbook.create_sheet("results_1")
+            if self.columns is not None:
+                self._sheet.append(self.columns)
+        self._workbook.save(self.path)
+
+
+EXPORTERS = {"xlsx": XlsxExporter, "csv": CsvExporter,
+             "parquet": ParquetExporter}
+
+
+def get_exporter(format: str, path: str, **kwds) -> Exporter:
+    """ Create the exporter of `format` ("xlsx", "csv" or "parquet") writing to `path`. """
+    if format not in EXPORTERS:
+        raise ValueError(
+            f"Unknown export format: {format}. Use one of: {', '.join(EXPORTERS)}.")
+    return EXPORTERS[format](path, **kwds)
+
+
+def export(chunks, path: str, format: str = "xlsx", **kwds) -> int:
+    """ Write an iterable of DataFrame chunks (e.g. `ResultAccumulator.iter_chunks()`)
+    to `path` as `format`. Returns the number of rows written.
+    """
+    with get_exporter(format, path, **kwds) as exporter:
+        for chunk in chunks:
+            exporter.write(chunk)
+    return exporter.num_rows
+
+
+def read_chunks(path: str, chunk_size: int = 10000):
+    """ Yield the rows of an exported file (CSV, Parquet or Excel) or of a directory of
+    `ResultAccumulator` chunks (e.g. `run()`'s `chunks/`) as DataFrame chunks. An
+    "index" column written by an exporter is turned back into the index.
+    """
+    if os.path.isdir(path):
+        chunks = (os.path.join(path, name) for name in sorted(os.listdir(path))
+                  if name.startswith("chunk_"))
+        chunks = (pd.read_parquet(c) if c.endswith(".parquet") else pd.read_pickle(c)
+                  for c in chunks)
+    elif path.endswith(".csv"):
+        chunks = pd.read_csv(path, chunksize=chunk_size)
+    elif path.endswith(".parquet"):
+        if pq is None:
+            raise ImportError("Parquet files require pyarrow: pip install pyarrow")
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(chunk_size))
+    elif path.endswith(".xlsx"):
+        if Workbook is None:
+            raise ImportError("Excel files require openpyxl: pip install openpyxl")
+        # Rows continued in new sheets (see `XlsxExporter`) are read back in order
+        chunks = pd.read_excel(path, sheet_name=None).values()
+    else:
+        raise ValueError(f"Unknown file format: {path}. Use a directory, .csv, .parquet or .xlsx.")
+    for chunk in chunks:
+        if "index" in chunk.columns:
+            chunk = chunk.set_index("index").rename_axis(None)
+        yield chunk
@@ -0,0 +1,253 @@
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+
+import pandas as pd
+from pybliometrics.scopus.exception import Scopus429Error, ScopusQueryError, ScopusServerError
+
+from prisma_automator.batching import unbatch
+from prisma_automator.fields import COMPLETE_FIELDS, FIELDS
+from prisma_automator.refiner import SUBJECT_AREAS
+
+Document = namedtuple('Document', FIELDS)
+
+SEARCH_MAX_ENTRIES = 5000
+
+
+def _digest(text: str) -> int:
+    return int(hashlib.md5(text.encode("utf8")).hexdigest(), 16)
+
+
+class FakeScopus:
+    def __init__(self, counts: dict = None, default_count: int = 5, max_count: int = 0,
+                 latency: float = 0.0, throttle: int = 0, years: tuple = (2000, 2023),
+                 quota: int = None, page_size: int = None, error_rate: float = 0.0, seed: int = 0,
+                 cached: bool = False):
+        """ Offline stand-in for pybliometrics' `ScopusSearch`, for tests and benchmarks.
+
+        An instance is called exactly like `ScopusSearch` and returns a search object
+        with `get_results_size()` and `results`.
+
+        `counts`: mapping of query string to number of results.
+        `default_count`: number of results of queries not in `counts`.
+        `max_count`: if > 0, queries not in `counts` get a deterministic number of
+        results in `[0, max_count]` derived from the query string instead.
+        `latency`: seconds each simulated request takes.
+        `throttle`: number of initial requests that fail with `Scopus429Error`, which
+        pybliometrics raises once every API key is out of quota.
+        `years`: first and last publication year of the generated documents. Documents
+        are spread evenly over the years and over the Scopus subject areas, so queries
+        restricted with `PUBYEAR` and `SUBJAREA` clauses return consistent subsets.
+        `quota`: weekly quota of the simulated key, reported by the search objects'
+        `get_key_remaining_quota()`. If None, no quota is reported.
+        `page_size`: results per simulated request. Defaults to Scopus' page size (200
+        for the STANDARD view with subscriber access, 25 otherwise). Plans and the token
+        bucket of a `Collector` still assume Scopus' page size.
+        `error_rate`: probability of a request failing with `ScopusServerError`, drawn
+        from a random generator seeded with `seed`.
+        `cached`: if True, searches behave as if pybliometrics loaded them from its file
+        cache: no request is counted, and the search objects have no response headers.
+        """
+        self.counts = counts or {}
+        self.default_count = default_count
+        self.max_count = max_count
+        self.latency = latency
+        self.throttle = throttle
+        self.years = years
+        self.quota = quota
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.cached = cached
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.queries = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Picklable, e.g. to be sent to worker processes (see `workqueue`)
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def count(self, query: str) -> int:
+        """ Number of results of `query`, ignoring `PUBYEAR` and `SUBJAREA` clauses. """
+        if query in self.counts:
+            return self.counts[query]
+        if self.max_count:
+            return _digest(query) % (self.max_count + 1)
+        return self.default_count
+
+    def request(self, query: str):
+        """ Simulate one HTTP request: wait, count it, and maybe throttle it. """
+        with self._lock:
+            self.requests += 1
+            self.queries.append(query)
+            throttled = self.requests <= self.throttle
+            failed = self.error_rate and self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise Scopus429Error("Quota exceeded (simulated).")
+        if failed:
+            raise ScopusServerError("Internal server error (simulated).")
+
+    def select(self, query: str) -> list:
+        """ Return the `(base query, index)` pairs of the documents matching `query`.
+
+        A batched query (see `batching.batch_query()`) returns the documents of all the
+        splits it combines.
+        """
+        base = re.split(r" AND (?:PUBYEAR|SUBJAREA)", query)[0]
+        members = unbatch(base[len("TITLE-ABS-KEY("):-1])
+        bases = [f"TITLE-ABS-KEY({m})" for m in members] if members else [base]
+        first, last = self.years
+        after = re.search(r"PUBYEAR > (\d+)", query)
+        before = re.search(r"PUBYEAR < (\d+)", query)
+        area = re.search(r"SUBJAREA\((\w+)\)", query)
+        low = int(after.group(1)) + 1 if after else first
+        high = int(before.group(1)) - 1 if before else last
+        selected = []
+        for base in bases:
+            for i in range(self.count(base)):
+                year = first + i % (last - first + 1)
+                if low <= year <= high and (not area or SUBJECT_AREAS[i % len(SUBJECT_AREAS)] == area.group(1)):
+                    selected.append((base, i))
+        return selected
+
+    def documents(self, selected, view: str = "COMPLETE") -> list:
+        """ Build the documents of `(base query, index)` pairs returned by `select()`.
+        With the STANDARD `view`, fields of the COMPLETE view are left empty.
+        """
+        first, last = self.years
+        docs = []
+        for query, i in selected:
+            seed = _digest(query) % 10**8
+            uid = f"{seed}{i:04d}"
+            year = first + i % (last - first + 1)
+            doc = dict.fromkeys(FIELDS)
+            doc.update(eid=f"2-s2.0-{uid}", doi=f"10.0000/fake.{uid}",
+                       title=f"Document {i} for {query}", subtype="ar",
+                       subtypeDescription="Article", creator="Doe J.",
+                       coverDate=f"{year}-01-01", description=f"Abstract of {query}.",
+                       citedby_count=0, openaccess=0)
+            if view == "STANDARD":
+                doc.update(dict.fromkeys(COMPLETE_FIELDS))
+            docs.append(Document(**doc))
+        return docs
+
+    def __call__(self, query: str, refresh=False, view: str = None, download: bool = True,
+                 subscriber: bool = True, **kwds):
+        return FakeScopusSearch(self, query, view=view, download=download,
+                                subscriber=subscriber)
+
+
+class FakeScopusSearch:
+    def __init__(self, backend: FakeScopus, query: str, view: str = None,
+                 download: bool = True, subscriber: bool = True):
+        """ Search object returned by `FakeScopus`, mirroring `ScopusSearch`. """
+        self._view = view or ("COMPLETE" if subscriber else "STANDARD")
+        self._count = backend.page_size or (
+            200 if self._view == "STANDARD" and subscriber else 25)
+        if not backend.cached:
+            backend.request(query)
+        selected = backend.select(query)
+        self._n = len(selected)
+        if not subscriber and self._n > SEARCH_MAX_ENTRIES:
+            raise ScopusQueryError(f"Found {self._n:,} matches.")
+        self.results = None
+        if download and self._n:
+            # Remaining pages are separate requests in the real API
+            for _ in range(1, -(-self._n // self._count)):
+                if not backend.cached:
+                    backend.request(query)
+            self.results = backend.documents(selected, self._view)
+        if not backend.cached:  # Headers of the last response, as in pybliometrics
+            self._header = {}
+            if backend.quota is not None:
+                self._header["X-RateLimit-Remaining"] = str(max(backend.quota - backend.requests, 0))
+
+    def get_results_size(self) -> int:
+        return self._n
+
+    def get_key_remaining_quota(self):
+        return getattr(self, "_header", {}).get("X-RateLimit-Remaining")
+
+
+# Words of the synthetic keywords and titles.
+VOCABULARY = ["augmented", "virtual", "mixed", "extended", "reality", "digital", "twin",
+              "gaming", "brain", "computer", "interface", "flexible", "assembly", "matrix",
+              "production", "scheduling", "heuristics", "learning", "robot", "sensor",
+              "network", "simulation", "model", "design", "system", "control", "data"]
+
+
+def keyword_grid(group_sizes: list, skips: bool = True, seed: int = 0) -> list:
+    """ Synthetic keyword groups for `Splitter.add_kwgroups()`, generating
+    `prod(group_sizes)` combinations, e.g. `[100, 100, 100]` for a million splits.
+
+    `skips`: if True, the last keyword of every other group is a skip (`""`), and one
+    keyword of every group is an OR of two keywords (`"A || B"`).
+    """
+    generator = random.Random(seed)
+    groups = []
+    for g, size in enumerate(group_sizes):
+        group = []
+        for k in range(size):
+            words = generator.sample(VOCABULARY, 2)
+            group.append(f"{words[0].title()} {words[1].title()} {g}.{k}")
+        if skips and size > 1:
+            group[0] += f" || {group[1]} Alternative"
+            if g % 2:
+                group[-1] = ""
+        groups.append(group)
+    return groups
+
+
+def synthetic_records(num: int, duplicates: float = 0.1, near_duplicates: float = 0.02,
+                      reviews: float = 0.02, missing_doi: float = 0.03, seed: int = 0) -> pd.DataFrame:
+    """ Synthetic search results, with the columns of `Collector.search()`'s dataframe,
+    for benchmarking `Collector.screen()` and the exporters.
+
+    `duplicates`: share of rows that repeat an earlier row's doi, title and abstract,
+    with a different case and punctuation in the title.
+    `near_duplicates`: share of rows repeating an earlier row with one title word changed.
+    `reviews`: share of "Conference Review" rows.
+    `missing_doi`: share of rows without a doi.
+    """
+    generator = random.Random(seed)
+    rows = []
+    for i in range(num):
+        draw = generator.random()
+        if rows and draw < duplicates:
+            row = dict(generator.choice(rows), eid=f"2-s2.0-{i:010d}")
+            row["title"] = row["title"].upper() + "."
+        elif rows and draw < duplicates + near_duplicates:
+            row = dict(generator.choice(rows), eid=f"2-s2.0-{i:010d}",
+                       doi=f"10.0000/synthetic.{i}")
+            words = row["title"].split()
+            words[generator.randrange(len(words))] = generator.choice(VOCABULARY)
+            row["title"] = " ".join(words)
+        else:
+            title = " ".join(generator.choices(VOCABULARY, k=generator.randint(6, 14)))
+            row = dict.fromkeys(FIELDS)
+            row.update(eid=f"2-s2.0-{i:010d}", doi=f"10.0000/synthetic.{i}",
+                       title=title.capitalize(), subtype="ar", subtypeDescription="Article",
+                       creator="Doe J.", coverDate=f"{2000 + i % 24}-01-01",
+                       publicationName=f"Journal of {generator.choice(VOCABULARY).title()}",
+                       description=" ".join(generator.choices(VOCABULARY, k=80)) + ".",
+                       authkeywords=" | ".join(generator.sample(VOCABULARY, 4)),
+                       citedby_count=generator.randrange(100), openaccess=0)
+            draw = generator.random()
+            if draw < reviews:
+                row.update(subtype="cr", subtypeDescription="Conference Review")
+            elif draw < reviews + missing_doi:
+                row["doi"] = None
+        row["splits"] = f'"{generator.choice(VOCABULARY)}" AND "{generator.choice(VOCABULARY)}"'
+        rows.append(row)
+    return pd.DataFrame(rows, columns=["splits"] + FIELDS)
@@ -0,0 +1,57 @@
+from prisma_automator.utility import record_to_dict
+
+# Same fields, in the same order, as pybliometrics' ScopusSearch results.
+FIELDS = ['eid', 'doi', 'pii', 'pubmed_id', 'title', 'subtype', 'subtypeDescription',
+          'creator', 'afid', 'affilname', 'affiliation_city', 'affiliation_country',
+          'author_count', 'author_names', 'author_ids', 'author_afids', 'coverDate',
+          'coverDisplayDate', 'publicationName', 'issn', 'source_id', 'eIssn',
+          'aggregationType', 'volume', 'issueIdentifier', 'article_number', 'pageRange',
+          'description', 'authkeywords', 'citedby_count', 'openaccess', 'freetoread',
+          'freetoreadLabel', 'fund_acr', 'fund_no', 'fund_sponsor']
+
+# Fields only returned by the COMPLETE view, which requires subscriber access. All
+# other fields are returned by the STANDARD view.
+COMPLETE_FIELDS = ['author_count', 'author_names', 'author_ids', 'author_afids',
+                   'description', 'authkeywords', 'fund_acr', 'fund_no', 'fund_sponsor']
+
+# Fields the collector always keeps, to identify and screen papers.
+REQUIRED_FIELDS = ['eid', 'doi', 'title', 'subtypeDescription']
+
+
+def needed_fields(fields) -> list:
+    """ `fields` and the `REQUIRED_FIELDS`, in the order of `FIELDS`. """
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}.")
+    wanted = set(fields) | set(REQUIRED_FIELDS)
+    return [f for f in FIELDS if f in wanted]
+
+
+def view_for(fields, subscriber: bool) -> str:
+    """ Smallest Scopus view returning all `fields`. If `fields` is None, the view used
+    by pybliometrics' ScopusSearch when none is given.
+    """
+    if fields is None:
+        return "COMPLETE" if subscriber else "STANDARD"
+    needed_fields(fields)  # Fail early on unknown fields
+    complete = set(fields) & set(COMPLETE_FIELDS)
+    if not complete:
+        return "STANDARD"
+    if not subscriber:
+        raise ValueError(
+            f"Fields {', '.join(sorted(complete))} require subscriber access (COMPLETE view).")
+    return "COMPLETE"
+
+
+def project(records: list, fields) -> list:
+    """ Keep only `fields` (see `needed_fields()`) of every record. Records are returned
+    as dicts. If `fields` is None, records are returned unchanged.
+    """
+    if fields is None:
+        return records
+    fields = needed_fields(fields)
+    projected = []
+    for record in records:
+        record = record_to_dict(record)
+        projected.append({f: record.get(f) for f in fields})
+    return projected
@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+
+from prisma_automator.utility import record_to_dict
+
+
+class RunJournal:
+    def __init__(self, path: str = "./out/journal.jsonl", resume: bool = False):
+        """ Append-only journal of a collection run, written as splits complete.
+
+        Every line is a JSON object: either the result count of a split, or the
+        records downloaded for it. Lines are flushed immediately, so a run that dies
+        halfway loses at most the splits that were in flight.
+
+        `path`: path to the journal file.
+        `resume`: if True, load the existing journal so completed splits are skipped.
+        Otherwise, the journal is started from scratch.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.counts = {}  # split -> num_results (None if Scopus refused to count it)
+        self.completed = {}  # split -> offset of its records in the journal file
+        if resume and os.path.exists(path):
+            self._load()
+        self._file = open(path, "ab" if resume else "wb")
+        self._lock = threading.Lock()
+        if resume and self._file.tell():
+            self._file.write(b"\n")  # Don't append to a line cut short by a crash
+
+    def _load(self):
+        # Only offsets of the records are kept in memory, not the records themselves
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                start, offset = offset, offset + len(line)
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Line cut short by a crash
+                if "records" in entry:
+                    self.completed[entry["split"]] = start
+                else:
+                    self.counts[entry["split"]] = entry["num_results"]
+
+    def _write(self, entry: dict) -> int:
+        line = json.dumps(entry, separators=(',', ':')).encode("utf8")
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(line + b"\n")
+            self._file.flush()
+        return offset
+
+    def record_count(self, split: str, num_results):
+        self.counts[split] = num_results
+        self._write({"split": split, "num_results": num_results})
+
+    def record_results(self, split: str, records: list):
+        records = [record_to_dict(r) for r in records or []]
+        self.completed[split] = self._write({"split": split, "records": records})
+
+    def get_results(self, split: str) -> list:
+        """ Read the records of a completed split back from the journal. """
+        with open(self.path, "rb") as f:
+            f.seek(self.completed[split])
+            return json.loads(f.readline())["records"]
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,103 @@
+import re
+
+# Quoted phrases, parentheses and the AND/OR operators of a split.
+TOKEN = re.compile(r'"([^"]*)"|(\()|(\))|\b(AND|OR)\b|(\S)', re.IGNORECASE)
+
+
+def tokenize(split: str) -> list:
+    tokens = []
+    for phrase, opening, closing, operator, other in TOKEN.findall(split):
+        if other:
+            raise ValueError(f"Unexpected '{other}' in split: {split}")
+        tokens.append(operator.upper() or opening or closing or ('"', phrase))
+    return tokens
+
+
+def normalize_phrase(phrase: str) -> str:
+    """ Scopus ignores case and repeated whitespace inside a phrase. """
+    return " ".join(phrase.split()).lower()
+
+
+def parse_split(split: str) -> list:
+    """ Parse a split into a list of AND-terms, each one a list of OR-ed phrases.
+
+    Splits have the form produced by `Splitter.parse_combination()`, e.g.
+    `"Virtual Reality" AND ("BCI" OR "Brain-Computer Interface")` is parsed into
+    `[["Virtual Reality"], ["BCI", "Brain-Computer Interface"]]`.
+    """
+    tokens = tokenize(split)
+    terms = []
+    i = 0
+    while i < len(tokens):
+        if terms:
+            if tokens[i] != "AND":
+                raise ValueError(f"Expected AND in split: {split}")
+            i += 1
+        if i < len(tokens) and tokens[i] == "(":
+            term = []
+            i += 1
+            while i < len(tokens) and tokens[i] != ")":
+                if term:
+                    if tokens[i] != "OR":
+                        raise ValueError(f"Expected OR in split: {split}")
+                    i += 1
+                if i >= len(tokens) or not isinstance(tokens[i], tuple):
+                    raise ValueError(f"Expected a phrase in split: {split}")
+                term.append(tokens[i][1])
+                i += 1
+            if i >= len(tokens) or not term:
+                raise ValueError(f"Unbalanced parentheses in split: {split}")
+            i += 1
+        elif i < len(tokens) and isinstance(tokens[i], tuple):
+            term = [tokens[i][1]]
+            i += 1
+        else:
+            raise ValueError(f"Expected a phrase in split: {split}")
+        terms.append(term)
+    return terms
+
+
+def canonical_terms(split: str) -> frozenset:
+    """ Order-insensitive form of a split: a set of AND-terms, each a set of normalized phrases.
+
+    Repeated terms and phrases are dropped, and so are terms implied by a narrower
+    one (`"A" AND ("A" OR "B")` is the same query as `"A"`).
+    """
+    terms = {frozenset(normalize_phrase(p) for p in term)
+             for term in parse_split(split)}
+    return frozenset(t for t in terms if not any(o < t for o in terms))
+
+
+def format_terms(terms) -> str:
+    """ Build a split from a set of AND-terms, sorted and quoted consistently. """
+    parts = []
+    for term in sorted(sorted(t) for t in terms):
+        phrases = " OR ".join(f"\"{p}\"" for p in term)
+        parts.append(phrases if len(term) == 1 else f"({phrases})")
+    return " AND ".join(parts)
+
+
+def canonical_split(split: str) -> str:
+    """ Canonical string of a split. Two splits return the same Scopus results if their
+    canonical strings are equal.
+
+    Splits that can't be parsed (e.g. key-words containing `"`) are returned unchanged,
+    so they only match identical splits.
+    """
+    try:
+        return format_terms(canonical_terms(split))
+    except ValueError:
+        return split
+
+
+def normalize_text(text: str) -> str:
+    """ Lowercase `text` and replace punctuation by spaces, as Scopus does for phrases. """
+    return " ".join(re.sub(r"[\W_]+", " ", text or "").split()).lower()
+
+
+def match_terms(terms, text: str) -> bool:
+    """ Whether `text`, normalized with `normalize_text()`, satisfies the AND-terms of a
+    split (see `parse_split()`): at least one phrase of every term must appear in the text.
+    """
+    text = f" {text} "
+    return all(any(f" {normalize_text(p)} " in text for p in term) for term in terms)
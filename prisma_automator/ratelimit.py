@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+class QuotaExhaustedError(Exception):
+    """ Raised when a request would go over the configured API key quota. """
+
+
+class TokenBucket:
+    def __init__(self, rate: float = 9, capacity: float = None, quota: int = None):
+        """ Thread-safe token bucket shared by all workers of a Collector.
+
+        `rate`: tokens (requests) added per second. Scopus allows 9 requests/s for the
+        Search API.
+        `capacity`: maximum burst size. Defaults to `rate`.
+        `quota`: total number of tokens that may ever be taken from the bucket, e.g. the
+        weekly quota of the API key (20000 for the Search API). If None, unlimited.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.quota = quota
+        self.used = 0
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens +
+                           (now - self._last) * self.rate)
+        self._last = now
+
+    def _take_quota(self, tokens: int):
+        if self.quota is not None and self.used + tokens > self.quota:
+            raise QuotaExhaustedError(
+                f"Quota of {self.quota} requests exhausted ({self.used} used).")
+        self.used += tokens
+
+    def acquire(self, tokens: int = 1):
+        """ Block until `tokens` can be taken from the bucket, then take them.
+
+        Requests larger than `capacity` are allowed and leave the bucket in debt, so
+        the following callers wait for the refill.
+        """
+        with self._lock:
+            self._take_quota(tokens)
+        needed = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def charge(self, tokens: int):
+        """ Take `tokens` without blocking, e.g. for pages that were already fetched.
+
+        Since the requests already happened, this never raises: the quota is only
+        enforced on the next `acquire()`.
+        """
+        if tokens <= 0:
+            return
+        with self._lock:
+            self.used += tokens
+            self._refill()
+            self._tokens -= tokens
+
+    def refund(self, tokens: int):
+        """ Give back `tokens` taken for requests that were never sent, e.g. searches
+        answered by pybliometrics' file cache.
+        """
+        with self._lock:
+            self.used -= tokens
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+    @property
+    def remaining(self):
+        """ Remaining quota, or None if the bucket has no quota. """
+        if self.quota is None:
+            return None
+        return self.quota - self.used
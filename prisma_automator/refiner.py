@@ -0,0 +1,68 @@
+from datetime import date
+
+# Scopus subject area codes, used with SUBJAREA() to partition single-year queries.
+SUBJECT_AREAS = ["AGRI", "ARTS", "BIOC", "BUSI", "CENG", "CHEM", "COMP", "DECI", "DENT",
+                 "EART", "ECON", "ENER", "ENGI", "ENVI", "HEAL", "IMMU", "MATE", "MATH",
+                 "MEDI", "MULT", "NEUR", "NURS", "PHAR", "PHYS", "PSYC", "SOCI", "VETE"]
+
+FIRST_YEAR = 1900
+LAST_YEAR = date.today().year + 1  # Articles in press may already have next year's date
+
+
+def build_query(split: str, clauses: tuple = ()) -> str:
+    """ Build the Scopus query of a split, restricted by extra `clauses` (e.g. `PUBYEAR > 2009`). """
+    query = "TITLE-ABS-KEY(" + split + ")"
+    for clause in clauses:
+        query += " AND " + clause
+    return query
+
+
+def year_clause(first: int, last: int) -> str:
+    return f"PUBYEAR > {first - 1} AND PUBYEAR < {last + 1}"
+
+
+def refine(count, threshold: int, first_year: int = FIRST_YEAR, last_year: int = LAST_YEAR,
+           subject_areas: bool = True, over_threshold: bool = False) -> list:
+    """ Partition a query with too many results into sub-queries with at most `threshold` results.
+
+    The `PUBYEAR` range is bisected until each range fits. Single years that still don't
+    fit are partitioned by subject area. Only counts are requested, so the number of
+    requests grows with the logarithm of the year range, not with the number of results.
+
+    `count`: function that takes a tuple of extra clauses and returns the number of
+    results of the restricted query, or None if Scopus refused to count it (>5000).
+    `threshold`: maximum number of results of a sub-query.
+    `subject_areas`: if False, single years over `threshold` aren't partitioned further.
+    `over_threshold`: if True, the caller already knows that the whole year range is over
+    `threshold` (e.g. from the count of the unrestricted query), so it's bisected
+    straight away instead of being counted again.
+
+    Returns a list of `(num_results, clauses)` tuples in chronological order. Sub-queries
+    that couldn't be brought under `threshold` are included with their `num_results`.
+    Empty sub-queries are left out.
+    """
+    parts = []
+    stack = [(first_year, last_year)]
+    known = over_threshold  # Whether the range popped next is known to be over threshold
+    while stack:
+        first, last = stack.pop()
+        clauses = (year_clause(first, last),)
+        num_results = None if known else count(clauses)
+        if not known and num_results is not None and num_results <= threshold:
+            if num_results:
+                parts.append((num_results, clauses))
+        elif first < last:
+            middle = (first + last) // 2
+            stack.append((middle + 1, last))
+            stack.append((first, middle))  # Popped first, keeps chronological order
+            known = False
+        elif subject_areas:
+            # Papers may belong to several subject areas, so these parts can overlap
+            for area in SUBJECT_AREAS:
+                area_clauses = clauses + (f"SUBJAREA({area})",)
+                area_results = count(area_clauses)
+                if area_results is None or area_results:
+                    parts.append((area_results, area_clauses))
+        else:
+            parts.append((num_results, clauses))
+    return parts
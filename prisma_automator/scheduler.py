@@ -0,0 +1,112 @@
+from prisma_automator.batching import unbatch
+from prisma_automator.query import canonical_terms
+
+# Orders in which `Scheduler` downloads the splits of a plan.
+PRIORITIES = ["plan", "smallest", "weights", "yield"]
+
+
+class Scheduler:
+    def __init__(self, budget: int = None, priority: str = "plan", weights: dict = None, index=None):
+        """ Orders the splits of a plan (see `Collector.plan()`) by priority and cuts it
+        at a budget of API requests, so the most valuable splits are downloaded first
+        and a run never spends more than the allowance of the week.
+
+        `budget`: maximum number of download requests (pages, as estimated from the
+        count probes). If None, every split is scheduled.
+        `priority`: order of the downloads:
+        - "plan": the order of the plan (the order in which splits were generated);
+        - "smallest": fewest pages first, which downloads the most splits per request;
+        - "weights": highest weight first (see `weights`), then the order of the plan;
+        - "yield": most expected new papers per page first (see `index`).
+        `weights`: mapping of key-word, as given to `Splitter.add_kwgroup()` (e.g.
+        `"Extended Reality || Mixed Reality"`), to weight. The weight of a split is
+        the product of the weights of its key-words; key-words without a weight count
+        as 1. A batch weighs as much as its heaviest split. Weights are given per
+        key-word rather than per group: every split takes a key-word of every group, so
+        a group's weight would be the same for all of them. To favour a whole group
+        over skipping it, give all its key-words the same weight.
+        `index`: `InvertedIndex` of the records collected so far. With the "yield"
+        priority, the records of a split already in the index aren't counted as new.
+        Without an index, every result is expected to be new.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(
+                f"Unknown priority: {priority}. Use one of: {', '.join(PRIORITIES)}.")
+        self.budget = budget
+        self.priority = priority
+        self.index = index
+        self.spent = 0  # Pages scheduled by the last `schedule()`
+        # Key-word -> AND-term of a split (see `query.canonical_terms()`)
+        self.weights = {}
+        for keyword, weight in (weights or {}).items():
+            phrases = " OR ".join(f'"{kw.strip()}"' for kw in keyword.split("||"))
+            term, = canonical_terms(f"({phrases})")
+            self.weights[term] = self.weights.get(term, 1) * weight
+
+    def weight(self, split: str) -> float:
+        """ Product of the weights of the key-words of `split`. """
+        if not self.weights:
+            return 1
+        members = unbatch(split) or [split]
+        weights = []
+        for member in members:
+            weight = 1
+            for term in canonical_terms(member):
+                weight *= self.weights.get(term, 1)
+            weights.append(weight)
+        return max(weights)
+
+    def expected_yield(self, num_results: int, split: str) -> int:
+        """ Number of results of `split` that aren't in `self.index` yet. """
+        if self.index is None:
+            return num_results
+        members = unbatch(split) or [split]
+        known = sum(self.index.count(m) for m in members)
+        return max(num_results - known, 0)
+
+    def _key(self, entry: tuple):
+        num_results, pages, split, parts = entry
+        if self.priority == "smallest":
+            return pages
+        if self.priority == "weights":
+            return -self.weight(split)
+        if self.priority == "yield":
+            if parts:  # Refined splits only download their parts
+                num_results = sum(n for n, _ in parts if n is not None)
+            return -self.expected_yield(num_results, split) / pages
+        return 0
+
+    def schedule(self, plan: list, completed=(), budget: int = None) -> tuple[list, list]:
+        """ Split `plan` into the entries to download now and the deferred ones.
+
+        Entries are taken in priority order while they fit in the budget. An entry that
+        doesn't fit is deferred, and smaller ones after it may still be scheduled, so
+        the budget is used up. Entries with no pages (excluded or empty splits) are
+        always scheduled, so they're reported by `Collector.search()`.
+
+        `plan`: list returned by `Collector.plan()`.
+        `completed`: splits already downloaded (e.g. `RunJournal.completed`), which
+        cost nothing.
+        `budget`: budget of this call instead of `self.budget`, e.g. capped by the
+        remaining quota of the API key.
+
+        Returns `(scheduled, deferred)`: the scheduled entries in priority order, to be
+        passed as `plan` to `Collector.search()`, and the deferred ones in plan order.
+        Deferred entries can be downloaded by a later run, e.g. with `resume=True`.
+        """
+        budget = self.budget if budget is None else budget
+        free = [e for e in plan if not e[1] or e[2] in completed]
+        downloads = [e for e in plan if e[1] and e[2] not in completed]
+        downloads.sort(key=self._key)  # Stable: ties keep the order of the plan
+        scheduled = []
+        deferred = set()
+        spent = 0
+        for entry in downloads:
+            pages = entry[1]
+            if budget is None or spent + pages <= budget:
+                scheduled.append(entry)
+                spent += pages
+            else:
+                deferred.add(entry[2])
+        self.spent = spent
+        return free + scheduled, [e for e in plan if e[2] in deferred]
@@ -0,0 +1,355 @@
+""" Screening pipeline: the stages deciding which search results are kept.
+
+A `Pipeline` runs a list of stages over chunks of search results:
+
+    pipeline = Pipeline(default_stages(criteria=[YearRange(2015, 2024), KeywordExclusion(["survey"])]))
+    for chunk, screened, decisions in pipeline.run(chunks):
+        ...
+
+Filters remove rows and record why (their `decision`); column stages (`DropColumns`)
+shape the kept rows. Consecutive row-local filters are fused: they are evaluated on the
+same rows in a single pass, and the chunk is copied once, after all of them. With
+`processes > 1`, fused filters run on a process pool, several chunks at a time, while
+stateful filters (e.g. `Dedup`) run in order in the calling process.
+"""
+import multiprocessing
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from prisma_automator.dedup import Deduplicator, normalize_column
+
+# Columns dropped by `Collector.screen()`.
+COLUMNS_TO_DROP = ["eid", "pii", "pubmed_id", "subtype", "afid", "affilname", "affiliation_city", "affiliation_country",
+                   "author_count", "author_ids", "author_afids", "coverDisplayDate", "issn", "source_id",
+                   "eIssn", "publicationName", "aggregationType", "article_number", "fund_acr", "fund_no", "fund_sponsor"]
+
+
+class Stage:
+    """ A filter of the screening pipeline. Subclasses implement `keep()`.
+
+    `decision`: screening decision of the rows the stage removes (see `SeenIndex`).
+    `row_local`: whether every row is kept or removed on its own. Row-local filters are
+    fused and may run in other processes, so they must be picklable and must not keep
+    state across chunks; other filters run in order, in the calling process.
+    `columns`: columns read by the stage, the only ones sent to other processes. If
+    None, every column is sent.
+    """
+    decision = "excluded"
+    row_local = True
+    columns = None
+    filters = True  # False for stages changing the columns instead of the rows
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        """ Boolean mask of the rows of `df` to keep. """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.decision})"
+
+
+class Filter(Stage):
+    def __init__(self, func, decision: str, columns: list = None, row_local: bool = True):
+        """ User-defined filter: `func(df)` returns a boolean mask (array or Series) of
+        the rows of `df` to keep, e.g.:
+
+            def cited(df):
+                return df.citedby_count.fillna(0).astype(int) >= 5
+
+            Filter(cited, "rarely cited", columns=["citedby_count"])
+
+        `func` must be a module-level function to run on a process pool.
+        """
+        self.func = func
+        self.decision = decision
+        self.columns = columns
+        self.row_local = row_local
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        return np.asarray(self.func(df), dtype=bool)
+
+
+class Dedup(Stage):
+    """ Removes duplicates with a `Deduplicator`, which remembers the rows kept from
+    earlier chunks (so it isn't row-local).
+    """
+    decision = "duplicate"
+    row_local = False
+
+    def __init__(self, dedup: Deduplicator = None):
+        self.dedup = dedup if dedup is not None else Deduplicator()
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        return ~self.dedup.duplicated(df)
+
+
+class DocumentType(Stage):
+    columns = ["subtypeDescription"]
+
+    def __init__(self, exclude: list = ("Conference Review",), include: list = None):
+        """ Removes documents by type (the `subtypeDescription` field, e.g. "Article",
+        "Review", "Conference Paper", "Conference Review").
+
+        `exclude`: document types to remove.
+        `include`: if given, only these document types are kept, and `exclude` is ignored.
+        """
+        self.exclude = list(exclude)
+        self.include = list(include) if include is not None else None
+        self.decision = "document type" if include is not None else "; ".join(self.exclude).lower()
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        types = df["subtypeDescription"]
+        if self.include is not None:
+            return types.isin(self.include).values
+        return ~types.isin(self.exclude).values
+
+
+class RequireDoi(Stage):
+    """ Removes rows without a doi. """
+    decision = "no doi"
+    columns = ["doi"]
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        return df["doi"].fillna("").astype(bool).values
+
+
+class YearRange(Stage):
+    decision = "out of year range"
+    columns = ["coverDate"]
+
+    def __init__(self, first: int = None, last: int = None):
+        """ Keeps the papers published from year `first` to year `last` (both included),
+        by their `coverDate`. Either bound may be None. Papers without a date are removed.
+        """
+        self.first = first
+        self.last = last
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        years = pd.to_numeric(df["coverDate"].astype(str).str[:4], errors="coerce")
+        keep = years.notna()
+        if self.first is not None:
+            keep &= years >= self.first
+        if self.last is not None:
+            keep &= years <= self.last
+        return keep.values
+
+
+class Language(Stage):
+    decision = "language"
+
+    def __init__(self, languages: list, column: str = "language"):
+        """ Keeps the papers written in one of `languages` (case ignored). Papers in
+        several languages (e.g. "English; Spanish") are kept if any of them matches.
+
+        Scopus search results have no language field: use `LANGUAGE(english)` in the
+        query to filter at the source, and this stage for records with a `column`
+        holding the language (e.g. merged from the Abstract Retrieval API).
+        """
+        self.languages = {language.lower() for language in languages}
+        self.column = column
+        self.columns = [column]
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        if self.column not in df:
+            raise ValueError(f"The records have no {self.column} column to screen by language.")
+        return np.array([bool(self.languages & {part.strip().lower() for part in str(value).split(";")})
+                         for value in df[self.column].fillna("").tolist()], dtype=bool)
+
+
+class KeywordExclusion(Stage):
+    decision = "excluded keyword"
+
+    def __init__(self, keywords: list, fields: list = ("title", "description", "authkeywords")):
+        """ Removes the papers mentioning any of `keywords` in `fields`. Key-words are
+        matched as whole phrases, ignoring case and punctuation, as Scopus does. Fields
+        missing from the records (e.g. abstracts without subscriber access) are skipped.
+        """
+        phrases = normalize_column(pd.Series(list(keywords), dtype=object))
+        phrases = [phrase for phrase in phrases if phrase]
+        if not phrases:
+            raise ValueError("KeywordExclusion needs at least one key-word.")
+        self.keywords = list(keywords)
+        self.columns = list(fields)
+        self.pattern = re.compile(" (?:" + "|".join(re.escape(p) for p in phrases) + ") ")
+
+    def keep(self, df: pd.DataFrame) -> np.ndarray:
+        keep = np.ones(len(df), dtype=bool)
+        for field in self.columns:
+            if field in df:
+                texts = " " + normalize_column(df[field]) + " "
+                keep &= ~texts.str.contains(self.pattern).values
+        return keep
+
+
+class DropColumns(Stage):
+    filters = False
+
+    def __init__(self, columns: list = COLUMNS_TO_DROP, fields: list = None):
+        """ Drops `columns` from the kept rows. If `fields` is given, only the "splits"
+        column and these fields are kept instead (see `Collector.search()`).
+
+        Column stages run after every filter, so filters can read any column.
+        """
+        self.drop = list(columns)
+        self.fields = list(fields) if fields is not None else None
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        if self.fields is not None:
+            return df[[c for c in ["splits", *self.fields] if c in df]]
+        return df.drop(columns=self.drop, errors="ignore")
+
+    def __repr__(self):
+        return "DropColumns()"
+
+
+def default_stages(dedup: Deduplicator = None, fields: list = None, criteria: list = ()) -> list:
+    """ The stages of `Collector.screen()`: duplicates, conference reviews and rows
+    without a doi are removed, then the `criteria` stages are applied, and
+    `COLUMNS_TO_DROP` (or all but `fields`) are dropped.
+    """
+    return [Dedup(dedup), DocumentType(), RequireDoi(), *criteria, DropColumns(fields=fields)]
+
+
+def evaluate(stages: list, df: pd.DataFrame) -> tuple[np.ndarray, list]:
+    """ Fused pass of the filters `stages` over `df`. Every filter reads all rows, and a
+    row is removed by the first filter rejecting it.
+
+    Returns the position in `stages` of the filter removing each row (-1 if kept), and
+    the seconds spent in each filter.
+    """
+    removed_by = np.full(len(df), -1, dtype=np.int16)
+    seconds = []
+    for i, stage in enumerate(stages):
+        start = time.perf_counter()
+        keep = np.asarray(stage.keep(df), dtype=bool)
+        removed_by[(removed_by < 0) & ~keep] = i
+        seconds.append(time.perf_counter() - start)
+    return removed_by, seconds
+
+
+class Pipeline:
+    def __init__(self, stages: list = None, processes: int = 1):
+        """ Screening pipeline running `stages` (see `default_stages()`) in order.
+
+        `processes`: if over 1, fused row-local filters run on a pool of this many
+        processes. Worth it for expensive filters (e.g. `KeywordExclusion` over
+        abstracts) on large corpora: chunks are sent to the workers, which takes time too.
+
+        Row counts and timings of every stage add up over the runs of the pipeline; see
+        `report()`.
+        """
+        stages = default_stages() if stages is None else list(stages)
+        self.filters = [s for s in stages if s.filters]
+        self.transforms = [s for s in stages if not s.filters]
+        self.processes = processes
+        self.rows = 0  # Rows screened
+        self._stats = np.zeros((len(self.filters), 2))  # Rows removed and seconds per filter
+        self._transform_seconds = [0.0] * len(self.transforms)
+        self._labels = np.array(["included"] + [s.decision for s in self.filters], dtype=object)
+
+    @property
+    def dedup(self) -> Deduplicator:
+        """ The `Deduplicator` of the first `Dedup` stage, or None. """
+        for stage in self.filters:
+            if isinstance(stage, Dedup):
+                return stage.dedup
+        return None
+
+    def segments(self) -> list:
+        """ The filters in `(offset, stages)` segments: consecutive row-local filters are
+        fused in one segment, and every other filter is a segment of its own.
+        """
+        segments = []
+        for i, stage in enumerate(self.filters):
+            if stage.row_local and segments and all(s.row_local for s in segments[-1][1]):
+                segments[-1][1].append(stage)
+            else:
+                segments.append((i, [stage]))
+        return segments
+
+    def _run_segment(self, offset: int, stages: list, items, executor):
+        """ Apply a segment to `(chunk, removed_by)` items, in order. Only the rows not
+        removed by earlier segments are evaluated.
+        """
+        parallel = executor is not None and all(s.row_local for s in stages)
+        columns = None
+        if all(s.columns is not None for s in stages):
+            columns = list(dict.fromkeys(c for s in stages for c in s.columns))
+        pending = deque()
+        for chunk, removed_by in items:
+            alive = np.flatnonzero(removed_by < 0)
+            if not len(alive):
+                # Nothing left to screen, e.g. a search without results
+                yield chunk, removed_by
+                continue
+            if not parallel:
+                df = chunk if len(alive) == len(chunk) else chunk.iloc[alive]
+                yield self._merge(offset, chunk, removed_by, alive, *evaluate(stages, df))
+                continue
+            # Only the rows and columns the filters read are sent to the workers
+            positions = slice(None) if columns is None else [
+                chunk.columns.get_loc(c) for c in columns if c in chunk]
+            df = chunk.iloc[alive, positions]
+            pending.append((chunk, removed_by, alive, executor.submit(evaluate, stages, df)))
+            if len(pending) >= 2 * self.processes:
+                chunk, removed_by, alive, future = pending.popleft()
+                yield self._merge(offset, chunk, removed_by, alive, *future.result())
+        while pending:
+            chunk, removed_by, alive, future = pending.popleft()
+            yield self._merge(offset, chunk, removed_by, alive, *future.result())
+
+    def _merge(self, offset: int, chunk: pd.DataFrame, removed_by: np.ndarray, alive: np.ndarray,
+               segment_removed_by: np.ndarray, seconds: list) -> tuple:
+        removed = segment_removed_by >= 0
+        removed_by[alive[removed]] = segment_removed_by[removed] + offset
+        counts = np.bincount(segment_removed_by[removed], minlength=len(seconds))
+        self._stats[offset:offset + len(seconds), 0] += counts
+        self._stats[offset:offset + len(seconds), 1] += seconds
+        return chunk, removed_by
+
+    def run(self, chunks):
+        """ Screen an iterable of DataFrame chunks, in order.
+
+        Yields `(chunk, screened, decisions)` for every chunk: the chunk, its screened
+        rows, and the screening decision of each of its rows ("included", or the
+        `decision` of the filter removing it).
+        """
+        items = ((chunk, np.full(len(chunk), -1, dtype=np.int16)) for chunk in chunks)
+        executor = None
+        if self.processes > 1 and any(s.row_local for s in self.filters):
+            executor = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            for offset, stages in self.segments():
+                items = self._run_segment(offset, stages, items, executor)
+            for chunk, removed_by in items:
+                self.rows += len(chunk)
+                kept = removed_by < 0
+                screened = chunk if kept.all() else chunk[kept]
+                for i, stage in enumerate(self.transforms):
+                    start = time.perf_counter()
+                    screened = stage.transform(screened)
+                    self._transform_seconds[i] += time.perf_counter() - start
+                decisions = pd.Series(self._labels[removed_by + 1], index=chunk.index, dtype=object)
+                yield chunk, screened, decisions
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def report(self) -> pd.DataFrame:
+        """ Rows entering, removed by and leaving every stage, and its time in seconds,
+        in order: the screening counts of the PRISMA flow diagram.
+        """
+        rows = []
+        remaining = self.rows
+        for stage, (removed, seconds) in zip(self.filters, self._stats):
+            rows.append((repr(stage), stage.decision, remaining, int(removed),
+                         remaining - int(removed), round(seconds, 6)))
+            remaining -= int(removed)
+        for stage, seconds in zip(self.transforms, self._transform_seconds):
+            rows.append((repr(stage), None, remaining, 0, remaining, round(seconds, 6)))
+        return pd.DataFrame(rows, columns=["stage", "decision", "rows_in", "removed", "rows_out", "seconds"])
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from prisma_automator.dedup import normalize_column, normalize_doi
+
+# Maximum number of parameters of a single SQLite query.
+MAX_PARAMS = 500
+
+
+def title_hash(title: str) -> str:
+    """ Hash of a normalized title and abstract (see `dedup.normalize_column()`), stable
+    across runs.
+    """
+    return hashlib.sha1(title.encode("utf8")).hexdigest()[:16] if title else ""
+
+
+class SeenIndex:
+    def __init__(self, path: str = "./out/seen.sqlite"):
+        """ Persistent index of the records screened by earlier runs, for living reviews.
+
+        Every screened record is stored with its EID, DOI, hash of its normalized title
+        and abstract, and screening decision ("included", "duplicate", "conference
+        review" or "no doi"). A record is seen if any of these identifiers matches, so a
+        paper whose EID or DOI changed between runs is still recognized by its text.
+        Titles alone are too ambiguous ("Editorial", "Preface"): rows without an abstract
+        are only matched by their title if they have no EID and no DOI either.
+
+        `path`: path to the SQLite file.
+
+        Records added during a run are only saved by `commit()`, so a run that dies
+        before exporting its results screens the same records again next time.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._con = sqlite3.connect(path)
+        self._con.execute("""CREATE TABLE IF NOT EXISTS records (
+            eid TEXT, doi TEXT, title TEXT, decision TEXT, run INTEGER)""")
+        for column in ("eid", "doi", "title"):
+            self._con.execute(
+                f"CREATE INDEX IF NOT EXISTS records_{column} ON records ({column})")
+        self._con.commit()
+        # Number of this run: one more than the last committed run
+        self.run = self._con.execute(
+            "SELECT COALESCE(MAX(run), 0) FROM records").fetchone()[0] + 1
+
+    @staticmethod
+    def identifiers(df: pd.DataFrame) -> pd.DataFrame:
+        """ EID, normalized DOI and hash of the normalized title and abstract (the
+        "title" column) of every row of `df`. Missing identifiers are empty strings.
+        """
+        empty = pd.Series("", index=df.index, dtype=object)
+        eids = df['eid'].fillna("").astype(str) if 'eid' in df else empty
+        dois = normalize_doi(df['doi']) if 'doi' in df else empty
+        titles = normalize_column(df['title']) if 'title' in df else empty
+        abstracts = normalize_column(df['description']) if 'description' in df else empty
+        texts = (titles + " " + abstracts).str.strip()
+        texts[(abstracts == "") & ((eids != "") | (dois != ""))] = ""
+        return pd.DataFrame({'eid': eids, 'doi': dois, 'title': texts.map(title_hash)})
+
+    def _known(self, column: str, values) -> set:
+        """ The `values` of `column` recorded by earlier runs. """
+        values = list({v for v in values if v})
+        known = set()
+        for i in range(0, len(values), MAX_PARAMS):
+            batch = values[i:i + MAX_PARAMS]
+            rows = self._con.execute(
+                f"SELECT {column} FROM records WHERE run < ? AND {column} IN ({','.join('?' * len(batch))})",
+                [self.run, *batch])
+            known.update(row[0] for row in rows)
+        return known
+
+    def unseen(self, df: pd.DataFrame) -> np.ndarray:
+        """ Boolean mask of the rows of `df` that match no record of an earlier run.
+
+        Records added by this run don't count: a paper found again in a later chunk is
+        left to the `Deduplicator`, and counted as a duplicate.
+        """
+        ids = self.identifiers(df)
+        seen = np.zeros(len(df), dtype=bool)
+        for column in ids:
+            seen |= ids[column].isin(self._known(column, ids[column])).values
+        return ~seen
+
+    def add(self, df: pd.DataFrame, decisions: pd.Series):
+        """ Add the rows of `df` with their screening `decisions` (indexed like `df`). """
+        ids = self.identifiers(df)
+        self._con.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?)", zip(
+            ids['eid'], ids['doi'], ids['title'], decisions.loc[df.index], [self.run] * len(df)))
+
+    def stats(self) -> dict:
+        """ Number of records per screening decision, over all runs. """
+        rows = self._con.execute(
+            "SELECT decision, COUNT(*) FROM records GROUP BY decision")
+        return dict(rows.fetchall())
+
+    def __len__(self):
+        return self._con.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def commit(self):
+        self._con.commit()
+
+    def close(self):
+        self._con.close()
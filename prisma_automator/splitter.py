@@ -1,9 +1,16 @@
+from prisma_automator.query import canonical_split
+from prisma_automator.telemetry import Telemetry
 from prisma_automator.utility import save_to_file
 from itertools import product
 
 class Splitter:
-    def __init__(self):
+    def __init__(self, telemetry: Telemetry = None):
+        """ `telemetry`: `Telemetry` receiving the timings of `split()`, e.g. the one of
+        the `Collector` searching the splits, so they're part of its run summary.
+        """
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
         self.kw_groups = []
+        self.aliases = {}  # Kept split -> all generated splits with the same canonical form
 
     def add_kwgroup(self, kw_group: list[str]):
         self.kw_groups.append(kw_group)
@@ -79,63 +86,124 @@ class Splitter:
         if not temp_combination:
             return combinations
 
+    def iter_combinations(self):
+        """ Lazily yield all possible key-word combinations, in the same order as `generate_combinations()`.
+
+        Combinations are built iteratively with `itertools.product`, so there's no
+        recursion-depth limit and only one combination is held in memory at a time.
+        Skipped key-words are replaced by `'#'` as in `generate_kwgraph()`.
+        """
+        groups = list()
+        num_skips = 0
+        for kw_g in self.kw_groups:
+            if '' in kw_g:
+                num_skips += 1
+                kw_g = ['#'*num_skips if x == '' else x for x in kw_g]
+            groups.append(kw_g)
+        for combination in product(*groups):
+            yield list(combination)
+
+    def parse_combination(self, combination: list) -> str:
+        """ Parse a single key-word combination into a split with logical operators
+
+        `combination`: list of key-words
+        """
+        temp_split = ""
+        for kw in combination:
+            if '#' not in kw:  # When the kw has '#', it is skipped.
+                if '||' in kw:  # kw contains OR operator. Apply different parsing.
+                    temp_kw = kw.split("||")
+                    temp_kw = [t_kw.strip() for t_kw in temp_kw]
+                    # First t_kw must not have OR
+                    kw = f"\"{temp_kw[0]}\""
+                    for t_kw in temp_kw[1:]:
+                        kw += f" OR \"{t_kw}\""
+                    if temp_split:
+                        temp_split += f" AND ({kw})"
+                    else:  # First kw of the split
+                        temp_split += f"({kw})"
+                else:
+                    if temp_split:
+                        temp_split += f" AND \"{kw}\""
+                    else:  # First kw of the split
+                        temp_split += f"\"{kw}\""
+        return temp_split
+
     def parse_combinations(self, combinations: list) -> list:
         """ Parse combinations and return a list of splits with logical operators
 
         `combinations`: list of key-word combinations
         """
-        splits = list()
-        for c in combinations:
-            temp_split = ""
-            for kw in c:
-                if '#' not in kw:  # When the kw has '#', it is skipped.
-                    if '||' in kw:  # kw contains OR operator. Apply different parsing.
-                        temp_kw = kw.split("||")
-                        temp_kw = [t_kw.strip() for t_kw in temp_kw]
-                        # First t_kw must not have OR
-                        kw = f"\"{temp_kw[0]}\""
-                        for t_kw in temp_kw[1:]:
-                            kw += f" OR \"{t_kw}\""
-                        if temp_split:
-                            temp_split += f" AND ({kw})"
-                        else:  # First kw of the split
-                            temp_split += f"({kw})"
-                    else:
-                        if temp_split:
-                            temp_split += f" AND \"{kw}\""
-                        else:  # First kw of the split
-                            temp_split += f"\"{kw}\""
-            splits.append(temp_split)
-        return splits
+        return [self.parse_combination(c) for c in combinations]
 
-    def split(self, log: bool = True, save_to: str = "./out/splits.txt") -> list:
-        """ Generate split strings by combining the key-words in `kw_groups`.
+    def iter_splits(self):
+        """ Lazily yield the split strings of all key-word combinations.
 
-        `log`: if True, prints logs.
-        `save_to`: path to the file in which the splits will be written. If `""`, doesn't save a file.
+        Memory use is constant regardless of the number of combinations, so the
+        generator can be passed directly to `save_to_file()` or `Collector.search()`.
         """
+        for combination in self.iter_combinations():
+            yield self.parse_combination(combination)
 
-        if log:
-            print("[#] Generating adjacency list... ")
+    def deduplicate(self, splits) -> list:
+        """ Drop splits that are the same Scopus query as an earlier one.
 
-        # Generate adjacency list as a Python dict
-        graph = self.generate_kwgraph()
+        Splits are compared by their canonical form (see `query.canonical_split()`):
+        case, whitespace, the order of AND/OR terms and repeated terms are ignored.
+        The first split of every canonical form is kept, and `self.aliases` maps it to
+        all the splits it stands for, so results can be attributed to each of them.
 
-        temp_combination = list()  # List as a Stack to build kw combinations
-        combinations = list()  # List of kw combinations
+        `splits`: list (or any iterable) of splits.
+        """
+        kept = dict()  # Canonical form -> kept split
+        self.aliases = dict()
+        unique = list()
+        for s in splits:
+            canonical = canonical_split(s)
+            if canonical in kept:
+                self.aliases[kept[canonical]].append(s)
+            else:
+                kept[canonical] = s
+                self.aliases[s] = [s]
+                unique.append(s)
+        return unique
+
+    def originals(self, split: str) -> list:
+        """ All generated splits that `split` stands for after `deduplicate()`. """
+        return self.aliases.get(split, [split])
+
+    def num_splits(self) -> int:
+        """ Number of splits generated from `kw_groups`, without generating them. """
+        num = 1
+        for kw_g in self.kw_groups:
+            num *= len(kw_g)
+        return num
 
-        if log:
-            print("[#] Generating key-word combinations... ")
+    def split(self, log: bool = True, save_to: str = "./out/splits.txt", dedup: bool = True) -> list:
+        """ Generate split strings by combining the key-words in `kw_groups`.
+
+        `log`: if True, prints logs.
+        `save_to`: path to the file in which the splits will be written. If `""`, doesn't save a file.
+        `dedup`: if True, splits that are the same Scopus query as an earlier split are
+        dropped (see `deduplicate()`).
 
-        # Generate all possible key-word combinations
-        combinations = self.generate_combinations(
-            temp_combination, combinations, graph, '')
+        Returns a list of splits. Use `iter_splits()` to generate them lazily instead.
+        """
 
         if log:
             print("[#] Generating splits... ")
 
         # Generate splits (search strings) from key-word combinations
-        splits = self.parse_combinations(combinations)
+        with self.telemetry.span("generate_splits"):
+            splits = list(self.iter_splits())
+
+        if dedup:
+            num_generated = len(splits)
+            with self.telemetry.span("deduplicate"):
+                splits = self.deduplicate(splits)
+            if log:
+                print(
+                    f"[#] Removed {num_generated - len(splits)} duplicate splits ({num_generated - len(splits)} requests saved).")
 
         if log:
             print("[$] Success! Total number of splits: " + str(len(splits)))
@@ -0,0 +1,106 @@
+from array import array
+
+from prisma_automator.accumulator import ResultAccumulator
+from prisma_automator.utility import record_to_dict
+
+
+def record_key(record: dict) -> str:
+    """ Identity of a paper: its EID, else its lowercase DOI, else its lowercase title. """
+    if record.get("eid"):
+        return record["eid"]
+    if record.get("doi"):
+        return "doi:" + record["doi"].lower()
+    return "title:" + " ".join(str(record.get("title") or "").split()).lower()
+
+
+class RecordStore:
+    def __init__(self, accumulator: ResultAccumulator = None):
+        """ Holds every paper exactly once, with the list of splits that found it.
+
+        Papers are identified by `record_key()`. The first time a paper is found, its
+        record is appended to `accumulator` (with the split that found it in the
+        "splits" column). Every later match only adds the split's id to the paper's
+        membership array, so a paper matching dozens of splits is stored once.
+
+        `accumulator`: where the unique records are streamed. Defaults to an in-memory
+        `ResultAccumulator`.
+
+        The store can be used wherever a `ResultAccumulator` is expected.
+        """
+        self.accumulator = accumulator if accumulator is not None else ResultAccumulator()
+        self.splits = []  # Split id -> split
+        self._split_ids = {}  # Split -> split id
+        self._rows = {}  # Paper key (and DOI) -> row
+        self._membership = []  # Row -> array of split ids
+
+    def split_id(self, split: str) -> int:
+        if split not in self._split_ids:
+            self._split_ids[split] = len(self.splits)
+            self.splits.append(split)
+        return self._split_ids[split]
+
+    def append(self, split: str, records: list):
+        """ Add the `records` found by `split`. Returns the number of new papers. """
+        sid = self.split_id(split)
+        new = []
+        for record in records:
+            record = record_to_dict(record)
+            key = record_key(record)
+            row = self._rows.get(key)
+            if row is None and record.get("doi"):
+                row = self._rows.get("doi:" + record["doi"].lower())
+            if row is None:
+                row = len(self._membership)
+                self._rows[key] = row
+                if record.get("doi"):
+                    self._rows["doi:" + record["doi"].lower()] = row
+                self._membership.append(array('I', [sid]))
+                new.append(record)
+            elif self._membership[row][-1] != sid:  # Ignore repeats within a split
+                self._membership[row].append(sid)
+        self.accumulator.append(split, new)
+        return len(new)
+
+    def splits_for(self, key: str) -> list:
+        """ Splits that found the paper with EID (or DOI) `key`. """
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows.get("doi:" + key.lower())
+        if row is None:
+            return []
+        return [self.splits[sid] for sid in self._membership[row]]
+
+    def yield_per_split(self) -> dict:
+        """ Number of distinct papers found by each split. """
+        counts = [0] * len(self.splits)
+        for sids in self._membership:
+            for sid in sids:
+                counts[sid] += 1
+        return dict(zip(self.splits, counts))
+
+    def unique_yield(self) -> dict:
+        """ Number of papers found by each split and by no other split: the papers that
+        would be lost if the split were dropped.
+        """
+        counts = [0] * len(self.splits)
+        for sids in self._membership:
+            if len(sids) == 1:
+                counts[sids[0]] += 1
+        return dict(zip(self.splits, counts))
+
+    def yield_stats(self) -> list:
+        """ `(num_papers, unique_papers, split)` tuples of every split, in the order in
+        which the splits were added.
+        """
+        total = self.yield_per_split()
+        unique = self.unique_yield()
+        return [(total[s], unique[s], s) for s in self.splits]
+
+    def iter_chunks(self):
+        return self.accumulator.iter_chunks()
+
+    def to_frame(self):
+        return self.accumulator.to_frame()
+
+    def __len__(self):
+        return len(self._membership)
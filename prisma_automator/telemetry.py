@@ -0,0 +1,179 @@
+import io
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Telemetry:
+    def __init__(self, path: str = None, profile: bool = False, trace_memory: bool = False):
+        """ Structured events and metrics of a collection run.
+
+        Every event is a JSON object with a timestamp ("ts") and a name ("event"),
+        written as a line of `path` as soon as it happens, so a run can be followed
+        with `tail -f` and analyzed afterwards. Metrics are also aggregated in memory
+        and returned by `summary()`:
+        - counters (`count()`), e.g. requests, retries, throttled requests, cache hits;
+        - gauges (`gauge()`), e.g. the remaining API quota;
+        - timings of spans (`span()`): count, total, mean and max seconds.
+
+        `path`: path to the JSON lines file. If None, events are only aggregated.
+        `profile`: if True, run cProfile between `start()` and `stop()`. Only the thread
+        calling `start()` is profiled; search workers mostly wait on the network anyway.
+        `trace_memory`: if True, run tracemalloc between `start()` and `stop()`.
+
+        Telemetry is thread-safe: workers of a `Collector` share one instance.
+        """
+        self.path = None
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}  # Span name -> [count, total seconds, max seconds]
+        self._file = None
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._profile_stats = None
+        self._memory = None
+        self._started = None
+        if path:
+            self.open(path)
+
+    def open(self, path: str):
+        """ Write the events to `path` from now on. """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self._file is not None:
+            self._file.close()
+        self.path = path
+        self._file = open(path, "a", encoding="utf8")
+
+    def event(self, name: str, **fields):
+        """ Emit an event with arbitrary JSON-serializable `fields`. """
+        if self._file is None:
+            return
+        line = json.dumps({"ts": round(time.time(), 6), "event": name, **fields},
+                          default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def time(self, name: str, seconds: float):
+        """ Add a measured duration to the timings of `name`. """
+        with self._lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def span(self, name: str, **fields):
+        """ Time the enclosed block. The duration is added to the timings of `name`, and
+        an event with `fields` and the duration is emitted if `fields` are given (e.g.
+        the split of a request), so hot loops only pay for the aggregation.
+        """
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            seconds = time.perf_counter() - start
+            self.time(name, seconds)
+            if fields:
+                self.event(name, seconds=round(seconds, 6), **fields)
+
+    def start(self):
+        """ Start the run's clock and the opt-in profilers. Calling it again, e.g. from
+        `Collector.run()` after the splits were generated, keeps the first start time.
+        """
+        if self._started is None:
+            self._started = time.perf_counter()
+            self.event("start")
+        if self.profile and self._profiler is None:
+            import cProfile  # Only imported when profiling, so the CLI starts fast
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def stop(self):
+        """ Stop the profilers, keeping their results for `summary()`. The profile is
+        saved next to the events file (`.prof`, readable with `pstats` or snakeviz).
+        """
+        if self._profiler is not None:
+            import pstats
+            self._profiler.disable()
+            self._profile_stats = pstats.Stats(self._profiler)
+            if self.path:
+                self._profile_stats.dump_stats(
+                    os.path.splitext(self.path)[0] + ".prof")
+            self._profiler = None
+        if self.trace_memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self._memory = {"peak_bytes": peak, "top": [
+                    {"where": str(stat.traceback), "bytes": stat.size}
+                    for stat in snapshot.statistics("lineno")[:10]]}
+
+    def summary(self) -> dict:
+        """ Aggregated metrics of the run so far. """
+        with self._lock:
+            summary = {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {name: {"count": n, "total": round(total, 6),
+                                   "mean": round(total / n, 6), "max": round(peak, 6)}
+                            for name, (n, total, peak) in self.timings.items()},
+            }
+        if self._started is not None:
+            summary["seconds"] = round(time.perf_counter() - self._started, 6)
+        if self._profile_stats is not None:
+            stream = io.StringIO()
+            self._profile_stats.stream = stream
+            self._profile_stats.sort_stats("cumulative").print_stats(15)
+            summary["profile"] = stream.getvalue()
+        if self._memory is not None:
+            summary["memory"] = self._memory
+        return summary
+
+    def report(self, log: bool = True) -> dict:
+        """ Stop the profilers, emit the summary as a "summary" event and print it. """
+        self.stop()
+        summary = self.summary()
+        self.event("summary", **summary)
+        if log:
+            if "seconds" in summary:
+                print(f"[#] Run took {summary['seconds']:.1f}s.")
+            for name, timing in sorted(summary["timings"].items(), key=lambda t: -t[1]["total"]):
+                print(f"[#] {name}: {timing['total']:.3f}s in {timing['count']} calls "
+                      f"(mean {timing['mean']:.4f}s, max {timing['max']:.4f}s).")
+            for name, value in sorted(summary["counters"].items()):
+                print(f"[#] {name}: {value}")
+            for name, value in sorted(summary["gauges"].items()):
+                print(f"[#] {name}: {value}")
+            if "memory" in summary:
+                print(
+                    f"[#] Peak traced memory: {summary['memory']['peak_bytes'] / 1024**2:.1f} MB.")
+            if "profile" in summary:
+                print(summary["profile"])
+            if self.path:
+                print(f"[/] Telemetry saved to: {self.path}")
+        return summary
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,14 +1,19 @@
+import csv
 import os
 
 def save_to_file_advanced(file_path: str, header: str, lines_to_write: list[tuple[str]], separator: str = ""):
+    """ Write `header`, then every tuple of `lines_to_write` as a line of columns joined by
+    `separator`. Columns containing the separator, quotes or line breaks are quoted, so
+    the file can be read by any CSV reader.
+    """
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "w") as f:
+    with open(file_path, "w", newline="") as f:
         f.write(header + "\n")  # Write the header first
-        for l in lines_to_write:  # then write every line
-            full_line = ""
-            for column in l:  # append columns to the full line
-                full_line += f"{column}{separator}"
-            f.write(full_line + "\n")
+        if separator:  # then write every line
+            csv.writer(f, delimiter=separator,
+                       lineterminator="\n").writerows(lines_to_write)
+        else:
+            f.writelines("".join(map(str, l)) + "\n" for l in lines_to_write)
 
 
 def save_to_file(file_path: str, lines_to_write: list[str]):
@@ -16,3 +21,9 @@ def save_to_file(file_path: str, lines_to_write: list[str]):
     with open(file_path, "w") as f:
         for l in lines_to_write:
             f.write(l + "\n")
+
+
+def record_to_dict(record) -> dict:
+    """ Convert a search result (namedtuple or dict) to a JSON-serializable dict. """
+    return record._asdict() if hasattr(record, "_asdict") else dict(record)
+
@@ -0,0 +1,338 @@
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from functools import partial
+
+from prisma_automator.collector import Collector, scopus_search
+from prisma_automator.ratelimit import QuotaExhaustedError, TokenBucket
+from prisma_automator.store import RecordStore
+from prisma_automator.utility import record_to_dict
+
+# States of a task.
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+
+
+class WorkQueue:
+    def __init__(self, path: str = "./out/queue.sqlite", lease: float = 300, max_attempts: int = 3):
+        """ Durable queue of splits in a SQLite file, shared by worker processes, possibly
+        on several machines sharing the file system.
+
+        A worker `claim()`s splits, which are leased to it for `lease` seconds, and
+        `ack()`s each one with its results, or `fail()`s it. Splits whose lease expired
+        (e.g. the worker crashed) are claimed again by another worker, so every split
+        is eventually done, and results are stored in the same transaction as the ack,
+        so a split's results are stored once even if two workers ran it.
+
+        `path`: path to the SQLite file.
+        `lease`: seconds a claimed split is reserved for its worker. Use `extend()` for
+        splits that take longer.
+        `max_attempts`: number of claims of a split before it's marked as failed.
+
+        Every call opens its own transaction, so many processes can share the file. Use
+        a file system with working locks (most network file systems need them enabled).
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._con = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._con.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            split TEXT PRIMARY KEY, position INTEGER, state TEXT, worker TEXT,
+            leased_until REAL, attempts INTEGER, num_results INTEGER, records TEXT,
+            error TEXT)""")
+        self._con.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, position)")
+
+    def enqueue(self, splits) -> int:
+        """ Add `splits` after the splits already in the queue. Splits already in it are
+        ignored, so enqueueing the same splits again is safe. Returns the number added.
+        """
+        self._con.execute("BEGIN IMMEDIATE")
+        try:
+            position = self._con.execute(
+                "SELECT COALESCE(MAX(position), -1) + 1 FROM tasks").fetchone()[0]
+            added = 0
+            for split in splits:
+                cursor = self._con.execute(
+                    "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, NULL, NULL, 0, NULL, NULL, NULL)",
+                    (split, position + added, PENDING))
+                added += cursor.rowcount
+            self._con.execute("COMMIT")
+        except BaseException:
+            self._con.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self, worker: str, num: int = 1) -> list:
+        """ Lease up to `num` splits to `worker`, pending ones first, in queue order. """
+        now = time.time()
+        self._con.execute("BEGIN IMMEDIATE")
+        try:
+            # Splits claimed too many times are given up on
+            self._con.execute(
+                "UPDATE tasks SET state = ? WHERE state = ? AND leased_until < ? AND attempts >= ?",
+                (FAILED, CLAIMED, now, self.max_attempts))
+            rows = self._con.execute(
+                """SELECT split FROM tasks
+                WHERE state = ? OR (state = ? AND leased_until < ?)
+                ORDER BY state = ? DESC, position LIMIT ?""",
+                (PENDING, CLAIMED, now, PENDING, num)).fetchall()
+            splits = [row[0] for row in rows]
+            for split in splits:
+                self._con.execute(
+                    """UPDATE tasks SET state = ?, worker = ?, leased_until = ?,
+                    attempts = attempts + 1 WHERE split = ?""",
+                    (CLAIMED, worker, now + self.lease, split))
+            self._con.execute("COMMIT")
+        except BaseException:
+            self._con.execute("ROLLBACK")
+            raise
+        return splits
+
+    def extend(self, split: str, worker: str) -> bool:
+        """ Renew the lease of `split`. Returns False if `worker` lost it. """
+        cursor = self._con.execute(
+            "UPDATE tasks SET leased_until = ? WHERE split = ? AND worker = ? AND state = ?",
+            (time.time() + self.lease, split, worker, CLAIMED))
+        return cursor.rowcount == 1
+
+    def ack(self, split: str, worker: str, num_results, records: list = None) -> bool:
+        """ Mark `split` as done with its `num_results` (None if Scopus refused to count
+        it) and downloaded `records` (None if it wasn't downloaded).
+
+        Returns False if the split was already done, e.g. by a worker that took over an
+        expired lease, in which case these results are discarded.
+        """
+        text = None
+        if records is not None:
+            text = json.dumps([record_to_dict(r) for r in records],
+                              separators=(',', ':'))
+        cursor = self._con.execute(
+            """UPDATE tasks SET state = ?, worker = ?, num_results = ?, records = ?,
+            error = NULL WHERE split = ? AND state != ?""",
+            (DONE, worker, num_results, text, split, DONE))
+        return cursor.rowcount == 1
+
+    def fail(self, split: str, worker: str, error: str):
+        """ Release `split` after an error. It's retried by the next claim, unless it
+        was already claimed `max_attempts` times.
+        """
+        self._con.execute(
+            """UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+            leased_until = NULL, error = ? WHERE split = ? AND worker = ? AND state = ?""",
+            (self.max_attempts, FAILED, PENDING, error, split, worker, CLAIMED))
+
+    def release(self, split: str, worker: str):
+        """ Give `split` back without counting the attempt, e.g. when the worker's API
+        key ran out of quota.
+        """
+        self._con.execute(
+            """UPDATE tasks SET state = ?, leased_until = NULL, attempts = attempts - 1
+            WHERE split = ? AND worker = ? AND state = ?""",
+            (PENDING, split, worker, CLAIMED))
+
+    def stats(self) -> dict:
+        """ Number of splits in every state. """
+        counts = dict.fromkeys([PENDING, CLAIMED, DONE, FAILED], 0)
+        counts.update(self._con.execute(
+            "SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        return counts
+
+    def is_finished(self) -> bool:
+        """ Whether every split is done or failed. """
+        stats = self.stats()
+        return not stats[PENDING] and not stats[CLAIMED]
+
+    def failures(self) -> list:
+        """ `(split, error)` tuples of the failed splits. """
+        return self._con.execute(
+            "SELECT split, error FROM tasks WHERE state = ? ORDER BY position", (FAILED,)).fetchall()
+
+    def iter_results(self):
+        """ Yield `(split, num_results, records)` tuples of the done splits, in queue
+        order, where `records` is a list of dicts, or None if the split wasn't downloaded.
+        """
+        rows = self._con.execute(
+            "SELECT split, num_results, records FROM tasks WHERE state = ? ORDER BY position", (DONE,))
+        for split, num_results, text in rows:
+            yield split, num_results, json.loads(text) if text is not None else None
+
+    def close(self):
+        self._con.close()
+
+
+class Worker:
+    def __init__(self, queue: WorkQueue, backend=scopus_search, apikey: str = None, name: str = None,
+                 bucket: TokenBucket = None, **kwds):
+        """ Claims, searches and acks the splits of a `WorkQueue`.
+
+        `backend`: callable with the signature of pybliometrics' `ScopusSearch`.
+        `apikey`: API key of this worker. If None, pybliometrics' configured key is used.
+        `name`: name of the worker in the queue. Defaults to the host name and process id.
+        `bucket`: `TokenBucket` of this worker's key. Defaults to Scopus' 9 requests/s.
+        `kwds`: other arguments of the worker's `Collector`, e.g. `cache` or `telemetry`.
+        """
+        self.queue = queue
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        if apikey is not None:
+            backend = partial(backend, apikey=apikey)
+        self.collector = Collector(backend=backend, bucket=bucket, **kwds)
+
+    def process(self, split: str, subscriber: bool = False, threshold: int = 1000, fields: list = None):
+        """ Count `split` and download it if it has at most `threshold` results, like
+        `Collector.search()`. Returns `(num_results, records)`.
+        """
+        num_results = self.collector._count_one(split, subscriber)
+        if num_results is None or num_results > threshold or not num_results:
+            return num_results, None
+        return num_results, self.collector._download_one(split, subscriber, fields=fields, num_results=num_results)
+
+    def run(self, subscriber: bool = False, threshold: int = 1000, fields: list = None,
+            wait: bool = False, poll: float = 1.0, log: bool = True) -> int:
+        """ Process splits until the queue is empty. Returns the number of splits acked.
+
+        `wait`: if True, keep polling every `poll` seconds until every split is done
+        or failed, to take over the splits of workers that die.
+
+        The worker stops early when the quota of its key is exhausted, leaving the
+        remaining splits to the other workers.
+        """
+        acked = 0
+        while True:
+            claimed = self.queue.claim(self.name)
+            if not claimed:
+                if not wait or self.queue.is_finished():
+                    break
+                time.sleep(poll)
+                continue
+            split = claimed[0]
+            try:
+                num_results, records = self.process(
+                    split, subscriber, threshold, fields)
+            except QuotaExhaustedError:
+                self.queue.release(split, self.name)
+                if log:
+                    print(f"[#] Worker {self.name}: quota exhausted, stopping.")
+                break
+            except Exception as error:
+                self.queue.fail(split, self.name, repr(error))
+                continue
+            acked += self.queue.ack(split, self.name, num_results, records)
+        if log:
+            print(f"[$] Worker {self.name}: {acked} splits done.")
+        return acked
+
+
+def run_worker(path: str, backend=scopus_search, apikey: str = None, name: str = None, quota: int = None,
+               subscriber: bool = False, threshold: int = 1000, fields: list = None, wait: bool = False,
+               log: bool = True) -> int:
+    """ Entry point of a worker process: process the splits of the `WorkQueue` in `path`.
+
+    `quota`: remaining quota of `apikey`; the worker stops before going over it.
+
+    Start one on every machine sharing the queue file, or use
+    `Coordinator.start_workers()` to start them on this one.
+    """
+    queue = WorkQueue(path)
+    try:
+        worker = Worker(queue, backend, apikey, name, TokenBucket(quota=quota))
+        return worker.run(subscriber, threshold, fields, wait=wait, log=log)
+    finally:
+        queue.close()
+
+
+class Coordinator:
+    def __init__(self, path: str = "./out/queue.sqlite", collector: Collector = None):
+        """ Enqueues the splits of a collection, starts local workers, and merges and
+        screens their results.
+
+        `path`: path to the `WorkQueue` file, shared with the workers.
+        `collector`: `Collector` screening the merged results.
+        """
+        self.path = path
+        self.queue = WorkQueue(path)
+        self.collector = collector if collector is not None else Collector()
+
+    def submit(self, splits) -> int:
+        """ Enqueue `splits` (e.g. from `Splitter.split()`). """
+        return self.queue.enqueue(splits)
+
+    def start_workers(self, apikeys: list, backend=scopus_search, **kwds) -> list:
+        """ Start one worker process per API key (see `run_worker()`) on this machine.
+
+        `apikeys`: API keys of the workers. Use None for pybliometrics' configured key.
+        `backend`: backend of the workers. It must be picklable, e.g. `ScopusSearch` or
+        a `FakeScopus`, which every worker gets a copy of.
+        `kwds`: other arguments of `run_worker()`, e.g. `subscriber` or `threshold`.
+
+        Returns the started processes.
+        """
+        context = multiprocessing.get_context("spawn")  # Same behavior on every OS
+        processes = []
+        for i, apikey in enumerate(apikeys):
+            process = context.Process(target=run_worker, args=(self.path, backend, apikey, f"worker-{i}"),
+                                      kwargs=kwds)
+            process.start()
+            processes.append(process)
+        return processes
+
+    def wait(self, processes: list = (), poll: float = 1.0, log: bool = True):
+        """ Wait until every split is done or failed, or every process in `processes`
+        has exited.
+        """
+        while not self.queue.is_finished():
+            if processes and not any(p.is_alive() for p in processes):
+                break
+            if log:
+                stats = self.queue.stats()
+                print(f"[#] Queue: {stats[DONE]} done, {stats[CLAIMED]} in progress, "
+                      f"{stats[PENDING]} pending, {stats[FAILED]} failed.", end="\r")
+            time.sleep(poll)
+        for process in processes:
+            process.join()
+        if log:
+            stats = self.queue.stats()
+            print(f"[$] Queue: {stats[DONE]} done, {stats[PENDING] + stats[CLAIMED]} left, "
+                  f"{stats[FAILED]} failed.")
+
+    def merge(self, accumulator=None) -> tuple:
+        """ Merge the results of the done splits, like `Collector.search()`.
+
+        `accumulator`: `ResultAccumulator` or `RecordStore` receiving the records.
+
+        Returns `(results, search_results, excluded_results)`, where `results` is a
+        `RecordStore` (or `accumulator`) with every paper found once.
+        """
+        results = accumulator if accumulator is not None else RecordStore()
+        search_results = []
+        excluded_results = []
+        for split, num_results, records in self.queue.iter_results():
+            if records is not None:
+                search_results.append((num_results, split))
+                results.append(split, records)
+            elif num_results is None:
+                excluded_results.append((">5000", split))
+            elif num_results:
+                excluded_results.append((num_results, split))
+        return results, search_results, excluded_results
+
+    def collect(self, splits, apikeys: list, backend=scopus_search, log: bool = True, **kwds):
+        """ Enqueue `splits`, process them with one local worker per API key, then merge
+        and screen the results (see `Collector.screen()`).
+
+        `kwds`: other arguments of `run_worker()`, e.g. `subscriber` or `threshold`.
+
+        Returns the screened dataframe, the search results and the excluded results.
+        """
+        self.submit(splits)
+        self.wait(self.start_workers(apikeys, backend, log=log, **kwds), log=log)
+        failures = self.queue.failures()
+        if log and failures:
+            print(f"[#] {len(failures)} splits failed, e.g. {failures[0][0]}: {failures[0][1]}")
+        results, search_results, excluded_results = self.merge()
+        screened = self.collector.screen(results, log=log, fields=kwds.get("fields"))
+        return screened, search_results, excluded_results
@@ -1,7 +1,36 @@
+import json
+import re
+import subprocess
+import sys
+import time
+
+import pandas as pd
 import pytest
 
+from prisma_automator.accumulator import ResultAccumulator
+from prisma_automator.batching import batch_query, batch_splits, demultiplex, unbatch
+from prisma_automator.cache import QueryCache
+from prisma_automator.cli import main
 from prisma_automator.collector import Collector
+from prisma_automator.dedup import Deduplicator
+from prisma_automator import exporters
+from prisma_automator.exporters import CsvExporter, export
+from prisma_automator.fake import FakeScopus, keyword_grid, synthetic_records
+from prisma_automator.fields import view_for
+from prisma_automator.index import InvertedIndex
+from prisma_automator.journal import RunJournal
+from prisma_automator.query import canonical_split, parse_split
+from prisma_automator.ratelimit import QuotaExhaustedError, TokenBucket
+from prisma_automator.refiner import refine
+from prisma_automator.scheduler import Scheduler
+from prisma_automator.screening import (DocumentType, Filter, KeywordExclusion, Language, Pipeline,
+                                        YearRange, default_stages)
+from prisma_automator.seen import SeenIndex
+from prisma_automator.store import RecordStore
 from prisma_automator.splitter import Splitter
+from prisma_automator.telemetry import Telemetry
+from prisma_automator.utility import save_to_file_advanced
+from prisma_automator.workqueue import Coordinator, WorkQueue, Worker
 
 
 class TestSplitter:
@@ -103,6 +132,62 @@ class TestSplitter:
         splits = self.splitter.split(log=False, save_to="")
         assert sorted(splits) == sorted(expected_splits)
 
+    def test_iter_splits_matches_split(self, create_splitter_with_kwgroups):
+        self.splitter.add_kwgroup(["Digital Twin", ""])
+        splits = self.splitter.split(log=False, save_to="")
+        assert list(self.splitter.iter_splits()) == splits
+        assert self.splitter.num_splits() == len(splits)
+
+    def test_iter_splits_has_no_recursion_limit(self, create_splitter):
+        self.splitter.add_kwgroups([[f"kw{i}"] for i in range(5000)])
+        splits = list(self.splitter.iter_splits())
+        assert len(splits) == 1 and splits[0].endswith("\"kw4999\"")
+
+    def test_iter_splits_is_lazy(self, create_splitter):
+        # 8 groups of 6 key-words: 1.7M splits, only the first 3 are generated
+        self.splitter.add_kwgroups(
+            [[f"kw{g}.{i}" for i in range(6)] for g in range(8)])
+        splits = self.splitter.iter_splits()
+        first = [next(splits) for _ in range(3)]
+        assert self.splitter.num_splits() == 6**8
+        assert first[2].endswith("\"kw7.2\"")
+
+    def test_split_removes_duplicates(self, create_splitter):
+        self.splitter.add_kwgroups([["A", ""], ["B", "a"], ["b", ""]])
+        splits = self.splitter.split(log=False, save_to="")
+        # All combinations of "A" and "B" collapse, and so do "A" and "a" alone
+        assert splits == ["\"A\" AND \"B\" AND \"b\"", "\"A\" AND \"a\"",
+                          "\"B\" AND \"b\""]
+        assert self.splitter.originals(splits[0]) == [
+            "\"A\" AND \"B\" AND \"b\"", "\"A\" AND \"B\"",
+            "\"A\" AND \"a\" AND \"b\"", "\"a\" AND \"b\""]
+        assert self.splitter.originals(splits[1]) == ["\"A\" AND \"a\"", "\"a\""]
+
+
+class TestQuery:
+    def test_parse_split(self):
+        split = "\"Virtual Reality\"  AND  (\"BCI\" OR \"Gaming\")"
+        assert parse_split(split) == [["Virtual Reality"], ["BCI", "Gaming"]]
+
+    def test_parse_split_rejects_malformed(self):
+        with pytest.raises(ValueError):
+            parse_split("\"A\" AND (\"B\" OR \"C\"")
+
+    def test_canonical_split_is_order_insensitive(self):
+        assert canonical_split("(\"Matrix\" OR \"flexible\") AND \"Heuristics\"") == \
+            canonical_split("\"heuristics\"  AND (\"Flexible\" OR \"Matrix\")") == \
+            "(\"flexible\" OR \"matrix\") AND \"heuristics\""
+
+    def test_canonical_split_absorbs_implied_terms(self):
+        assert canonical_split("\"A\" AND (\"A\" OR \"B\") AND \"A\"") == "\"a\""
+
+    def test_unparsable_split_is_kept(self):
+        splitter = Splitter()
+        splitter.add_kwgroups([['12" display', "Display"], ["Gaming"]])
+        splits = splitter.split(log=False, save_to="")
+        assert splits[0] == '"12" display" AND "Gaming"' and len(splits) == 2
+        assert canonical_split(splits[0]) == splits[0]
+
 
 class TestCollector:
     """  Tests for the Collector class
@@ -176,3 +261,948 @@ class TestCollector:
         num_duplicates = screened_df.duplicated(subset=['doi', 'title']).sum()
         assert num_duplicates == 0
 
+
+class TestTokenBucket:
+    def test_acquire_respects_rate(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        start = time.monotonic()
+        for _ in range(5):
+            bucket.acquire()
+        # The first token is available immediately, the other 4 take 1/20 s each
+        assert time.monotonic() - start >= 0.15
+
+    def test_quota_exhausted(self):
+        bucket = TokenBucket(rate=1000, quota=3)
+        for _ in range(3):
+            bucket.acquire()
+        with pytest.raises(QuotaExhaustedError):
+            bucket.acquire()
+        assert bucket.remaining == 0
+
+
+class TestCollectorOffline:
+    """ Tests for the Collector class using the offline `FakeScopus` backend. """
+    @pytest.fixture
+    def create_splits(self):
+        self.splits = [f"\"Keyword {i}\" AND \"Other\"" for i in range(20)]
+
+    def test_concurrent_search_matches_serial_order(self, create_splits):
+        backend = FakeScopus(max_count=30)
+        serial = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        concurrent = Collector(backend=backend, workers=8,
+                               bucket=TokenBucket(rate=1000))
+        _, serial_results, serial_excluded = serial.search(
+            self.splits, threshold=20, log=False)
+        _, results, excluded = concurrent.search(
+            self.splits, threshold=20, log=False)
+        assert results == serial_results and excluded == serial_excluded
+
+    def test_concurrent_search_is_faster(self, create_splits):
+        backend = FakeScopus(default_count=1, latency=0.05)
+        collector = Collector(backend=backend, workers=10,
+                              bucket=TokenBucket(rate=1000))
+        start = time.monotonic()
+        collector.search(self.splits, log=False)
+        # Serial execution would take 20 * 0.05 = 1 s
+        assert time.monotonic() - start < 0.5
+
+    def test_throttled_requests_stop_the_search(self, create_splits):
+        backend = FakeScopus(default_count=1, throttle=1)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000),
+                              backoff=0.001)
+        # Every API key is out of quota: retrying would be pointless
+        with pytest.raises(QuotaExhaustedError):
+            collector.search(self.splits[:2], log=False)
+        assert backend.requests == 1
+
+    def test_failed_requests_are_retried(self, create_splits):
+        backend = FakeScopus(default_count=1, error_rate=0.5, seed=1)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000), backoff=0)
+        _, results, _ = collector.search(self.splits[:2], log=False)
+        retries = collector.telemetry.summary()["counters"]["retries"]
+        # 2 count probes and 2 downloads, plus the failed requests
+        assert len(results) == 2 and retries > 0 and backend.requests == 4 + retries
+
+    def test_file_cache_is_not_charged(self, create_splits):
+        bucket = TokenBucket(rate=1000, quota=3)
+        collector = Collector(backend=FakeScopus(default_count=60, cached=True), bucket=bucket)
+        _, results, _ = collector.search(self.splits[:4], log=False)
+        assert len(results) == 4 and bucket.used == 0
+
+    def test_quota_covers_every_page(self, create_splits):
+        # 4 count probes, then 3 pages per download: only 2 downloads fit in the quota
+        backend = FakeScopus(default_count=60, latency=0.01)
+        bucket = TokenBucket(rate=1000, quota=12)
+        collector = Collector(backend=backend, workers=4, bucket=bucket)
+        with pytest.raises(QuotaExhaustedError):
+            collector.search(self.splits[:4], log=False)
+        assert backend.requests == bucket.used == 10
+
+    def test_search_excludes_over_5000_for_non_subscribers(self):
+        splits = ["\"Virtual Reality\"", "\"Virtual Reality\" AND \"BCI\""]
+        backend = FakeScopus(counts={f"TITLE-ABS-KEY({splits[0]})": 6000})
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        _, results, excluded = collector.search(splits, log=False)
+        assert excluded == [(">5000", splits[0])] and results == [(5, splits[1])]
+
+    def test_over_threshold_splits_are_never_downloaded(self, create_splits):
+        backend = FakeScopus(
+            counts={f"TITLE-ABS-KEY({self.splits[0]})": 2000})
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        _, results, excluded = collector.search(
+            self.splits[:2], threshold=1000, log=False)
+        assert excluded == [(2000, self.splits[0])]
+        # Only the count probe was sent for the excluded split
+        assert backend.queries.count(f"TITLE-ABS-KEY({self.splits[0]})") == 1
+
+    def test_plan_estimates_pages(self, create_splits, tmp_path):
+        counts = {f"TITLE-ABS-KEY({self.splits[0]})": 60,
+                  f"TITLE-ABS-KEY({self.splits[1]})": 0,
+                  f"TITLE-ABS-KEY({self.splits[2]})": 1500}
+        collector = Collector(backend=FakeScopus(counts=counts),
+                              bucket=TokenBucket(rate=1000))
+        plan = collector.plan(self.splits[:3], threshold=1000, log=False)
+        assert plan == [(60, 3, self.splits[0], []), (0, 0, self.splits[1], []),
+                        (1500, 0, self.splits[2], [])]
+        path = tmp_path / "plan.txt"
+        collector.save_plan(plan, str(path), log=False)
+        assert "estimated quota cost): 3" in path.read_text()
+
+    def test_search_consumes_generator(self):
+        splitter = Splitter()
+        splitter.add_kwgroups([["A", "B"], ["C", "D || E"]])
+        collector = Collector(backend=FakeScopus(), workers=3,
+                              bucket=TokenBucket(rate=1000))
+        _, results, _ = collector.search(splitter.iter_splits(), log=False)
+        assert [s for _, s in results] == splitter.split(log=False, save_to="")
+
+    def test_search_returns_results_of_all_splits(self, create_splits):
+        collector = Collector(backend=FakeScopus(default_count=3),
+                              bucket=TokenBucket(rate=1000))
+        df, _, _ = collector.search(self.splits, log=False)
+        assert len(df) == 60 and list(df.splits.unique()) == self.splits
+        assert df.columns[0] == 'splits' and df.index.is_unique
+
+    def test_screen_accumulator_matches_dataframe(self, create_splits, tmp_path):
+        # Every split is searched twice, so half of the rows are duplicates
+        collector = Collector(backend=FakeScopus(default_count=7),
+                              bucket=TokenBucket(rate=1000))
+        accumulator = ResultAccumulator(str(tmp_path / "chunks"), chunk_size=25)
+        collector.search(self.splits * 2, log=False, accumulator=accumulator)
+        # 11 full chunks were written, the last 5 rows are still buffered
+        assert len(accumulator) == 280 and len(list(tmp_path.glob("chunks/chunk_*"))) == 11
+        screened = collector.screen(accumulator, log=False)
+        expected = collector.screen(accumulator.to_frame(), log=False)
+        assert len(screened) == 140 and screened.equals(expected)
+
+
+class TestQueryCache:
+    def test_normalized_split_hits(self, tmp_path):
+        cache = QueryCache(str(tmp_path / "cache.sqlite"))
+        cache.put("\"BCI\"  AND \"Gaming\"", False, "STANDARD", 3)
+        assert cache.get_count("\"bci\" AND \"gaming\"", False, "STANDARD") == (3,)
+        assert cache.get_count("\"bci\" AND \"gaming\"", True, "COMPLETE") is None
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    def test_ttl_expires_entries(self, tmp_path):
+        cache = QueryCache(str(tmp_path / "cache.sqlite"), ttl=0)
+        cache.put("\"BCI\"", False, "STANDARD", 3)
+        time.sleep(0.01)
+        assert cache.get_count("\"BCI\"", False, "STANDARD") is None
+
+    def test_lru_eviction(self, tmp_path):
+        backend = FakeScopus(default_count=3)
+        records = backend.documents([("q", i) for i in range(3)])
+        cache = QueryCache(str(tmp_path / "cache.sqlite"), max_size=1)
+        cache.put("\"A\"", False, "STANDARD", 3, records)
+        assert cache.stats()["entries"] == 0
+        cache.max_size = 10**6
+        cache.put("\"A\"", False, "STANDARD", 3, records)
+        cache.put("\"B\"", False, "STANDARD", 3, records)
+        cache.get_records("\"A\"", False, "STANDARD")  # "B" is now the LRU
+        cache.max_size = cache.stats()["size"] - 1
+        cache.put("\"C\"", False, "STANDARD", 0)
+        assert cache.get_records("\"B\"", False, "STANDARD") is None
+        assert len(cache.get_records("\"A\"", False, "STANDARD")) == 3
+
+    def test_collector_consults_cache(self, tmp_path):
+        splits = ["\"A\"", "\"B\""]
+        backend = FakeScopus(default_count=3)
+        cache = QueryCache(str(tmp_path / "cache.sqlite"))
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000),
+                              cache=cache)
+        df, _, _ = collector.search(splits, log=False)
+        requests = backend.requests
+        cached_df, _, _ = collector.search(splits + ["\"C\""], log=False)
+        # Only the new split is sent to Scopus: one count and one download
+        assert backend.requests - requests == 2
+        assert list(cached_df.columns) == list(df.columns)
+
+
+class TestRunJournal:
+    def test_resume_skips_completed_splits(self, tmp_path):
+        splits = [f"\"Keyword {i}\"" for i in range(10)]
+        path = str(tmp_path / "journal.jsonl")
+        # The first run dies when the quota runs out at the 13th request
+        backend = FakeScopus(default_count=2)
+        collector = Collector(backend=backend,
+                              bucket=TokenBucket(rate=1000, quota=13))
+        journal = RunJournal(path)
+        with pytest.raises(QuotaExhaustedError):
+            collector.search(splits, log=False, journal=journal)
+        journal.close()
+        # 10 count probes and 3 downloads were journaled
+        journal = RunJournal(path, resume=True)
+        assert len(journal.counts) == 10 and len(journal.completed) == 3
+        backend = FakeScopus(default_count=2)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        _, results, _ = collector.search(splits, log=False, journal=journal)
+        journal.close()
+        assert backend.requests == 7 and len(results) == 10
+
+    def test_truncated_line_is_ignored(self, tmp_path):
+        path = tmp_path / "journal.jsonl"
+        path.write_text('{"split": "A", "num_results": 3}\n{"split": "B", "num_')
+        journal = RunJournal(str(path), resume=True)
+        journal.record_count("C", 1)
+        journal.close()
+        assert journal.counts == {"A": 3, "C": 1}
+        journal = RunJournal(str(path), resume=True)
+        journal.close()
+        assert journal.counts == {"A": 3, "C": 1}
+
+
+class TestRefiner:
+    def test_refine_bisects_years(self):
+        # 100 results per year from 2000 to 2009
+        def count(clauses):
+            first, last = [int(x) for x in re.findall(r"\d+", clauses[0])]
+            return 100 * len(range(max(first + 1, 2000), min(last - 1, 2009) + 1))
+        parts = refine(count, threshold=300, first_year=2000, last_year=2009)
+        assert sum(n for n, _ in parts) == 1000
+        assert all(n <= 300 for n, _ in parts)
+        assert parts[0][1] == ("PUBYEAR > 1999 AND PUBYEAR < 2003",)
+
+    def test_refine_skips_known_range(self):
+        probes = []
+
+        def count(clauses):
+            probes.append(clauses)
+            return 200
+        parts = refine(count, threshold=300, first_year=2000, last_year=2009, over_threshold=True)
+        # The whole range isn't counted again, only its two halves
+        assert len(probes) == len(parts) == 2
+        assert parts[0][1] == ("PUBYEAR > 1999 AND PUBYEAR < 2005",)
+
+    def test_refine_single_year_by_subject_area(self):
+        parts = refine(lambda clauses: 10 if len(clauses) == 2 else 500,
+                       threshold=300, first_year=2020, last_year=2020)
+        assert len(parts) == 27 and parts[0][1][1] == "SUBJAREA(AGRI)"
+
+    def test_collector_merges_refined_split(self):
+        split = "\"Virtual Reality\""
+        backend = FakeScopus(counts={f"TITLE-ABS-KEY({split})": 6000})
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=10**6))
+        df, results, excluded = collector.search(
+            [split], threshold=1000, log=False, refine=True)
+        assert results == [(6000, split)] and excluded == []
+        assert len(df) == 6000 and df.eid.is_unique
+
+
+class TestBatching:
+    def test_batch_query_roundtrip(self):
+        splits = ["\"A\" AND (\"B\" OR \"C\")", "(\"D\" OR \"E\") AND \"F\""]
+        assert unbatch(batch_query(splits)) == splits
+        assert unbatch(splits[1]) is None
+        assert unbatch("(\"D\" OR \"E\") AND (\"F\" OR \"G\")") is None
+
+    def test_batch_splits_respects_length(self):
+        splits = [f"\"Keyword {i}\"" for i in range(100)]
+        batches = list(batch_splits(splits, max_length=200))
+        assert sum(batches, []) == splits
+        assert all(len(batch_query(b)) <= 200 for b in batches)
+
+    def test_demultiplex(self):
+        records = [{"title": "Gaming with BCIs", "description": "A brain-computer interface game.",
+                    "authkeywords": "BCI | Gaming"},
+                   {"title": "Unrelated", "description": None, "authkeywords": None}]
+        splits = ["\"BCI\" AND \"Gaming\"", "\"Brain-Computer Interface\"",
+                  "\"Virtual Reality\""]
+        groups, unmatched = demultiplex(records, splits)
+        assert groups[splits[0]] == records
+        assert groups[splits[1]] == records
+        assert groups[splits[2]] == records[1:] and unmatched == 1
+
+    def test_collector_batches_small_splits(self):
+        splits = [f"\"Keyword {i}\" AND \"Other\"" for i in range(40)]
+        backend = FakeScopus(default_count=3)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=10**6))
+        df, results, _ = collector.search(
+            splits, threshold=200, log=False, batch=True)
+        # One count probe and 5 pages (120 results) for the only batch
+        assert backend.requests == 6
+        assert results == [(3, s) for s in splits]
+
+    def test_collector_halves_batches_over_threshold(self):
+        splits = [f"\"Keyword {i}\"" for i in range(8)]
+        backend = FakeScopus(default_count=30)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=10**6))
+        plan = collector.plan(splits, threshold=100, log=False, batch=True)
+        assert [unbatch(s) for _, _, s, _ in plan] == [splits[:2], splits[2:4],
+                                                        splits[4:6], splits[6:]]
+
+
+class TestRecordStore:
+    @pytest.fixture
+    def create_store(self):
+        backend = FakeScopus()
+        self.docs = backend.documents([("q", i) for i in range(4)])
+        self.store = RecordStore()
+        self.store.append("A", self.docs[:3])
+        self.store.append("B", self.docs[1:])
+        self.store.append("C", self.docs[1:2])
+
+    def test_papers_are_stored_once(self, create_store):
+        df = self.store.to_frame()
+        assert len(self.store) == 4 and len(df) == 4
+        assert list(df.splits) == ["A", "A", "A", "B"]
+
+    def test_splits_for_paper(self, create_store):
+        assert self.store.splits_for(self.docs[1].eid) == ["A", "B", "C"]
+        assert self.store.splits_for(self.docs[3].doi.upper()) == ["B"]
+        assert self.store.splits_for("2-s2.0-unknown") == []
+
+    def test_yield_per_split(self, create_store):
+        assert self.store.yield_per_split() == {"A": 3, "B": 3, "C": 1}
+        assert self.store.unique_yield() == {"A": 1, "B": 1, "C": 0}
+        assert self.store.yield_stats()[2] == (1, 0, "C")
+
+
+class TestDeduplicator:
+    @pytest.fixture
+    def create_frame(self):
+        abstract = ("We propose a heuristic for the reconfiguration of flexible assembly lines "
+                    "and evaluate it on a set of industrial case studies with promising results")
+        self.df = pd.DataFrame({
+            'doi': ["10.1000/ABC", "https://doi.org/10.1000/abc", None, None, None, "10.1000/xyz"],
+            'title': ["Flexible assembly", "Flexible assembly (copy)", "Matrix production",
+                      "MATRIX   production!", "Matrix production", "Flexible Assembly"],
+            'description': [abstract, abstract, "An abstract.", "An  abstract", "Other abstract.",
+                            abstract.replace("promising", "encouraging")]})
+
+    def test_exact_passes(self, create_frame):
+        dedup = Deduplicator()
+        df = dedup.process(self.df)
+        assert list(df.index) == [0, 2, 4, 5]
+        report = dedup.report()
+        assert list(zip(report.dropped, report.kept, report.reason)) == [
+            (1, 0, "doi"), (3, 2, "title")]
+        assert report.title[1] == "MATRIX   production!"
+
+    def test_near_duplicates(self, create_frame):
+        dedup = Deduplicator(near_duplicates=True)
+        df = dedup.process(self.df)
+        assert list(df.index) == [0, 2, 4]
+        report = dedup.report()
+        assert (report.dropped[2], report.kept[2]) == (5, 0)
+        assert report.reason[2].startswith("near-duplicate")
+
+    def test_near_duplicates_in_batches(self):
+        df = synthetic_records(600, duplicates=0, near_duplicates=0.3, reviews=0, missing_doi=0)
+        kept = [list(Deduplicator(near_duplicates=True, batch_size=size).process(df).index)
+                for size in [7, 2000]]
+        assert kept[0] == kept[1] and len(kept[0]) < 500
+
+    def test_duplicates_across_chunks(self, create_frame):
+        dedup = Deduplicator(near_duplicates=True)
+        chunks = [dedup.process(self.df.iloc[:3]), dedup.process(self.df.iloc[3:])]
+        assert list(pd.concat(chunks).index) == [0, 2, 4]
+
+    def test_duplicated_index(self, create_frame):
+        # Chunks read back from files each have their own RangeIndex
+        df = pd.concat([self.df.iloc[:3].reset_index(drop=True), self.df.iloc[3:].reset_index(drop=True)])
+        dedup = Deduplicator(near_duplicates=True)
+        assert list(dedup.duplicated(df)) == [False, True, False, True, False, True]
+        assert list(dedup.process(self.df.iloc[3:].reset_index(drop=True)).title) == []
+        report = dedup.report()
+        assert list(report.title[:3]) == ["Flexible assembly (copy)", "MATRIX   production!", "Flexible Assembly"]
+        assert list(zip(report.dropped, report.kept, report.reason))[:2] == [(1, 0, "doi"), (0, 2, "title")]
+
+
+class TestSeenIndex:
+    @pytest.fixture
+    def create_records(self):
+        self.collector = Collector(backend=FakeScopus())
+        docs = FakeScopus().documents([("q", i) for i in range(6)])
+        self.df = pd.DataFrame([d._asdict() for d in docs])
+
+    def test_only_new_records_are_screened(self, create_records, tmp_path):
+        path = str(tmp_path / "seen.sqlite")
+        seen = SeenIndex(path)
+        first = self.collector.screen(self.df.iloc[:4], log=False, seen=seen)
+        seen.commit()
+        seen.close()
+        assert len(first) == 4
+
+        # The next run finds two new records, and an old one with a new EID and DOI
+        df = self.df.copy()
+        df.loc[0, ['eid', 'doi']] = ["2-s2.0-new", "10.0000/new"]
+        seen = SeenIndex(path)
+        assert seen.run == 2
+        second = self.collector.screen(df, log=False, seen=seen)
+        assert list(second.index) == [4, 5]
+        seen.commit()
+        assert len(seen) == 6 and seen.stats() == {"included": 6}
+
+    def test_generic_titles_are_not_matched(self, create_records, tmp_path):
+        df = self.df.copy()
+        df["title"] = "Editorial"
+        df["description"] = [None, None, None, "On A.", "On B.", "On C."]
+        path = str(tmp_path / "seen.sqlite")
+        anonymous = df.iloc[[0]].assign(eid=None, doi=None)
+        seen = SeenIndex(path)
+        seen.add(df.iloc[[0, 3]], pd.Series("included", index=df.index[[0, 3]]))
+        seen.add(anonymous, pd.Series("included", index=anonymous.index))
+        seen.commit()
+        seen.close()
+        seen = SeenIndex(path)
+        # Other editorials, with their own EID or abstract, are new
+        assert list(seen.unseen(df)) == [False, True, True, False, True, True]
+        # Without EID and DOI, the title is all there is to match
+        assert not seen.unseen(anonymous).any()
+
+    def test_uncommitted_records_are_forgotten(self, create_records, tmp_path):
+        path = str(tmp_path / "seen.sqlite")
+        seen = SeenIndex(path)
+        self.collector.screen(self.df, log=False, seen=seen)
+        seen.close()
+        seen = SeenIndex(path)
+        assert seen.run == 1 and seen.unseen(self.df).all()
+
+    def test_repeats_within_a_run_are_duplicates(self, create_records, tmp_path):
+        seen = SeenIndex(str(tmp_path / "seen.sqlite"))
+        # The same paper is found in the first and the second chunk of the run
+        chunks = [self.df.iloc[:3], self.df.iloc[[2, 3]].set_axis([6, 7])]
+        screened = pd.concat(self.collector.screen_chunks(chunks, log=False, seen=seen))
+        assert list(screened.index) == [0, 1, 2, 7]
+        assert seen.stats() == {"included": 4, "duplicate": 1}
+
+    def test_decisions_are_recorded(self, create_records, tmp_path):
+        df = self.df.copy()
+        df.loc[1, 'subtypeDescription'] = "Conference Review"
+        df.loc[2, 'doi'] = df.loc[0, 'doi'].upper()
+        seen = SeenIndex(str(tmp_path / "seen.sqlite"))
+        self.collector.screen(df, log=False, seen=seen)
+        assert seen.stats() == {"included": 4, "duplicate": 1, "conference review": 1}
+
+
+class TestExporters:
+    @pytest.fixture
+    def create_chunks(self):
+        docs = FakeScopus().documents([("q", i) for i in range(25)])
+        df = pd.DataFrame([d._asdict() for d in docs])
+        df['splits'] = '"A, B" AND "C"'
+        self.chunks = [df.iloc[i:i + 10] for i in range(0, len(df), 10)]
+
+    def test_csv_export(self, create_chunks, tmp_path):
+        path = str(tmp_path / "results.csv")
+        assert export(self.chunks, path, format="csv") == 25
+        df = pd.read_csv(path)
+        assert len(df) == 25 and list(df['index']) == list(range(25))
+        assert (df.splits == '"A, B" AND "C"').all()
+
+    def test_csv_append_aligns_columns(self, create_chunks, tmp_path):
+        path = str(tmp_path / "results.csv")
+        export(self.chunks[:1], path, format="csv", index=False)
+        with CsvExporter(path, index=False, append=True) as exporter:
+            exporter.write(self.chunks[1][['title', 'eid']])
+        df = pd.read_csv(path)
+        assert len(df) == 20 and df.columns[0] == 'eid' and df.doi[10:].isna().all()
+
+    def test_unknown_format(self, tmp_path):
+        with pytest.raises(ValueError):
+            export([], str(tmp_path / "results.txt"), format="txt")
+
+    def test_xlsx_rolls_over_to_new_sheet(self, create_chunks, tmp_path, monkeypatch):
+        openpyxl = pytest.importorskip("openpyxl")
+        monkeypatch.setattr(exporters, "EXCEL_MAX_ROWS", 11)
+        path = str(tmp_path / "results.xlsx")
+        export(self.chunks, path, format="xlsx")
+        sheets = openpyxl.load_workbook(path).worksheets
+        assert [sheet.max_row for sheet in sheets] == [11, 11, 6]
+
+    def test_parquet_categoricals(self, create_chunks, tmp_path):
+        pytest.importorskip("pyarrow")
+        path = str(tmp_path / "results.parquet")
+        export(self.chunks, path, format="parquet")
+        df = pd.read_parquet(path)
+        assert len(df) == 25 and df.splits.dtype == "category"
+
+    def test_save_to_file_advanced_quotes(self, tmp_path):
+        path = str(tmp_path / "out" / "results.txt")
+        save_to_file_advanced(path, "num_results,split", [
+            (3, '"A" AND "B, C"')], separator=',')
+        df = pd.read_csv(path)
+        assert list(df.columns) == ['num_results', 'split']
+        assert df.split[0] == '"A" AND "B, C"'
+
+    def test_run_exports_and_increments(self, tmp_path):
+        save_to = str(tmp_path) + "/"
+        splits = ["\"Keyword 1\"", "\"Keyword 2\""]
+        collector = Collector(backend=FakeScopus(), bucket=TokenBucket(rate=1000))
+        collector.run(splits, save_to=save_to, log=False, format="csv")
+        assert len(pd.read_csv(save_to + "final_results.csv")) == 10
+
+        collector.run(splits, save_to=save_to, log=False, format="csv", incremental=True)
+        collector.run(splits[:1] + ["\"Keyword 3\""], save_to=save_to, log=False,
+                      format="csv", incremental=True)
+        assert len(pd.read_csv(save_to + "delta_results_001.csv")) == 10
+        assert len(pd.read_csv(save_to + "delta_results_002.csv")) == 5
+        assert len(pd.read_csv(save_to + "cumulative_results.csv")) == 15
+
+
+class TestInvertedIndex:
+    @pytest.fixture
+    def create_index(self):
+        self.records = [
+            {'eid': "e0", 'title': "Virtual Reality for BCI", 'description': "A study.",
+             'authkeywords': None},
+            {'eid': "e1", 'title': "Gaming in virtual worlds", 'description': "Reality checks.",
+             'authkeywords': "Brain-computer interface | Virtual reality"},
+            {'eid': "e2", 'title': "Virtual", 'description': "Reality of gaming.",
+             'authkeywords': "Gaming | Virtual"},
+        ]
+        self.index = InvertedIndex(harvested=['"Virtual Reality"'])
+        self.index.add(self.records)
+
+    def test_phrases(self, create_index):
+        assert self.index.hits('"virtual reality"') == ["e0", "e1"]
+        assert self.index.hits('"Brain Computer Interface"') == ["e1"]
+        # Phrases don't span fields or author keywords
+        assert self.index.hits('"virtual reality" AND "gaming"') == ["e1"]
+        assert self.index.count('"gaming virtual"') == 0
+
+    def test_boolean_splits(self, create_index):
+        split = '"Virtual Reality" AND ("BCI" OR "Brain-Computer Interface")'
+        assert self.index.hits(split) == ["e0", "e1"]
+        assert self.index.counts(['"gaming" AND "reality"', '"unknown"']) == [
+            (2, '"gaming" AND "reality"'), (0, '"unknown"')]
+
+    def test_matches_local_demultiplexing(self):
+        # Same matching rules as batching.demultiplex()
+        records = FakeScopus().documents(
+            [(f'TITLE-ABS-KEY("Keyword {i % 3}")', i) for i in range(30)])
+        index = InvertedIndex()
+        index.add(records)
+        splits = ['"Keyword 1"', '"keyword 2" AND "abstract"', '("Keyword 0" OR "Keyword 1")']
+        groups, _ = demultiplex(records, splits)
+        assert [index.count(s) for s in splits] == [len(groups[s]) for s in splits]
+
+    def test_coverage(self, create_index):
+        assert self.index.is_covered('"virtual reality" AND "BCI"')
+        assert not self.index.is_covered('("Virtual Reality" OR "Gaming") AND "BCI"')
+        assert self.index.new_splits(['"Virtual reality"', '"Gaming"']) == ['"Gaming"']
+
+    def test_from_store(self, create_index):
+        store = RecordStore()
+        store.append('"Virtual Reality"', self.records[:2])
+        index = InvertedIndex.from_store(store)
+        assert len(index) == 2 and index.is_covered('"Virtual Reality" AND "Gaming"')
+
+
+class TestFieldProjection:
+    def test_view_for_fields(self):
+        assert view_for(None, subscriber=True) == "COMPLETE"
+        assert view_for(["title", "coverDate"], subscriber=True) == "STANDARD"
+        assert view_for(["title", "description"], subscriber=True) == "COMPLETE"
+        with pytest.raises(ValueError):
+            view_for(["description"], subscriber=False)
+        with pytest.raises(ValueError):
+            view_for(["abstract"], subscriber=True)
+
+    def test_standard_view_needs_fewer_requests(self):
+        splits = ["\"Keyword 1\""]
+        backend = FakeScopus(default_count=400)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        df, _, _ = collector.search(splits, subscriber=True, log=False,
+                                    fields=["title", "coverDate"])
+        # 1 count probe and 2 pages of 200 results
+        assert backend.requests == 3
+        assert list(df.columns) == ["splits", "eid", "doi", "title",
+                                    "subtypeDescription", "coverDate"]
+
+        backend = FakeScopus(default_count=400)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        df, _, _ = collector.search(splits, subscriber=True, log=False,
+                                    fields=["description"])
+        # 1 count probe and 16 pages of 25 results
+        assert backend.requests == 17 and df.description.notna().all()
+
+    def test_screen_keeps_declared_fields(self):
+        collector = Collector(backend=FakeScopus(), bucket=TokenBucket(rate=1000))
+        fields = ["title", "coverDate", "afid"]
+        df, _, _ = collector.search(["\"Keyword 1\""], log=False, fields=fields)
+        screened = collector.screen(df, log=False, fields=fields)
+        assert list(screened.columns) == ["splits", "title", "coverDate", "afid"]
+
+    def test_projections_are_cached_separately(self, tmp_path):
+        cache = QueryCache(str(tmp_path / "cache.sqlite"))
+        backend = FakeScopus()
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000), cache=cache)
+        collector.search(["\"Keyword 1\""], log=False, fields=["title"])
+        collector.search(["\"Keyword 1\""], log=False, fields=["title"])
+        assert backend.requests == 2  # Count and download, then both cached
+        df, _, _ = collector.search(["\"Keyword 1\""], log=False, fields=["coverDate"])
+        assert backend.requests == 3 and df.coverDate.notna().all()
+
+
+class TestTelemetry:
+    def test_spans_and_counters(self, tmp_path):
+        telemetry = Telemetry(str(tmp_path / "telemetry.jsonl"))
+        for _ in range(3):
+            with telemetry.span("step"):
+                telemetry.count("items", 2)
+        with telemetry.span("split", split='"A"') as event:
+            event["records"] = 5
+        telemetry.close()
+        summary = telemetry.summary()
+        assert summary["counters"] == {"items": 6}
+        assert summary["timings"]["step"]["count"] == 3
+        # Only spans with fields emit events
+        events = pd.read_json(tmp_path / "telemetry.jsonl", lines=True)
+        assert list(events.event) == ["split"] and events.records[0] == 5
+
+    def test_run_metrics(self, tmp_path):
+        save_to = str(tmp_path) + "/"
+        telemetry = Telemetry()
+        splitter = Splitter(telemetry=telemetry)
+        splitter.add_kwgroups([["Keyword 1", "Keyword 2"], ["A", ""]])
+        splits = splitter.split(log=False, save_to="")
+        collector = Collector(backend=FakeScopus(error_rate=0.1, seed=3, quota=100),
+                              bucket=TokenBucket(rate=1000), backoff=0, telemetry=telemetry)
+        collector.run(splits, save_to=save_to, log=False, format="csv")
+        summary = telemetry.summary()
+        counters = summary["counters"]
+        # 4 count probes and 4 downloads, plus the failed requests
+        assert counters["server_errors"] == counters["retries"] > 0
+        assert counters["requests"] == counters["pages"] + counters["retries"]
+        assert counters["pages"] == 8
+        assert summary["gauges"]["quota_remaining"] == 100 - counters["requests"]
+        for name in ["generate_splits", "deduplicate", "plan", "search", "screen", "export"]:
+            assert name in summary["timings"]
+
+        events = pd.read_json(save_to + "telemetry.jsonl", lines=True)
+        assert (events.event == "request").sum() == 8
+        assert list(events[events.event == "split"].split) == splits
+        assert events.event.iloc[-1] == "summary"
+
+    def test_split_events_without_parts(self):
+        collector = Collector(backend=FakeScopus(default_count=3), bucket=TokenBucket(rate=1000))
+        records = collector._download_one('"A"', subscriber=True)
+        assert len(records) == 3
+        assert collector.telemetry.summary()["timings"]["split"]["count"] == 1
+
+    def test_profile(self):
+        telemetry = Telemetry(profile=True, trace_memory=True)
+        telemetry.start()
+        sorted(range(10000), key=str)
+        telemetry.stop()
+        summary = telemetry.summary()
+        assert "sorted" in summary["profile"] and summary["memory"]["peak_bytes"] > 0
+
+
+class TestSyntheticData:
+    def test_keyword_grid(self):
+        splitter = Splitter()
+        splitter.add_kwgroups(keyword_grid([10, 4, 5]))
+        assert splitter.num_splits() == 200
+        assert len(splitter.split(log=False, save_to="", dedup=False)) == 200
+
+    def test_synthetic_records_are_screened(self):
+        df = synthetic_records(2000)
+        collector = Collector(backend=FakeScopus())
+        dedup = Deduplicator(near_duplicates=True)
+        screened = collector.screen(df, log=False, dedup=dedup)
+        reasons = dedup.report().reason.value_counts()
+        assert 0 < len(screened) < len(df) * 0.95
+        assert reasons.index.str.startswith("near-duplicate").any()
+
+    def test_error_rate_and_page_size(self):
+        backend = FakeScopus(default_count=30, page_size=10, error_rate=0.3)
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000), backoff=0)
+        df, _, _ = collector.search(["\"Keyword 1\""], log=False)
+        assert len(df) == 30
+        # 1 count probe and 3 pages, plus the failed searches, which are retried
+        counters = collector.telemetry.summary()["counters"]
+        assert counters["server_errors"] == counters["retries"] > 0
+        assert backend.requests > 4
+
+
+class TestScheduler:
+    @pytest.fixture
+    def create_plan(self):
+        self.plan = [(100, 4, '"A" AND "X"', []),
+                     (20, 1, '"B" AND "X"', []),
+                     (5000, 0, '"C"', []),
+                     (50, 2, '("D" OR "E") AND "Y"', [])]
+
+    def splits_of(self, entries):
+        return [s for _, _, s, _ in entries]
+
+    def test_priorities(self, create_plan):
+        scheduled, _ = Scheduler(priority="smallest").schedule(self.plan)
+        assert self.splits_of(scheduled) == [
+            '"C"', '"B" AND "X"', '("D" OR "E") AND "Y"', '"A" AND "X"']
+        weights = {"D || E": 2, "Y": 1.5, "X": 0.5}
+        scheduled, _ = Scheduler(priority="weights", weights=weights).schedule(self.plan)
+        assert self.splits_of(scheduled)[1] == '("D" OR "E") AND "Y"'
+        with pytest.raises(ValueError):
+            Scheduler(priority="largest")
+
+    def test_expected_yield(self, create_plan):
+        index = InvertedIndex()
+        index.add([{'eid': f"e{i}", 'title': "A study of X"} for i in range(99)])
+        scheduled, _ = Scheduler(priority="yield", index=index).schedule(self.plan)
+        # "A" AND "X" only has 1 new paper left, over 4 pages
+        assert self.splits_of(scheduled)[-1] == '"A" AND "X"'
+
+    def test_budget(self, create_plan):
+        scheduler = Scheduler(budget=3)
+        scheduled, deferred = scheduler.schedule(self.plan)
+        # "A" AND "X" doesn't fit, smaller splits after it still do
+        assert self.splits_of(deferred) == ['"A" AND "X"'] and scheduler.spent == 3
+        scheduled, deferred = scheduler.schedule(self.plan, completed={'"A" AND "X"'})
+        assert not deferred
+
+    def test_run_resumes_deferred_splits(self, tmp_path):
+        save_to = str(tmp_path) + "/"
+        splits = ["\"Keyword 1\"", "\"Keyword 2\"", "\"Keyword 3\""]
+        backend = FakeScopus(default_count=30)  # 2 pages per split
+        collector = Collector(backend=backend, bucket=TokenBucket(rate=1000))
+        collector.run(splits, save_to=save_to, log=False, format="csv",
+                      scheduler=Scheduler(budget=4))
+        assert len(pd.read_csv(save_to + "final_results.csv")) == 60
+        deferred = pd.read_csv(save_to + "deferred_plan.txt", comment="#")
+        assert list(deferred.split) == ["\"Keyword 3\""]
+
+        backend.requests = 0
+        collector.run(splits, save_to=save_to, log=False, format="csv", resume=True,
+                      scheduler=Scheduler(budget=4))
+        assert backend.requests == 2  # Only the deferred split is downloaded
+        assert len(pd.read_csv(save_to + "final_results.csv")) == 90
+
+
+class TestWorkQueue:
+    @pytest.fixture
+    def create_queue(self, tmp_path):
+        self.path = str(tmp_path / "queue.sqlite")
+        self.splits = [f"\"Keyword {i}\"" for i in range(6)]
+        self.queue = WorkQueue(self.path, lease=0.2, max_attempts=2)
+        self.queue.enqueue(self.splits)
+
+    def test_claim_and_ack(self, create_queue):
+        assert self.queue.enqueue(self.splits[:2]) == 0  # Already queued
+        assert self.queue.claim("a", num=2) == self.splits[:2]
+        assert self.queue.claim("b") == self.splits[2:3]
+        assert self.queue.ack(self.splits[0], "a", 1, [{"eid": "e0"}])
+        assert not self.queue.ack(self.splits[0], "b", 1, [])  # Already done
+        assert list(self.queue.iter_results()) == [
+            (self.splits[0], 1, [{"eid": "e0"}])]
+
+    def test_expired_leases_and_failures(self, create_queue):
+        other = WorkQueue(self.path, lease=0.2, max_attempts=2)
+        assert self.queue.claim("a") == self.splits[:1]
+        time.sleep(0.3)
+        # The lease of "a" expired, pending splits still come first
+        assert other.claim("b", num=6) == self.splits[1:] + self.splits[:1]
+        other.fail(self.splits[0], "b", "error")
+        assert self.queue.stats()["failed"] == 1  # Claimed twice
+        other.fail(self.splits[1], "b", "error")
+        assert other.claim("b") == self.splits[1:2]
+
+    def test_worker_matches_search(self, create_queue):
+        backend = FakeScopus(counts={self.splits[1]: 2000, self.splits[2]: 0})
+        worker = Worker(self.queue, backend=backend, apikey="key",
+                        bucket=TokenBucket(rate=1000))
+        assert worker.run(log=False) == 6
+        results, search_results, excluded_results = Coordinator(self.path).merge()
+        df, expected_search, expected_excluded = Collector(
+            backend=backend, bucket=TokenBucket(rate=1000)).search(self.splits, log=False)
+        assert search_results == expected_search and excluded_results == expected_excluded
+        assert results.to_frame().equals(df)
+
+    def test_worker_processes(self, create_queue):
+        coordinator = Coordinator(self.path, Collector(backend=FakeScopus()))
+        screened, search_results, _ = coordinator.collect(
+            self.splits + ["\"Keyword 6\""], apikeys=["key-a", "key-b"],
+            backend=FakeScopus(latency=0.01), log=False)
+        assert len(search_results) == 7 and len(screened) == 35
+        workers = {w for w, in coordinator.queue._con.execute("SELECT worker FROM tasks")}
+        assert workers <= {"worker-0", "worker-1"}
+
+
+class TestCli:
+    @pytest.fixture
+    def create_keywords(self, tmp_path):
+        self.out = str(tmp_path / "out") + "/"
+        self.keywords = str(tmp_path / "keywords.json")
+        with open(self.keywords, "w") as f:
+            json.dump({"reality": ["Augmented Reality", "Extended Reality || Mixed Reality"],
+                       "goal": ["BCI", None]}, f)
+
+    def test_split(self, create_keywords):
+        assert main(["split", self.keywords, "-o", self.out + "splits.txt", "-q"]) == 0
+        with open(self.out + "splits.txt") as f:
+            splits = f.read().splitlines()
+        assert splits == ['"Augmented Reality" AND "BCI"', '"Augmented Reality"',
+                          '("Extended Reality" OR "Mixed Reality") AND "BCI"',
+                          '("Extended Reality" OR "Mixed Reality")']
+
+    def test_plan_collect_screen_export(self, create_keywords):
+        backend = FakeScopus()
+        main(["split", self.keywords, "-o", self.out + "splits.txt", "-q"])
+        assert main(["plan", self.out + "splits.txt", "-o", self.out, "--rate", "1000", "-q"],
+                    backend=backend) == 0
+        assert len(pd.read_csv(self.out + "plan.txt", comment="#")) == 4
+        assert main(["collect", self.keywords, "-o", self.out, "--rate", "1000", "--format", "csv",
+                     "--fields", "title,coverDate", "-q"], backend=backend) == 0
+        final = pd.read_csv(self.out + "final_results.csv")
+        assert len(final) == 20 and "coverDate" in final
+
+        assert main(["screen", self.out + "chunks", self.out + "screened.csv",
+                     "--fields", "title", "-q"]) == 0
+        screened = pd.read_csv(self.out + "screened.csv")
+        assert list(screened.columns) == ["index", "splits", "title"] and len(screened) == 20
+        assert main(["export", self.out + "screened.csv", self.out + "exported.csv", "-q"]) == 0
+        assert pd.read_csv(self.out + "exported.csv").equals(screened)
+
+    def test_quiet_split(self, create_keywords, capsys):
+        assert main(["split", self.keywords, "-o", self.out + "splits.txt", "-q"]) == 0
+        assert capsys.readouterr().out == ""
+
+    def test_yield_priority_with_index(self, create_keywords):
+        backend = FakeScopus()
+        save_to_file_advanced(self.out + "first.txt", '"Augmented Reality" AND "BCI"', [])
+        main(["collect", self.out + "first.txt", "-o", self.out + "first/", "--rate", "1000",
+              "--format", "csv", "-q"], backend=backend)
+        # The papers of the first run are in the index, and "Augmented Reality" finds them too,
+        # so with room for 3 of the 4 splits, one of these two is deferred
+        assert main(["collect", self.keywords, "-o", self.out + "second/", "--rate", "1000",
+                     "--format", "csv", "--priority", "yield", "--budget", "3",
+                     "--index", self.out + "first/final_results.csv", "-q"], backend=backend) == 0
+        deferred = pd.read_csv(self.out + "second/deferred_plan.txt", comment="#")
+        assert list(deferred.split) == ['"Augmented Reality"']
+
+    def test_errors(self, create_keywords):
+        assert main(["export", self.out + "missing.csv", self.out + "exported.csv", "-q"]) == 1
+        assert main(["export", self.keywords, self.out + "exported.txt", "-q"]) == 1
+
+    def test_quota_exhausted(self, create_keywords, capsys):
+        args = ["collect", self.keywords, "-o", self.out, "--rate", "1000", "--format", "csv", "-q"]
+        assert main(args + ["--quota", "6"], backend=FakeScopus()) == 1
+        assert "--resume" in capsys.readouterr().err
+        assert main(args + ["--resume"], backend=FakeScopus()) == 0
+
+    def test_lazy_imports(self):
+        code = ("import sys; import prisma_automator.cli, prisma_automator.collector, "
+                "prisma_automator.splitter; print(sorted({'pandas', 'pybliometrics'} & set(sys.modules)))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                check=True).stdout
+        assert output.strip() == "[]"
+
+
+def cited(df):
+    return df.citedby_count.astype(int) >= 10
+
+
+class TestScreeningPipeline:
+    @pytest.fixture
+    def create_records(self):
+        self.df = synthetic_records(3000)
+        self.chunks = [self.df[i:i + 1000] for i in range(0, len(self.df), 1000)]
+        self.criteria = [YearRange(2005, 2014), KeywordExclusion(["brain computer"]),
+                         Filter(cited, "rarely cited", columns=["citedby_count"])]
+
+    def test_default_stages_match_screen(self, create_records):
+        collector = Collector(backend=FakeScopus())
+        expected = collector.screen(self.df, log=False)
+        screened = collector.screen(self.df, log=False, pipeline=Pipeline(default_stages()))
+        assert screened.equals(expected)
+
+    def test_empty_results(self):
+        collector = Collector(backend=FakeScopus())
+        screened = collector.screen(pd.DataFrame(columns=['splits']), log=False)
+        assert screened.empty and list(screened.columns) == ['splits']
+        pipeline = Pipeline(default_stages(criteria=[YearRange(2015)]), processes=2)
+        chunk, screened, decisions = next(pipeline.run([pd.DataFrame(columns=['splits', 'title'])]))
+        assert screened.empty and decisions.empty
+        assert pipeline.report().removed.sum() == 0
+
+    def test_dedup_without_titles(self):
+        df = pd.DataFrame({"doi": ["10.1/a", "10.1/A", ""], "splits": ["x", "y", "z"]})
+        dedup = Deduplicator()
+        assert list(dedup.process(df).index) == [0, 2]
+        assert list(dedup.report().title) == [None]
+
+    def test_row_local_stages_are_fused(self):
+        pipeline = Pipeline(default_stages(criteria=[YearRange(2015)]))
+        segments = [(offset, [repr(s) for s in stages]) for offset, stages in pipeline.segments()]
+        assert segments == [(0, ["Dedup(duplicate)"]),
+                            (1, ["DocumentType(conference review)", "RequireDoi(no doi)",
+                                 "YearRange(out of year range)"])]
+
+    def test_criteria_and_report(self, create_records):
+        pipeline = Pipeline(default_stages(criteria=self.criteria))
+        decisions = []
+        screened = []
+        for _, new_chunk, chunk_decisions in pipeline.run(self.chunks):
+            screened.append(new_chunk)
+            decisions.append(chunk_decisions)
+        screened = pd.concat(screened)
+        decisions = pd.concat(decisions)
+        years = screened.coverDate.str[:4].astype(int)
+        assert years.between(2005, 2014).all() and (screened.citedby_count >= 10).all()
+        assert not screened.title.str.lower().str.contains("brain computer").any()
+
+        report = pipeline.report()
+        assert list(report.decision[:-1]) == ["duplicate", "conference review", "no doi",
+                                              "out of year range", "excluded keyword", "rarely cited"]
+        assert report.rows_in[0] == 3000 and report.rows_out.iloc[-1] == len(screened)
+        assert (report.rows_in[1:].values == report.rows_out[:-1].values).all()
+        counts = decisions.value_counts()
+        assert counts["included"] == len(screened)
+        assert (report.removed[:-1].values == counts[report.decision[:-1]].values).all()
+
+    def test_process_pool_matches_sequential(self, create_records):
+        sequential = Pipeline(default_stages(criteria=self.criteria))
+        parallel = Pipeline(default_stages(criteria=self.criteria), processes=2)
+        expected = pd.concat(s for _, s, _ in sequential.run(self.chunks))
+        screened = pd.concat(s for _, s, _ in parallel.run(self.chunks))
+        assert screened.equals(expected)
+        assert sequential.report().removed.equals(parallel.report().removed)
+
+    def test_document_type_and_language(self, create_records):
+        df = self.df.assign(language=["English", "Spanish; English", "German"] * 1000)
+        pipeline = Pipeline([DocumentType(include=["Article"]), Language(["english"])])
+        _, screened, decisions = next(pipeline.run([df]))
+        assert set(screened.subtypeDescription) == {"Article"} and "German" not in set(screened.language)
+        assert decisions.eq("language").sum() == (df.subtypeDescription.eq("Article") & df.language.eq("German")).sum()
+        with pytest.raises(ValueError):
+            next(Pipeline([Language(["English"])]).run([self.df]))
+
+    def test_run_and_cli_criteria(self, tmp_path):
+        save_to = str(tmp_path) + "/"
+        collector = Collector(backend=FakeScopus(), bucket=TokenBucket(rate=1000))
+        collector.run(['"Keyword 1"', '"Keyword 2"'], save_to=save_to, log=False, format="csv",
+                      criteria=[YearRange(2020)])
+        report = pd.read_csv(save_to + "screening.csv")
+        final = pd.read_csv(save_to + "final_results.csv")
+        assert report.decision[3] == "out of year range"
+        assert report.rows_out.iloc[-1] == len(final) and (final.coverDate.str[:4].astype(int) >= 2020).all()
+
+        assert main(["screen", save_to + "chunks", save_to + "screened.csv", "--years", "-2019",
+                     "--report", save_to + "report.csv", "-q"]) == 0
+        screened = pd.read_csv(save_to + "screened.csv")
+        removed = pd.read_csv(save_to + "report.csv").removed[3]
+        assert len(screened) + removed == report.rows_out[2]
+        assert main(["screen", save_to + "chunks", save_to + "screened.csv", "--years", "x", "-q"]) == 1